@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure utils.generate_username against a User table seeded with heavy name collisions
+(every case 1-4 candidate of "juan gonzalez" and the first --collisions numbered usernames
+taken), comparing it with one exists() query per candidate, as it worked before.
+
+It runs inside the LMS, the seeded users are created in a transaction that is rolled back:
+
+    DJANGO_SETTINGS_MODULE=lms.envs.devstack python benchmarks/bench_generate_username.py --collisions 3000
+"""
+# Python Standard Libraries
+import argparse
+import os
+import time
+
+# Installed packages (via pip)
+import django
+
+USER_DATA = {
+    'nombres': 'JUAN PABLO',
+    'apellidoPaterno': 'GONZALEZ',
+    'apellidoMaterno': 'PEREZ',
+}
+
+
+class Rollback(Exception):
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--collisions', type=int, default=3000, help='numbered usernames already taken')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lms.envs.devstack')
+    django.setup()
+    from django.contrib.auth.models import User
+    from django.db import connection, transaction
+    from django.test.utils import CaptureQueriesContext
+    from uchileedxlogin.utils import USERNAME_MAX_SUFFIX, generate_username, generate_username_candidates
+
+    first_name = ['JUAN', 'PABLO']
+    last_name = ['GONZALEZ', 'PEREZ']
+    candidates = list(generate_username_candidates(first_name, last_name))
+    numbered = ['JUAN_GONZALEZ{}'.format(i) for i in range(1, USERNAME_MAX_SUFFIX)]
+    taken = candidates + numbered[:args.collisions]
+
+    try:
+        with transaction.atomic():
+            User.objects.bulk_create(
+                [User(username=username.lower(), email='{}@bench.invalid'.format(i)) for i, username in enumerate(taken)],
+                batch_size=1000)
+
+            start = time.perf_counter()
+            for i in range(args.repeat):
+                with CaptureQueriesContext(connection) as queries:
+                    username = generate_username(dict(USER_DATA))
+            batched = (time.perf_counter() - start) / args.repeat
+
+            # One exists() query per candidate, until the first free one.
+            start = time.perf_counter()
+            for i in range(args.repeat):
+                exists_queries = 0
+                for candidate in candidates + numbered:
+                    exists_queries += 1
+                    if not User.objects.filter(username=candidate).exists():
+                        break
+            one_by_one = (time.perf_counter() - start) / args.repeat
+
+            print('username: {} ({} taken)'.format(username, len(taken)))
+            print('{:<16} {:6d} queries {:9.1f} ms'.format('one by one', exists_queries, one_by_one * 1000))
+            print('{:<16} {:6d} queries {:9.1f} ms'.format('batched', len(queries), batched * 1000))
+            raise Rollback()
+    except Rollback:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the per-call latency of PH lookups made with a bare requests.get (a new
+connection per call, as ph_query did before) against the pooled ph_client.
+
+    python benchmarks/bench_ph_client.py --calls 500
+
+Both runs query the local stub in ph_stub_server.py, so the difference is the
+connection setup cost only; against the real PH api, TLS makes the gap larger.
+"""
+# Python Standard Libraries
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Installed packages (via pip)
+import requests
+from django.conf import settings
+
+from ph_stub_server import dataset_doc_id, start_server
+
+
+def measure(function, calls):
+    """
+    Call function `calls` times and return the latencies in milliseconds.
+    """
+    latencies = []
+    for i in range(calls):
+        start = time.perf_counter()
+        function(dataset_doc_id(i))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print('{:<16} mean {:7.3f} ms   p50 {:7.3f} ms   p95 {:7.3f} ms'.format(
+        name, statistics.mean(latencies), statistics.median(latencies), p95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=500)
+    args = parser.parse_args()
+
+    server = start_server(dataset_size=args.calls)
+    settings.configure(
+        EDXLOGIN_USER_INFO_URL=server.url,
+        EDXLOGIN_KEY='',
+        EDXLOGIN_PH_CACHE_TTL=0,
+        LMS_ROOT_URL='http://localhost')
+
+    from uchileedxlogin.ph_query import get_user_data
+
+    def bare_get(doc_id):
+        headers = {'AppKey': settings.EDXLOGIN_KEY, 'Origin': settings.LMS_ROOT_URL}
+        params = (('indiv_id', '"{}"'.format(doc_id)),)
+        return requests.get(settings.EDXLOGIN_USER_INFO_URL, headers=headers, params=params).json()
+
+    def pooled_get(doc_id):
+        return get_user_data(doc_id, 'indiv_id')
+
+    # Warm up both paths.
+    measure(bare_get, 10)
+    measure(pooled_get, 10)
+    report('requests.get', measure(bare_get, args.calls))
+    report('ph_client', measure(pooled_get, args.calls))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
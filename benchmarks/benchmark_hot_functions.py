@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+pytest-benchmark suite of the pure-Python functions that run on every row of the bulk uploads.
+
+    pytest benchmarks/                                # autosaves the results in .benchmarks/
+    pytest benchmarks/ --benchmark-compare            # compare against the last saved run
+    pytest benchmarks/ --benchmark-json=results.json
+    EDXLOGIN_BENCHMARK_MAX_SIZE=10000 pytest benchmarks/
+
+Every benchmark runs over synthetic datasets of 10^3 to 10^6 rows (capped by
+EDXLOGIN_BENCHMARK_MAX_SIZE), built with a fixed seed, that mix valid values with
+adversarial ones: very long values, separators only, unicode, wrong verification digits.
+The functions that query the database (select_email, generate_username) run over smaller
+datasets against a User table seeded with collisions.
+"""
+# Python Standard Libraries
+import os
+import random
+import re
+from itertools import cycle
+
+# Installed packages (via pip)
+import pytest
+from django.contrib.auth.models import User
+
+# Internal project dependencies
+from uchileedxlogin.doc_ids import parse_doc_ids
+from uchileedxlogin.utils import generate_username, get_username_candidates, select_email, validate_all_doc_id_types, validate_rut
+from uchileedxlogin.views import regex
+
+SEED = 20240101
+MAX_SIZE = int(os.environ.get('EDXLOGIN_BENCHMARK_MAX_SIZE', 10 ** 6))
+SIZES = [size for size in (10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6) if size <= MAX_SIZE]
+DB_SIZES = [size for size in (10 ** 2, 10 ** 3) if size <= MAX_SIZE]
+FIRST_NAMES = ['juan', 'maría', 'josé', 'ana', 'pedro', 'sofía', 'ñuño', 'luis', 'o\'higgins', 'van der berg']
+LAST_NAMES = ['gonzález', 'muñoz', 'rojas', 'díaz', 'pérez', 'soto', 'contreras', 'silva', 'martínez', 'sepúlveda']
+
+
+def rut_dv(number):
+    digits = map(int, reversed(str(number)))
+    res = (-sum(d * f for d, f in zip(digits, cycle(range(2, 8))))) % 11
+    return 'K' if res == 10 else str(res)
+
+
+def adversarial_doc_ids(rng):
+    return [
+        '9' * 1000 + '-K',
+        '1' * 2000,
+        '-.-.-.-.-.',
+        '',
+        ' ',
+        'P' + 'A' * 500,
+        'CG' + '0' * 1000,
+        '١٢٣٤٥٦٧٨-٥',
+        '12.345.678-ñ',
+        ''.join(rng.choice('0123456789.-kK ') for i in range(64)),
+    ]
+
+
+def doc_id_dataset(size):
+    """
+    Return `size` doc_ids typed in every format seen in the uploads, 10% of them with a wrong
+    verification digit, 5% passports and CGs and 1% adversarial values.
+    """
+    rng = random.Random(SEED + size)
+    adversarial = adversarial_doc_ids(rng)
+    doc_ids = []
+    for i in range(size):
+        kind = rng.random()
+        if kind < 0.01:
+            doc_ids.append(adversarial[i % len(adversarial)])
+            continue
+        if kind < 0.035:
+            doc_ids.append('P{}'.format(rng.randint(10 ** 5, 10 ** 12)))
+            continue
+        if kind < 0.06:
+            doc_ids.append('CG{:08d}'.format(rng.randint(0, 10 ** 8 - 1)))
+            continue
+        number = rng.randint(10 ** 6, 3 * 10 ** 7)
+        dv = rut_dv(number) if kind > 0.15 else rng.choice('0123456789K')
+        style = rng.randint(0, 3)
+        if style == 0:
+            doc_ids.append('{:,}-{}'.format(number, dv).replace(',', '.'))
+        elif style == 1:
+            doc_ids.append('{}-{}'.format(number, dv.lower()))
+        elif style == 2:
+            doc_ids.append(' {}{} '.format(number, dv))
+        else:
+            doc_ids.append('{}{}'.format(number, dv).rjust(10, '0'))
+    return doc_ids
+
+
+def email_dataset(size):
+    rng = random.Random(SEED + size)
+    adversarial = [
+        'a.' * 5000 + 'a@',
+        'a' * 10000 + '@' + 'b.' * 5000,
+        '"' + 'x' * 10000,
+        '@@@@@@@@@@',
+        'ñandú@uchile.cl',
+        'test@' + 'sub.' * 1000 + 'c',
+    ]
+    emails = []
+    for i in range(size):
+        if rng.random() < 0.01:
+            emails.append(adversarial[i % len(adversarial)])
+        else:
+            emails.append('{}.{}{}@{}'.format(
+                rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), i, rng.choice(['uchile.cl', 'ug.uchile.cl', 'gmail.com'])))
+    return emails
+
+
+def name_dataset(size):
+    """
+    Return `size` ph user_data with common names, 1% of them adversarial (many or very long names).
+    """
+    rng = random.Random(SEED + size)
+    adversarial = [
+        {'nombres': ' '.join(FIRST_NAMES * 5), 'apellidoPaterno': ' '.join(LAST_NAMES * 5), 'apellidoMaterno': None},
+        {'nombres': 'a' * 500, 'apellidoPaterno': 'b' * 500, 'apellidoMaterno': 'c' * 500},
+        {'nombres': '', 'apellidoPaterno': None, 'apellidoMaterno': None},
+        {'nombres': '!!! ??? ###', 'apellidoPaterno': '***', 'apellidoMaterno': '$$$'},
+    ]
+    names = []
+    for i in range(size):
+        if rng.random() < 0.01:
+            names.append(dict(adversarial[i % len(adversarial)]))
+        else:
+            names.append({
+                'nombres': '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(FIRST_NAMES)),
+                'apellidoPaterno': rng.choice(LAST_NAMES),
+                'apellidoMaterno': rng.choice(LAST_NAMES),
+            })
+    return names
+
+
+def legacy_normalize_doc_ids(text):
+    """
+    doc_id normalisation and padding that EdxLoginStaff and EdxLoginUserData did before
+    doc_ids.parse_doc_ids, kept as the baseline of test_parse_doc_ids.
+    """
+    doc_id_list = text.split('\n')
+    doc_id_list = [doc_id.upper() for doc_id in doc_id_list]
+    doc_id_list = [doc_id.replace("-", "") for doc_id in doc_id_list]
+    doc_id_list = [doc_id.replace(".", "") for doc_id in doc_id_list]
+    doc_id_list = [doc_id.strip() for doc_id in doc_id_list]
+    doc_id_list = [doc_id for doc_id in doc_id_list if doc_id]
+    doc_id_list_format = []
+    for doc_id in doc_id_list:
+        while len(doc_id) < 10 and 'P' != doc_id[0] and 'CG' != doc_id[0:2]:
+            doc_id = "0" + doc_id
+        doc_id_list_format.append(doc_id)
+    return doc_id_list_format
+
+
+def run(benchmark, size, function, *args):
+    """
+    Benchmark function over a dataset of `size` rows, with fewer rounds for the big datasets.
+    """
+    benchmark.extra_info['size'] = size
+    return benchmark.pedantic(function, args=args, rounds=3 if size >= 10 ** 5 else 10, warmup_rounds=1)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_validate_rut(benchmark, size):
+    doc_ids = [doc_id for doc_id in doc_id_dataset(size) if doc_id.strip()]
+
+    def validate(doc_ids):
+        return sum(1 for doc_id in doc_ids if validate_rut(doc_id))
+    run(benchmark, size, validate, doc_ids)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_validate_all_doc_id_types(benchmark, size):
+    doc_ids = [doc_id.cleaned for doc_id in parse_doc_ids(doc_id_dataset(size))]
+    run(benchmark, size, lambda doc_ids: [validate_all_doc_id_types(doc_id) for doc_id in doc_ids], doc_ids)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_legacy_normalize_doc_ids(benchmark, size):
+    text = '\n'.join(doc_id_dataset(size))
+    run(benchmark, size, legacy_normalize_doc_ids, text)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_parse_doc_ids(benchmark, size):
+    """
+    Cleaning, padding, validation and duplicates of a pasted textarea, 10^5 lines is the target.
+    """
+    text = '\n'.join(doc_id_dataset(size))
+    run(benchmark, size, parse_doc_ids, text)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_email_regex(benchmark, size):
+    emails = email_dataset(size)
+    run(benchmark, size, lambda emails: [re.match(regex, email) is not None for email in emails], emails)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_get_username_candidates(benchmark, size):
+    names = name_dataset(size)
+    run(benchmark, size, lambda names: [get_username_candidates(name) for name in names], names)
+
+
+@pytest.fixture
+def seeded_users(db):
+    """
+    User table with the usual collisions: the first candidates of every common name taken.
+    """
+    usernames = {}
+    for first_name in FIRST_NAMES:
+        for last_name in LAST_NAMES:
+            candidates, numbered_prefix = get_username_candidates(
+                {'nombres': first_name, 'apellidoPaterno': last_name, 'apellidoMaterno': None})
+            usernames.update(dict.fromkeys(candidates + ['{}{}'.format(numbered_prefix, i) for i in range(1, 50)]))
+    users = [User(username=username, email='{}@uchile.cl'.format(username)) for username in usernames]
+    User.objects.bulk_create(users, batch_size=1000)
+    return users
+
+
+@pytest.mark.parametrize('size', DB_SIZES)
+def test_select_email(benchmark, seeded_users, size):
+    rng = random.Random(SEED + size)
+    email_lists = [
+        [seeded_users[rng.randrange(len(seeded_users))].email, 'new{}@gmail.com'.format(i), 'new{}@uchile.cl'.format(i)]
+        for i in range(size)]
+    run(benchmark, size, lambda email_lists: [select_email(emails) for emails in email_lists], email_lists)
+
+
+@pytest.mark.parametrize('size', DB_SIZES)
+def test_generate_username(benchmark, seeded_users, size):
+    names = name_dataset(size)
+    run(benchmark, size, lambda names: [generate_username(dict(name)) for name in names], names)
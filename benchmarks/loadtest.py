@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test of the login and staff flows against the local PH/CAS stand-in (ph_stub_server.py).
+
+It replays, at the given concurrency, one of the scenarios:
+
+- callback: EdxLoginCallback with a ticket of a persona of the dataset (CAS validate, PH
+  lookup, account creation on the first pass and login).
+- staff: EdxLoginStaff bulk enroll ("enroll" action) of --batch-size doc_ids in --course. With
+  more than EDXLOGIN_JOB_MIN_ROWS doc_ids the view queues a background job, those operations are
+  reported as queued and left out of the latency percentiles.
+- export: EdxLoginUserData export of --batch-size doc_ids.
+
+and reports the p50/p95/p99 latency and the PH calls per operation.
+It runs inside the LMS, against its database (it creates users and enrollments, so use a
+devstack or a throwaway database, sqlite in-memory databases aren't shared between threads):
+
+    DJANGO_SETTINGS_MODULE=lms.envs.devstack python benchmarks/loadtest.py \\
+        --scenario callback --concurrency 20 --operations 1000 --latency-ms 40
+
+Without --stub-url the stub is started in-process with --latency-ms, --error-rate and
+--dataset-size.
+"""
+# Python Standard Libraries
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Installed packages (via pip)
+import django
+import requests
+
+from ph_stub_server import dataset_doc_id, dataset_username, start_server
+
+SCENARIOS = ['callback', 'staff', 'export']
+STAFF_USERNAME = 'edxlogin_loadtest_staff'
+# Outcomes of an operation.
+SUCCEEDED = 'succeeded'
+QUEUED = 'queued'
+FAILED = 'failed'
+
+
+def percentile(values, percent):
+    """
+    Return the nearest-rank percentile of a sorted list.
+    """
+    if not values:
+        return 0
+    rank = max(1, int(round(percent / 100.0 * len(values))))
+    return values[min(rank, len(values)) - 1]
+
+
+def format_doc_id(doc_id):
+    """
+    Format a padded doc_id as the staff would type it, e.g. 10000000-8.
+    """
+    doc_id = doc_id.lstrip('0')
+    return '{}-{}'.format(doc_id[:-1], doc_id[-1])
+
+
+def staff_outcome(context):
+    """
+    Return the outcome of a staff request: QUEUED if the view queued a background job, SUCCEEDED
+    if it saved the doc_ids, FAILED otherwise (it answers with status 200 on errors too).
+    """
+    if 'job_id' in context:
+        return QUEUED
+    saved = 'saved' in context or 'doc_id_saved' in context
+    if saved and not any(key.startswith('error') for key in context):
+        return SUCCEEDED
+    return FAILED
+
+
+class LoadTest(object):
+    def __init__(self, args, stub_url):
+        # Django is configured at this point.
+        from django.contrib.auth.models import Permission, User
+        from django.test import Client
+        from django.urls import reverse
+
+        self.args = args
+        self.stub_url = stub_url
+        self.client_class = Client
+        self.local = threading.local()
+        self.urls = {
+            'login': reverse('uchileedxlogin-login:login'),
+            'callback': reverse('uchileedxlogin-login:callback'),
+            'staff': reverse('uchileedxlogin-login:staff'),
+            'export': reverse('uchileedxlogin-login:data'),
+        }
+        self.staff_user, _ = User.objects.get_or_create(
+            username=STAFF_USERNAME,
+            defaults={'email': '{}@example.com'.format(STAFF_USERNAME), 'is_staff': True})
+        # The staff view also checks this permission for every course of the request.
+        self.staff_user.user_permissions.add(Permission.objects.get(
+            codename='uchile_instructor_staff', content_type__app_label='uchileedxlogin'))
+
+    def client(self):
+        """
+        Return the client of the current thread.
+        """
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.client_class(HTTP_HOST=self.args.host)
+            if self.args.scenario != 'callback':
+                client.force_login(self.staff_user)
+            self.local.client = client
+        return client
+
+    def batch(self, number):
+        first = number * self.args.batch_size
+        return '\n'.join(
+            format_doc_id(dataset_doc_id((first + i) % self.args.dataset_size))
+            for i in range(self.args.batch_size))
+
+    def operation(self, number):
+        """
+        Run the operation `number` of the scenario, return (seconds, outcome).
+        """
+        scenario = self.args.scenario
+        start = time.perf_counter()
+        if scenario == 'callback':
+            # A new client each time, so every login starts without a session.
+            client = self.client_class(HTTP_HOST=self.args.host)
+            ticket = 'ST-{}'.format(dataset_username(number % self.args.dataset_size))
+            response = client.get(self.urls['callback'], data={'ticket': ticket})
+            succeeded = response.status_code == 302 and not response['Location'].startswith(self.urls['login'])
+            outcome = SUCCEEDED if succeeded else FAILED
+        elif scenario == 'staff':
+            data = {
+                'action': 'enroll',
+                'doc_ids': self.batch(number),
+                'course': self.args.course,
+                'modes': 'audit',
+                'enroll': '1'}
+            if self.args.force:
+                data['force'] = '1'
+            response = self.client().post(self.urls['staff'], data=data)
+            outcome = staff_outcome(response.json()) if response.status_code == 200 else FAILED
+        else:
+            response = self.client().post(self.urls['export'], data={'doc_ids': self.batch(number)})
+            succeeded = response.status_code == 200 and response['Content-Type'] == 'text/csv'
+            outcome = SUCCEEDED if succeeded else FAILED
+        return time.perf_counter() - start, outcome
+
+    def worker(self, number):
+        from django.db import connection
+        try:
+            return self.operation(number)
+        except Exception as e:
+            print('Operation {} failed: {!r}'.format(number, e), file=sys.stderr)
+            return 0, FAILED
+        finally:
+            if self.args.close_connections:
+                connection.close()
+
+    def stub_stats(self):
+        return requests.get(self.stub_url + '__stats').json()
+
+    def run(self):
+        requests.get(self.stub_url + '__reset')
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            results = list(executor.map(self.worker, range(self.args.operations)))
+        elapsed = time.perf_counter() - start
+        return results, elapsed, self.stub_stats()
+
+
+def report(args, results, elapsed, stats):
+    latencies = sorted(seconds * 1000 for seconds, outcome in results if outcome == SUCCEEDED)
+    queued = sum(1 for _, outcome in results if outcome == QUEUED)
+    failed = sum(1 for _, outcome in results if outcome == FAILED)
+    print('scenario {}, {} operations, concurrency {}{}'.format(
+        args.scenario, len(results), args.concurrency,
+        ', batch size {}'.format(args.batch_size) if args.scenario != 'callback' else ''))
+    print('throughput  {:8.1f} ops/s   failed {}   queued {}'.format(len(results) / elapsed, failed, queued))
+    print('latency     p50 {:8.1f} ms   p95 {:8.1f} ms   p99 {:8.1f} ms'.format(
+        percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99)))
+    print('ph calls    {:8.2f} per operation ({} total, {} errors)'.format(
+        stats['ph_requests'] / float(len(results)), stats['ph_requests'], stats['ph_errors']))
+    print('cas calls   {:8.2f} per operation'.format(stats['cas_requests'] / float(len(results))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=SCENARIOS, default='callback')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--operations', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=50, help='doc_ids per staff/export operation')
+    parser.add_argument('--course', default='', help='course id used by the staff scenario')
+    parser.add_argument('--force', action='store_true', help='force enroll in the staff scenario')
+    parser.add_argument('--host', default='localhost', help='Host header of the requests, must be allowed')
+    parser.add_argument('--stub-url', default=None, help='url of a running ph_stub_server.py')
+    parser.add_argument('--dataset-size', type=int, default=1000)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--close-connections', action='store_true', help='close the db connection after each operation')
+    args = parser.parse_args()
+    if args.scenario == 'staff' and not args.course:
+        parser.error('--course is required by the staff scenario')
+
+    server = None
+    stub_url = args.stub_url
+    if stub_url is None:
+        server = start_server(
+            dataset_size=args.dataset_size,
+            latency_ms=args.latency_ms,
+            error_rate=args.error_rate)
+        stub_url = server.url
+    if not stub_url.endswith('/'):
+        stub_url += '/'
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lms.envs.devstack')
+    django.setup()
+    from django.test.utils import override_settings
+    with override_settings(
+            EDXLOGIN_USER_INFO_URL=stub_url,
+            EDXLOGIN_RESULT_VALIDATE=stub_url + 'validate',
+            EDXLOGIN_REQUEST_URL=stub_url + 'login'):
+        results, elapsed, stats = LoadTest(args, stub_url).run()
+    report(args, results, elapsed, stats)
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the uchile services used by the plugin, for benchmarks and load tests:
+
+- PH persona api (EDXLOGIN_USER_INFO_URL): GET /?indiv_id="<doc_id>" or /?usuario="<username>".
+- CAS (EDXLOGIN_REQUEST_URL / EDXLOGIN_RESULT_VALIDATE): GET /login redirects to the service
+  with a ticket, GET /validate?ticket=ST-<username> answers "yes\\n<username>\\n".
+- GET /__stats returns the request counters as json, GET /__reset resets them.
+
+The persona dataset is deterministic (see dataset_persona), values outside of it
+get an empty persona list, like ph does.
+
+    python benchmarks/ph_stub_server.py --port 8765 --dataset-size 10000 --latency-ms 40 --error-rate 0.01
+"""
+# Python Standard Libraries
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import cycle
+from urllib.parse import parse_qs, urlencode, urlparse
+
+FIRST_RUT = 10000000
+
+
+def rut_dv(number):
+    """
+    Return the verification digit of a rut number.
+    """
+    digits = map(int, reversed(str(number)))
+    s = sum(d * f for d, f in zip(digits, cycle(range(2, 8))))
+    res = (-s) % 11
+    return 'K' if res == 10 else str(res)
+
+
+def dataset_doc_id(index):
+    """
+    Return the (padded) doc_id of the persona number index of the dataset.
+    """
+    number = FIRST_RUT + index
+    return '{}{}'.format(number, rut_dv(number)).rjust(10, '0')
+
+
+def dataset_username(index):
+    return 'user.{}'.format(index)
+
+
+def dataset_persona(index):
+    """
+    Return the ph persona number index of the dataset.
+    """
+    username = dataset_username(index)
+    return {
+        "indiv_id": dataset_doc_id(index),
+        "nombres": "NOMBRE{} SEGUNDO".format(index),
+        "paterno": "PATERNO",
+        "materno": "MATERNO",
+        "pasaporte": [{"usuario": username}],
+        "email": [{"email": "{}@uchile.cl".format(username)}]
+    }
+
+
+def dataset_index(query_type, value, dataset_size):
+    """
+    Return the index of the persona matching the query, None if it isn't in the dataset.
+    """
+    try:
+        if query_type == 'usuario':
+            index = int(value.split('.', 1)[1])
+        else:
+            index = int(value[:-1]) - FIRST_RUT
+    except (IndexError, ValueError):
+        return None
+    if 0 <= index < dataset_size:
+        return index
+    return None
+
+
+class PhStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/__stats':
+            return self.send_body(200, json.dumps(self.server.stats()), 'application/json')
+        if url.path == '/__reset':
+            self.server.reset()
+            return self.send_body(200, '{}', 'application/json')
+        if url.path.endswith('/login'):
+            return self.cas_login(query)
+        if url.path.endswith('/validate'):
+            return self.cas_validate(query)
+        return self.ph_query(query)
+
+    def simulate(self):
+        """
+        Wait the configured latency, returns False if the request must fail.
+        """
+        if self.server.latency:
+            time.sleep(max(0, random.gauss(self.server.latency, self.server.latency * 0.2)))
+        return random.random() >= self.server.error_rate
+
+    def ph_query(self, query):
+        self.server.count('ph_requests')
+        if not self.simulate():
+            self.server.count('ph_errors')
+            return self.send_body(500, 'stub error', 'text/plain')
+        query_type = 'usuario' if 'usuario' in query else 'indiv_id'
+        value = query.get(query_type, [''])[0].strip('"')
+        index = dataset_index(query_type, value, self.server.dataset_size)
+        persona = [] if index is None else [dataset_persona(index)]
+        body = json.dumps({
+            'data': {
+                'getRowsPersona': {
+                    'status_code': 200,
+                    'persona': persona
+                }
+            }
+        })
+        return self.send_body(200, body, 'application/json')
+
+    def cas_login(self, query):
+        service = query.get('service', [''])[0]
+        username = query.get('username', [dataset_username(0)])[0]
+        separator = '&' if '?' in service else '?'
+        self.send_response(302)
+        self.send_header('Location', '{}{}{}'.format(service, separator, urlencode({'ticket': 'ST-' + username})))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def cas_validate(self, query):
+        self.server.count('cas_requests')
+        if not self.simulate():
+            self.server.count('cas_errors')
+            return self.send_body(500, 'stub error', 'text/plain')
+        ticket = query.get('ticket', [''])[0]
+        if ticket.startswith('ST-'):
+            return self.send_body(200, 'yes\n{}\n'.format(ticket[3:]), 'text/plain')
+        return self.send_body(200, 'no\n\n', 'text/plain')
+
+    def send_body(self, status, body, content_type):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PhStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler=PhStubHandler, dataset_size=10000, latency_ms=0, error_rate=0):
+        super().__init__(address, handler)
+        self.dataset_size = dataset_size
+        self.latency = latency_ms / 1000.0
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address)
+
+    @property
+    def request_count(self):
+        return self.counters['ph_requests']
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def reset(self):
+        with self._lock:
+            self.counters = {'ph_requests': 0, 'ph_errors': 0, 'cas_requests': 0, 'cas_errors': 0}
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+def start_server(host='127.0.0.1', port=0, **kwargs):
+    """
+    Start the stub in a daemon thread and return the server.
+    """
+    server = PhStubServer((host, port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--dataset-size', type=int, default=10000, help='number of personas known by ph')
+    parser.add_argument('--latency-ms', type=float, default=0, help='mean latency of every response')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests answered with a 500')
+    args = parser.parse_args()
+    server = PhStubServer(
+        (args.host, args.port),
+        dataset_size=args.dataset_size,
+        latency_ms=args.latency_ms,
+        error_rate=args.error_rate)
+    print('Stub listening on {} (ph: /, cas: /login and /validate)'.format(server.url))
+    server.serve_forever()
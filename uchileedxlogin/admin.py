@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import EdxLoginUser, EdxLoginUserCourseRegistration
+from .models import EdxLoginJob, EdxLoginPersona, EdxLoginUser, EdxLoginUserCourseRegistration
 
 # Register your models here.
 
@@ -17,7 +17,22 @@ class EdxLoginUserCourseRegistrationAdmin(admin.ModelAdmin):
     ordering = ['-course']
 
 
+class EdxLoginPersonaAdmin(admin.ModelAdmin):
+    list_display = ('run', 'username', 'have_sso', 'fetched_at')
+    search_fields = ['run', 'username']
+    ordering = ['-fetched_at']
+
+
+class EdxLoginJobAdmin(admin.ModelAdmin):
+    raw_id_fields = ('user',)
+    list_display = ('id', 'action', 'status', 'processed', 'total', 'user', 'created_at')
+    list_filter = ('action', 'status')
+    ordering = ['-created_at']
+
+
 admin.site.register(EdxLoginUser, EdxLoginUserAdmin)
 admin.site.register(
     EdxLoginUserCourseRegistration,
     EdxLoginUserCourseRegistrationAdmin)
+admin.site.register(EdxLoginPersona, EdxLoginPersonaAdmin)
+admin.site.register(EdxLoginJob, EdxLoginJobAdmin)
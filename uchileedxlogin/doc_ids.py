@@ -0,0 +1,98 @@
+"""
+Parsing of the document ids (doc_id) typed in the staff, external and userdata forms.
+
+A doc_id is cleaned (upper case, without '-', '.' and surrounding whitespace) and, unless it is
+a passport ('P...') or a CG ('CG...'), padded with zeros to DOC_ID_LENGTH, which is how the
+runs are saved in EdxLoginUser and EdxLoginUserCourseRegistration.
+"""
+# Python Standard Libraries
+from collections import namedtuple
+from itertools import cycle
+from operator import mul
+
+# Internal project dependencies
+from uchileedxlogin.services.utils import get_document_type
+
+DOC_ID_LENGTH = 10
+PASSPORT_MIN_LENGTH = 5
+PASSPORT_MAX_LENGTH = 20
+
+RUT_FACTORS = (2, 3, 4, 5, 6, 7)
+
+_SEPARATORS = str.maketrans('', '', '-.')
+
+# cleaned is the doc_id as typed once cleaned (used in the error messages), value the canonical
+# doc_id, duplicate is True when a previous doc_id of the same input has the same value.
+DocId = namedtuple('DocId', ['cleaned', 'value', 'type', 'valid', 'duplicate'])
+
+
+def rut_verification_digit(number):
+    """
+    Return the verification digit ('0'-'9' or 'K') of the rut number (a string of digits).
+    Raises ValueError if number has any other character.
+    """
+    res = (-sum(map(mul, map(int, reversed(number)), cycle(RUT_FACTORS)))) % 11
+    return 'K' if res == 10 else str(res)
+
+
+def is_valid_doc_id(cleaned, doc_id_type):
+    """
+    Verify a cleaned doc_id of type doc_id_type (see services.utils.get_document_type): the
+    verification digit of a rut, the length of a passport or CG.
+    """
+    if doc_id_type == 'passport':
+        return PASSPORT_MIN_LENGTH <= len(cleaned) - 1 <= PASSPORT_MAX_LENGTH
+    if doc_id_type == 'cg':
+        return len(cleaned) == DOC_ID_LENGTH
+    if not cleaned:
+        return False
+    try:
+        return rut_verification_digit(cleaned[:-1]) == cleaned[-1]
+    except ValueError:
+        return False
+
+
+def clean_doc_id(doc_id):
+    return doc_id.upper().translate(_SEPARATORS).strip()
+
+
+def format_doc_id(doc_id):
+    """
+    Return the canonical doc_id of doc_id, '' if it's blank.
+    """
+    cleaned = clean_doc_id(doc_id)
+    if cleaned and get_document_type(cleaned) == 'rut':
+        return cleaned.rjust(DOC_ID_LENGTH, '0')
+    return cleaned
+
+
+def parse_doc_ids(doc_ids):
+    """
+    Parse the doc_ids of a textarea (one per line) or of a list (e.g. a CSV column) in a single
+    pass, returning a DocId for each one that isn't blank, in the same order.
+    """
+    if isinstance(doc_ids, str):
+        lines = doc_ids.upper().translate(_SEPARATORS).split('\n')
+    else:
+        lines = [doc_id.upper().translate(_SEPARATORS) for doc_id in doc_ids]
+    parsed = []
+    seen = set()
+    for line in lines:
+        cleaned = line.strip()
+        if not cleaned:
+            continue
+        # get_document_type and is_valid_doc_id, inlined for the ruts as they are most of the lines.
+        if cleaned[0] == 'P' or cleaned[:2] == 'CG':
+            doc_id_type = get_document_type(cleaned)
+            value = cleaned
+            valid = is_valid_doc_id(cleaned, doc_id_type)
+        else:
+            doc_id_type = 'rut'
+            value = cleaned.rjust(DOC_ID_LENGTH, '0')
+            try:
+                valid = rut_verification_digit(cleaned[:-1]) == cleaned[-1]
+            except ValueError:
+                valid = False
+        parsed.append(DocId(cleaned, value, doc_id_type, valid, value in seen))
+        seen.add(value)
+    return parsed
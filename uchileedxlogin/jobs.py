@@ -0,0 +1,224 @@
+# Python Standard Libraries
+import json
+import logging
+from collections import Counter
+from datetime import timedelta
+
+# Installed packages (via pip)
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+# Internal project dependencies
+from uchileedxlogin.models import EdxLoginJob
+
+logger = logging.getLogger(__name__)
+
+JOB_DEFAULT_MIN_ROWS = 50
+JOB_DEFAULT_CHUNK_SIZE = 100
+BULK_DEFAULT_MAX_ROWS = 5000
+JOB_DEFAULT_STALE_AFTER = 1800
+
+
+def get_bulk_max_rows():
+    """
+    Max number of rows (doc_ids or external users) of a staff or external request.
+    """
+    return getattr(settings, 'EDXLOGIN_BULK_MAX_ROWS', BULK_DEFAULT_MAX_ROWS)
+
+
+def job_chunk_size():
+    return getattr(settings, 'EDXLOGIN_JOB_CHUNK_SIZE', JOB_DEFAULT_CHUNK_SIZE)
+
+
+def use_background_job(request, rows):
+    """
+    Check if a staff or external request of rows rows is run as a background job: when it's
+    asked for in the 'background' parameter or it has more than EDXLOGIN_JOB_MIN_ROWS rows.
+    """
+    if request.POST.getlist("background"):
+        return True
+    min_rows = getattr(settings, 'EDXLOGIN_JOB_MIN_ROWS', JOB_DEFAULT_MIN_ROWS)
+    return min_rows is not None and rows > min_rows
+
+
+def create_job(user, action, params, total):
+    return EdxLoginJob.objects.create(user=user, action=action, params=json.dumps(params), total=total)
+
+
+def get_job_status(job):
+    """
+    Return the progress of job, the number of rows of each outcome and its result so far.
+    """
+    return {
+        'job_id': job.id,
+        'action': job.action,
+        'status': job.status,
+        'total': job.total,
+        'processed': job.processed,
+        'outcomes': dict(Counter(json.loads(job.outcomes))),
+        'result': json.loads(job.result),
+    }
+
+
+def save_progress(job, result, outcomes):
+    """
+    Save the result of job so far and the outcomes of the rows of a chunk. It's called in the
+    transaction of the chunk, so the progress is committed (or rolled back) with its rows.
+    """
+    job.processed += len(outcomes)
+    job.result = json.dumps(result)
+    job.outcomes = json.dumps(json.loads(job.outcomes) + outcomes)
+    job.save(update_fields=['processed', 'result', 'outcomes', 'updated_at'])
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def merge_doc_id_saved(doc_id_saved, chunk_doc_id_saved):
+    """
+    Join the doc_id_saved report of EdxLoginStaff.enroll_or_create_users for a chunk to the
+    report of the previous chunks.
+    """
+    for key, value in chunk_doc_id_saved.items():
+        separator = " - " if key == 'doc_id_saved_pending' else " / "
+        doc_id_saved[key] = separator.join(saved for saved in (doc_id_saved.get(key, ''), value) if saved)
+    return doc_id_saved
+
+
+def run_staff_job(job, params):
+    """
+    Enroll the doc_ids of params not processed yet, in chunks of EDXLOGIN_JOB_CHUNK_SIZE doc_ids.
+    """
+    # Imported here, the views import this module.
+    from uchileedxlogin.views import EdxLoginStaff
+
+    def checkpoint(chunk_result, outcomes):
+        result = json.loads(job.result)
+        if result:
+            merge_doc_id_saved(result['doc_id_saved'], chunk_result['doc_id_saved'])
+        else:
+            result = chunk_result
+        save_progress(job, result, outcomes)
+
+    for doc_id_list in chunks(params['doc_id_list'][job.processed:], job_chunk_size()):
+        EdxLoginStaff().enroll_or_create_users(
+            params['course_ids'], params['mode'], doc_id_list, params['force'], params['enroll'],
+            checkpoint=checkpoint)
+
+
+def run_external_job(job, params):
+    """
+    Enroll the rows of params not processed yet, in chunks of EDXLOGIN_JOB_CHUNK_SIZE rows.
+    The emails of a chunk are queued when its transaction commits: they carry the generated
+    passwords, which are not stored, so they can't be sent again once the rows are committed.
+    """
+    from uchileedxlogin.views import EdxLoginExternal
+
+    view = EdxLoginExternal()
+
+    def checkpoint(lista_saved, lista_not_saved, outcomes):
+        transaction.on_commit(lambda: view.send_enroll_emails(
+            params['course_ids'], lista_saved, params['send_email'], params['login_url'], params['helpdesk_url']))
+        result = json.loads(job.result)
+        email_saved = result.get('lista_saved', []) + [
+            {key: value for key, value in saved.items() if key != 'password'} for saved in lista_saved]
+        lista_not_saved = result.get('lista_not_saved', []) + lista_not_saved
+        save_progress(job, view.saved_context(email_saved, lista_not_saved, params['send_email']), outcomes)
+
+    for lista_data in chunks(params['lista_data'][job.processed:], job_chunk_size()):
+        view.enroll_create_user(
+            params['course_ids'], params['mode'], lista_data, params['enroll'], checkpoint=checkpoint)
+
+
+def run_sync_job(job, params):
+    """
+    Sync the roster of params (see EdxLoginStaff.sync_roster): the doc_ids to add are enrolled in
+    chunks of EDXLOGIN_JOB_CHUNK_SIZE doc_ids, each committed with the progress of the job, and
+    the ones to remove are unenrolled at the end. A resumed job plans the sync again, so the
+    doc_ids added by its committed chunks are not added twice.
+    """
+    from uchileedxlogin.views import EdxLoginStaff
+
+    view = EdxLoginStaff()
+    doc_id_sync = view.plan_sync(params['course_ids'], params['doc_id_list'], params['enroll'])
+    courses_by_adds = view.group_sync_courses(doc_id_sync, 'added')
+    result = json.loads(job.result) or view.sync_report(
+        {course_id: {'added': [], 'removed': []} for course_id in params['course_ids']}, {})
+    job.total = job.processed + sum(len(added) for added in courses_by_adds)
+    job.save(update_fields=['total', 'updated_at'])
+
+    def checkpoint(course_ids, doc_id_list):
+        def save_chunk(chunk_result, outcomes):
+            merge_doc_id_saved(result['doc_id_saved'], chunk_result['doc_id_saved'])
+            for course_id in course_ids:
+                result['doc_id_sync'][course_id]['added'].extend(doc_id_list)
+            save_progress(job, result, outcomes)
+        return save_chunk
+
+    for added, course_ids in courses_by_adds.items():
+        for doc_id_list in chunks(list(added), job_chunk_size()):
+            view.enroll_or_create_users(
+                course_ids, params['mode'], doc_id_list, params['force'], params['enroll'],
+                checkpoint=checkpoint(course_ids, doc_id_list))
+    with transaction.atomic():
+        for removed, course_ids in view.group_sync_courses(doc_id_sync, 'removed').items():
+            view.unenroll_user(course_ids, list(removed))
+            for course_id in course_ids:
+                result['doc_id_sync'][course_id]['removed'].extend(removed)
+        save_progress(job, result, [])
+
+
+JOB_RUNNERS = {
+    'enroll': run_staff_job,
+    'staff_enroll': run_staff_job,
+    'external': run_external_job,
+    'sync': run_sync_job,
+}
+
+
+def run_job(job_id):
+    """
+    Run the pending job job_id from its first row not processed yet, committing its progress
+    with each chunk of EDXLOGIN_JOB_CHUNK_SIZE rows.
+    """
+    # Claimed with an update, so a job queued twice is run once.
+    if not EdxLoginJob.objects.filter(id=job_id, status='pending').update(status='running', updated_at=timezone.now()):
+        logger.error("There isn't a pending job with id: {}".format(job_id))
+        return
+    job = EdxLoginJob.objects.get(id=job_id)
+    try:
+        JOB_RUNNERS[job.action](job, json.loads(job.params))
+    except Exception:
+        logger.exception("Job {} ({}) failed after {} of {} rows".format(job.id, job.action, job.processed, job.total))
+        job.status = 'failed'
+    else:
+        job.status = 'finished'
+    job.save(update_fields=['status', 'updated_at'])
+
+
+def resume_job(job_id):
+    """
+    Run again the failed or interrupted (still running) job job_id from its last committed chunk.
+    """
+    if not EdxLoginJob.objects.filter(id=job_id, status__in=['running', 'failed']).update(status='pending'):
+        logger.error("There isn't a failed or running job with id: {}".format(job_id))
+        return
+    run_job(job_id)
+
+
+def get_resumable_job_ids(stale_after=None, failed=False):
+    """
+    Return the ids of the jobs still running without progress in the last stale_after seconds
+    (EDXLOGIN_JOB_STALE_AFTER by default), their worker was interrupted, and of the failed
+    jobs if failed is set.
+    """
+    if stale_after is None:
+        stale_after = getattr(settings, 'EDXLOGIN_JOB_STALE_AFTER', JOB_DEFAULT_STALE_AFTER)
+    jobs = EdxLoginJob.objects.filter(
+        status='running', updated_at__lt=timezone.now() - timedelta(seconds=stale_after))
+    if failed:
+        jobs = jobs | EdxLoginJob.objects.filter(status='failed')
+    return list(jobs.order_by('id').values_list('id', flat=True))
@@ -0,0 +1,41 @@
+# Python Standard Libraries
+import logging
+
+# Installed packages (via pip)
+from django.core.management.base import BaseCommand
+
+# Internal project dependencies
+from uchileedxlogin.ph_mirror import refresh_stale_personas
+from uchileedxlogin.tasks import refresh_personas_task
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Refresh from ph the stale snapshots of the persona mirror (EdxLoginPersona).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            type=int,
+            default=None,
+            help='Refresh the snapshots older than this number of seconds (default EDXLOGIN_PH_PERSONA_REFRESH_AGE).')
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='Max number of snapshots to refresh, the oldest first.')
+        parser.add_argument(
+            '--async',
+            action='store_true',
+            dest='run_async',
+            help='Queue the refresh as a celery task instead of running it here.')
+
+    def handle(self, *args, **options):
+        if options['run_async']:
+            refresh_personas_task.delay(older_than=options['older_than'], limit=options['limit'])
+            self.stdout.write('Refresh queued.')
+            return
+        result = refresh_stale_personas(older_than=options['older_than'], limit=options['limit'])
+        self.stdout.write(
+            'Refreshed: {refreshed}, removed: {removed}, failed: {failed}'.format(**result))
@@ -0,0 +1,48 @@
+# Python Standard Libraries
+import logging
+
+# Installed packages (via pip)
+from django.core.management.base import BaseCommand
+
+# Internal project dependencies
+from uchileedxlogin.jobs import get_resumable_job_ids, resume_job
+from uchileedxlogin.tasks import resume_job_task
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Resume the interrupted (or failed) background jobs (EdxLoginJob) from their last committed chunk.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--job-id',
+            type=int,
+            action='append',
+            dest='job_ids',
+            default=None,
+            help='Resume this job, can be repeated (default every interrupted job).')
+        parser.add_argument(
+            '--stale-after',
+            type=int,
+            default=None,
+            help='Resume the jobs running without progress for this number of seconds (default EDXLOGIN_JOB_STALE_AFTER).')
+        parser.add_argument(
+            '--failed',
+            action='store_true',
+            help='Resume the failed jobs too.')
+        parser.add_argument(
+            '--async',
+            action='store_true',
+            dest='run_async',
+            help='Queue each job as a celery task instead of running it here.')
+
+    def handle(self, *args, **options):
+        job_ids = options['job_ids'] or get_resumable_job_ids(
+            stale_after=options['stale_after'], failed=options['failed'])
+        for job_id in job_ids:
+            if options['run_async']:
+                resume_job_task.delay(job_id)
+            else:
+                resume_job(job_id)
+        self.stdout.write('Resumed jobs: {}'.format(', '.join(str(job_id) for job_id in job_ids) or '-'))
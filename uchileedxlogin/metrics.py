@@ -0,0 +1,162 @@
+# Python Standard Libraries
+import logging
+import socket
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+
+# Installed packages (via pip)
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+METRICS_DEFAULT_PREFIX = 'uchileedxlogin'
+METRICS_DEFAULT_STATSD_HOST = '127.0.0.1'
+METRICS_DEFAULT_STATSD_PORT = 8125
+
+
+class MetricsBackend(object):
+    """
+    Backend that discards every metric, used when EDXLOGIN_METRICS_BACKEND is not set.
+    """
+    def timing(self, name, milliseconds):
+        pass
+
+    def increment(self, name, value=1):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+
+class LoggingMetricsBackend(MetricsBackend):
+    """
+    Write every metric to the log.
+    """
+    def timing(self, name, milliseconds):
+        logger.info("metric timing {}: {:.1f} ms".format(name, milliseconds))
+
+    def increment(self, name, value=1):
+        logger.info("metric counter {}: +{}".format(name, value))
+
+    def gauge(self, name, value):
+        logger.info("metric gauge {}: {}".format(name, value))
+
+
+class StatsdMetricsBackend(MetricsBackend):
+    """
+    Send every metric to a statsd compatible server over UDP, at EDXLOGIN_METRICS_STATSD_HOST
+    and EDXLOGIN_METRICS_STATSD_PORT. Sending never raises, metrics are lost if the server is down.
+    """
+    def __init__(self):
+        self.address = (
+            getattr(settings, 'EDXLOGIN_METRICS_STATSD_HOST', METRICS_DEFAULT_STATSD_HOST),
+            getattr(settings, 'EDXLOGIN_METRICS_STATSD_PORT', METRICS_DEFAULT_STATSD_PORT))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, line):
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except Exception as e:
+            logger.debug("Failed to send metric {}: {}".format(line, e))
+
+    def timing(self, name, milliseconds):
+        self.send('{}:{:.3f}|ms'.format(name, milliseconds))
+
+    def increment(self, name, value=1):
+        self.send('{}:{}|c'.format(name, value))
+
+    def gauge(self, name, value):
+        self.send('{}:{}|g'.format(name, value))
+
+
+class MemoryMetricsBackend(MetricsBackend):
+    """
+    Keep every metric in memory, for tests.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def timing(self, name, milliseconds):
+        with self._lock:
+            self.timings[name].append(milliseconds)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def reset(self):
+        with self._lock:
+            self.timings = defaultdict(list)
+            self.counters = Counter()
+            self.gauges = {}
+
+
+METRICS_BACKENDS = {
+    'logging': LoggingMetricsBackend,
+    'statsd': StatsdMetricsBackend,
+    'memory': MemoryMetricsBackend,
+}
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Return the backend selected in EDXLOGIN_METRICS_BACKEND ('logging', 'statsd' or 'memory'),
+    every call with the same setting returns the same instance.
+    """
+    name = getattr(settings, 'EDXLOGIN_METRICS_BACKEND', None)
+    if name not in _backends:
+        with _backends_lock:
+            if name not in _backends:
+                _backends[name] = METRICS_BACKENDS.get(name, MetricsBackend)()
+    return _backends[name]
+
+
+def metric_name(name):
+    return '{}.{}'.format(getattr(settings, 'EDXLOGIN_METRICS_PREFIX', METRICS_DEFAULT_PREFIX), name)
+
+
+def timing(name, milliseconds):
+    get_backend().timing(metric_name(name), milliseconds)
+
+
+def increment(name, value=1):
+    get_backend().increment(metric_name(name), value)
+
+
+def gauge(name, value):
+    get_backend().gauge(metric_name(name), value)
+
+
+class StageTimer(object):
+    """
+    Measure the stages of an operation, emitting a timing metric '<operation>.<stage>' for each
+    one, and keep their durations to build a Server-Timing header.
+    """
+    def __init__(self, operation):
+        self.operation = operation
+        self.durations = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            milliseconds = (time.perf_counter() - start) * 1000
+            self.durations[name] = self.durations.get(name, 0) + milliseconds
+            timing('{}.{}'.format(self.operation, name), milliseconds)
+
+    def server_timing(self):
+        """
+        Return the value of a Server-Timing header with the duration of every stage.
+        """
+        return ', '.join('{};dur={:.1f}'.format(name, milliseconds) for name, milliseconds in self.durations.items())
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uchileedxlogin', '0009_edxloginuser_have_sso'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EdxLoginPersona',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run', models.CharField(max_length=20, unique=True)),
+                ('username', models.CharField(blank=True, db_index=True, max_length=50, null=True)),
+                ('nombres', models.CharField(blank=True, max_length=255)),
+                ('apellido_paterno', models.CharField(blank=True, max_length=255)),
+                ('apellido_materno', models.CharField(blank=True, max_length=255)),
+                ('emails', models.TextField(default='[]')),
+                ('have_sso', models.BooleanField(default=False)),
+                ('fetched_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uchileedxlogin', '0010_edxloginpersona'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='edxloginuser',
+            name='ph_username',
+            field=models.CharField(blank=True, max_length=50, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='edxloginuser',
+            name='ph_username_checked_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uchileedxlogin', '0012_edxloginjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='edxloginjob',
+            name='outcomes',
+            field=models.TextField(default='[]'),
+        ),
+    ]
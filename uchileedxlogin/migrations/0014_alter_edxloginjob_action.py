@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uchileedxlogin', '0013_edxloginjob_outcomes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='edxloginjob',
+            name='action',
+            field=models.CharField(choices=[('enroll', 'enroll'), ('staff_enroll', 'staff_enroll'), ('external', 'external'), ('sync', 'sync')], max_length=20),
+        ),
+    ]
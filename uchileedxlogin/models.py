@@ -19,6 +19,9 @@ class EdxLoginUser(models.Model):
         on_delete=models.CASCADE,
         blank=False,
         null=False)
+    # Uchile (ph/cas) username of the user, saved on login so returning users are found without ph.
+    ph_username = models.CharField(max_length=50, unique=True, null=True, blank=True)
+    ph_username_checked_at = models.DateTimeField(null=True, blank=True)
 
 
 class EdxLoginUserCourseRegistration(models.Model):
@@ -29,3 +32,46 @@ class EdxLoginUserCourseRegistration(models.Model):
     course = CourseKeyField(max_length=255)
     mode = models.TextField(choices=MODE_CHOICES)
     auto_enroll = models.BooleanField(default=True)
+
+
+class EdxLoginPersona(models.Model):
+    """
+    Local snapshot of a ph persona, keyed by its doc_id (indiv_id) and its uchile username (usuario).
+    """
+    run = models.CharField(max_length=20, unique=True)
+    username = models.CharField(max_length=50, null=True, blank=True, db_index=True)
+    nombres = models.CharField(max_length=255, blank=True)
+    apellido_paterno = models.CharField(max_length=255, blank=True)
+    apellido_materno = models.CharField(max_length=255, blank=True)
+    # Json list with the emails of the persona.
+    emails = models.TextField(default='[]')
+    have_sso = models.BooleanField(default=False)
+    fetched_at = models.DateTimeField(db_index=True)
+
+
+class EdxLoginJob(models.Model):
+    """
+    Staff or external enrollment run in the background by a celery task, its progress and
+    (partial) result are polled by the staff and external views.
+    The rows are processed in chunks, each one committed together with the progress of the job,
+    so an interrupted job can be resumed from its last committed chunk.
+    """
+    ACTION_CHOICES = (("enroll", "enroll"), ("staff_enroll", "staff_enroll"), ("external", "external"), ("sync", "sync"))
+    STATUS_CHOICES = (
+        ("pending", "pending"),
+        ("running", "running"),
+        ("finished", "finished"),
+        ("failed", "failed"))
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    action = models.CharField(max_length=20, choices=ACTION_CHOICES)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending")
+    # Json with the validated data of the form, and json with the same result the view returns.
+    params = models.TextField(default='{}')
+    result = models.TextField(default='{}')
+    # Json list with the outcome of each processed row, saved with the chunk of the rows.
+    outcomes = models.TextField(default='[]')
+    total = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
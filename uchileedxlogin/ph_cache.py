@@ -0,0 +1,253 @@
+# Python Standard Libraries
+import copy
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Installed packages (via pip)
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+PH_CACHE_DEFAULT_TTL = 300
+PH_CACHE_DEFAULT_NOT_FOUND_TTL = 60
+PH_CACHE_DEFAULT_MAX_SIZE = 10000
+PH_SINGLE_FLIGHT_DEFAULT_TIMEOUT = 15
+PH_SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+
+
+class PhCache(object):
+    """
+    Read-through cache for the ph lookups.
+    Entries are kept in an in-process LRU of at most EDXLOGIN_PH_CACHE_MAX_SIZE items and,
+    if EDXLOGIN_PH_CACHE_DJANGO_ALIAS is set, in that django cache so they are shared
+    between processes. Found results live EDXLOGIN_PH_CACHE_TTL seconds and "persona not found"
+    results EDXLOGIN_PH_CACHE_NOT_FOUND_TTL seconds, a ttl of 0 disables that kind of entry.
+    """
+    # Stored value of the "persona not found" results.
+    NOT_FOUND = '__not_found__'
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.not_found_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'EDXLOGIN_PH_CACHE_TTL', PH_CACHE_DEFAULT_TTL)
+
+    @property
+    def not_found_ttl(self):
+        return getattr(settings, 'EDXLOGIN_PH_CACHE_NOT_FOUND_TTL', PH_CACHE_DEFAULT_NOT_FOUND_TTL)
+
+    @property
+    def max_size(self):
+        return getattr(settings, 'EDXLOGIN_PH_CACHE_MAX_SIZE', PH_CACHE_DEFAULT_MAX_SIZE)
+
+    @property
+    def django_cache(self):
+        alias = getattr(settings, 'EDXLOGIN_PH_CACHE_DJANGO_ALIAS', None)
+        return caches[alias] if alias else None
+
+    @staticmethod
+    def django_key(key):
+        """
+        Return a key safe to use in any django cache backend (e.g. memcached).
+        """
+        return 'uchileedxlogin.ph.{}'.format(hashlib.md5(repr(key).encode('utf-8')).hexdigest())
+
+    def get(self, key, count=True):
+        """
+        Return a tuple (found, value) with a copy of the value cached in key.
+        If count is False the lookup isn't added to the hit/miss counters.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                else:
+                    del self._entries[key]
+                    entry = None
+        if entry is None and self.django_cache is not None:
+            try:
+                entry = self.django_cache.get(self.django_key(key))
+            except Exception:
+                logger.exception("Failed to read the ph cache entry: {}".format(key))
+            if entry is not None and entry[0] > now:
+                self._store(key, entry)
+            else:
+                entry = None
+        if entry is None:
+            if count:
+                with self._lock:
+                    self.misses += 1
+            return False, None
+        if count:
+            with self._lock:
+                if entry[1] == self.NOT_FOUND:
+                    self.not_found_hits += 1
+                else:
+                    self.hits += 1
+        return True, copy.deepcopy(entry[1])
+
+    def set(self, key, value):
+        """
+        Cache the value in key, use PhCache.NOT_FOUND as value for "persona not found" results.
+        """
+        ttl = self.not_found_ttl if value == self.NOT_FOUND else self.ttl
+        if ttl <= 0:
+            return
+        entry = (time.time() + ttl, copy.deepcopy(value))
+        self._store(key, entry)
+        if self.django_cache is not None:
+            try:
+                self.django_cache.set(self.django_key(key), entry, ttl)
+            except Exception:
+                logger.exception("Failed to write the ph cache entry: {}".format(key))
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Remove the entry of key from every tier.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.django_cache is not None:
+            try:
+                self.django_cache.delete(self.django_key(key))
+            except Exception:
+                logger.exception("Failed to remove the ph cache entry: {}".format(key))
+
+    def clear(self):
+        """
+        Remove every in-process entry and reset the counters.
+        Entries of the django cache tier expire by themselves.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.not_found_hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """
+        Return the counters of the cache.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'not_found_hits': self.not_found_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries)
+            }
+
+
+class Flight(object):
+    """
+    Call in progress of a SingleFlight.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls with the same key, so callers share the call in progress
+    and its result (or exception) instead of repeating it.
+    If EDXLOGIN_PH_SINGLE_FLIGHT_DISTRIBUTED is set, a lock in the django cache
+    EDXLOGIN_PH_CACHE_DJANGO_ALIAS extends it to other processes: while another process holds the
+    lock of the key, the call waits (at most EDXLOGIN_PH_SINGLE_FLIGHT_TIMEOUT seconds) polling
+    `poll` for the result it publishes.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    @property
+    def django_cache(self):
+        alias = getattr(settings, 'EDXLOGIN_PH_CACHE_DJANGO_ALIAS', None)
+        if alias and getattr(settings, 'EDXLOGIN_PH_SINGLE_FLIGHT_DISTRIBUTED', False):
+            return caches[alias]
+        return None
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'EDXLOGIN_PH_SINGLE_FLIGHT_TIMEOUT', PH_SINGLE_FLIGHT_DEFAULT_TIMEOUT)
+
+    def do(self, key, function, poll=None):
+        """
+        Return the result of function(), sharing it with the concurrent calls with the same key.
+        poll must return a tuple (found, value) with the result published by other processes.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self._flights[key] = flight
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result)
+        try:
+            flight.result = self._call(key, function, poll)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+        return copy.deepcopy(flight.result)
+
+    def _call(self, key, function, poll):
+        """
+        Call function, unless another process is already doing it and publishes its result.
+        """
+        django_cache = self.django_cache
+        if django_cache is None or poll is None:
+            return function()
+        lock_key = '{}.lock'.format(PhCache.django_key(key))
+        deadline = time.monotonic() + self.timeout
+        while not django_cache.add(lock_key, os.getpid(), self.timeout):
+            found, value = poll()
+            if found:
+                with self._lock:
+                    self.coalesced += 1
+                return value
+            if time.monotonic() > deadline:
+                logger.warning("Timeout waiting for the ph lookup of another process, key: {}".format(key))
+                return function()
+            time.sleep(PH_SINGLE_FLIGHT_POLL_INTERVAL)
+        try:
+            return function()
+        finally:
+            django_cache.delete(lock_key)
+
+
+ph_cache = PhCache()
+ph_single_flight = SingleFlight()
@@ -0,0 +1,270 @@
+# Python Standard Libraries
+import logging
+import os
+import threading
+import time
+
+# Installed packages (via pip)
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+# Internal project dependencies
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+PH_DEFAULT_POOL_SIZE = 10
+PH_DEFAULT_CONNECT_TIMEOUT = 3
+PH_DEFAULT_READ_TIMEOUT = 10
+PH_BREAKER_DEFAULT_FAILURE_THRESHOLD = 5
+PH_BREAKER_DEFAULT_SLOW_CALL_THRESHOLD = 5
+PH_BREAKER_DEFAULT_RESET_TIMEOUT = 30
+PH_BREAKER_DEFAULT_HALF_OPEN_CALLS = 1
+
+
+class PhCircuitOpenException(Exception):
+    """
+    Raised to indicate that the ph api is failing and the request was not made.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for the requests made to the ph api.
+    After EDXLOGIN_PH_BREAKER_FAILURE_THRESHOLD consecutive failures (connection errors, timeouts,
+    5xx responses or calls slower than EDXLOGIN_PH_BREAKER_SLOW_CALL_THRESHOLD seconds) the circuit
+    opens and every call fails fast with PhCircuitOpenException. After
+    EDXLOGIN_PH_BREAKER_RESET_TIMEOUT seconds it becomes half open and lets
+    EDXLOGIN_PH_BREAKER_HALF_OPEN_CALLS trial requests through: a success closes it again, a failure
+    opens it for another period.
+    Listeners added with add_listener are called with (old_state, new_state) on every transition.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._listeners = []
+        self.reset()
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'EDXLOGIN_PH_BREAKER_ENABLED', True)
+
+    @property
+    def failure_threshold(self):
+        return getattr(settings, 'EDXLOGIN_PH_BREAKER_FAILURE_THRESHOLD', PH_BREAKER_DEFAULT_FAILURE_THRESHOLD)
+
+    @property
+    def slow_call_threshold(self):
+        return getattr(settings, 'EDXLOGIN_PH_BREAKER_SLOW_CALL_THRESHOLD', PH_BREAKER_DEFAULT_SLOW_CALL_THRESHOLD)
+
+    @property
+    def reset_timeout(self):
+        return getattr(settings, 'EDXLOGIN_PH_BREAKER_RESET_TIMEOUT', PH_BREAKER_DEFAULT_RESET_TIMEOUT)
+
+    @property
+    def half_open_calls(self):
+        return getattr(settings, 'EDXLOGIN_PH_BREAKER_HALF_OPEN_CALLS', PH_BREAKER_DEFAULT_HALF_OPEN_CALLS)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _set_state(self, state):
+        """
+        Change the state, must be called holding the lock.
+        """
+        old_state = self.state
+        if old_state == state:
+            return
+        self.state = state
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            logger.warning("PH circuit breaker opened after {} consecutive failures.".format(self.consecutive_failures))
+        else:
+            logger.warning("PH circuit breaker changed from {} to {}.".format(old_state, state))
+        for listener in self._listeners:
+            try:
+                listener(old_state, state)
+            except Exception:
+                logger.exception("PH circuit breaker listener failed.")
+
+    def before_call(self):
+        """
+        Raise PhCircuitOpenException if the call must not be made.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.short_circuited += 1
+                    raise PhCircuitOpenException("PH circuit breaker is open.")
+                self._set_state(self.HALF_OPEN)
+                self.trial_calls = 0
+            if self.state == self.HALF_OPEN:
+                if self.trial_calls >= self.half_open_calls:
+                    self.short_circuited += 1
+                    raise PhCircuitOpenException("PH circuit breaker is half open, waiting for trial requests.")
+                self.trial_calls += 1
+
+    def record_success(self, duration):
+        """
+        Record a finished call, it counts as a failure if it was too slow.
+        """
+        if duration > self.slow_call_threshold:
+            logger.warning("Slow PH request: {:.3f} seconds.".format(duration))
+            self.record_failure()
+            return
+        with self._lock:
+            self.consecutive_failures = 0
+            if self.state == self.HALF_OPEN:
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state == self.OPEN:
+                    return
+                self._set_state(self.OPEN)
+
+    def reset(self):
+        """
+        Close the circuit and reset the counters.
+        """
+        with self._lock:
+            self.state = self.CLOSED
+            self.opened_at = None
+            self.trial_calls = 0
+            self.consecutive_failures = 0
+            self.failures = 0
+            self.trips = 0
+            self.short_circuited = 0
+
+    def stats(self):
+        """
+        Return the state and counters of the breaker.
+        """
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'failures': self.failures,
+                'trips': self.trips,
+                'short_circuited': self.short_circuited
+            }
+
+
+class PhClient(object):
+    """
+    HTTP client used for every request made to the ph api.
+    It keeps a pooled, keep-alive requests.Session, so consecutive queries reuse the open
+    TCP/TLS connections instead of paying a new handshake for each lookup.
+    The session is created lazily (and again after a fork), because settings are not loaded
+    when this module is imported and sockets can't be shared between worker processes.
+    Every request goes through the circuit breaker, which raises PhCircuitOpenException
+    while ph is failing.
+    """
+    def __init__(self):
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.breaker = CircuitBreaker()
+
+    @property
+    def session(self):
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._build_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    @property
+    def timeout(self):
+        """
+        Return the (connect, read) timeout used in every request.
+        """
+        return (
+            getattr(settings, 'EDXLOGIN_PH_CONNECT_TIMEOUT', PH_DEFAULT_CONNECT_TIMEOUT),
+            getattr(settings, 'EDXLOGIN_PH_READ_TIMEOUT', PH_DEFAULT_READ_TIMEOUT))
+
+    def _build_session(self):
+        """
+        Create a session with a connection pool sized by EDXLOGIN_PH_POOL_SIZE.
+        """
+        pool_size = getattr(settings, 'EDXLOGIN_PH_POOL_SIZE', PH_DEFAULT_POOL_SIZE)
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=0)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
+        })
+        return session
+
+    def get(self, params):
+        """
+        Make a GET request to the ph api with the given query params.
+        """
+        headers = {
+            'AppKey': settings.EDXLOGIN_KEY,
+            'Origin': settings.LMS_ROOT_URL
+        }
+        self.breaker.before_call()
+        start = time.monotonic()
+        try:
+            result = self.session.get(
+                settings.EDXLOGIN_USER_INFO_URL,
+                headers=headers,
+                params=params,
+                timeout=self.timeout)
+        except Exception:
+            self.breaker.record_failure()
+            metrics.increment('ph.request.error')
+            raise
+        duration = time.monotonic() - start
+        metrics.timing('ph.request', duration * 1000)
+        if result.status_code >= 500:
+            self.breaker.record_failure()
+            metrics.increment('ph.request.error')
+        else:
+            self.breaker.record_success(duration)
+        return result
+
+    def close(self):
+        """
+        Close the pooled connections, the next request will open a new session.
+        """
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._pid = None
+
+
+# Value of the ph.breaker.state gauge for each state.
+BREAKER_STATE_GAUGE = {
+    CircuitBreaker.CLOSED: 0,
+    CircuitBreaker.HALF_OPEN: 1,
+    CircuitBreaker.OPEN: 2,
+}
+
+
+def record_breaker_state(old_state, new_state):
+    metrics.gauge('ph.breaker.state', BREAKER_STATE_GAUGE[new_state])
+    if new_state == CircuitBreaker.OPEN:
+        metrics.increment('ph.breaker.trips')
+
+
+ph_client = PhClient()
+ph_client.breaker.add_listener(record_breaker_state)
@@ -0,0 +1,177 @@
+# Python Standard Libraries
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+# Installed packages (via pip)
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+# Internal project dependencies
+from .models import EdxLoginPersona
+from .ph_cache import PhCache, ph_cache
+from .ph_query import PH_DEFAULT_MAX_WORKERS, PhPersona, PhPersonaNotFoundException, query_persona
+
+logger = logging.getLogger(__name__)
+
+PH_PERSONA_DEFAULT_MAX_AGE = 86400
+PH_PERSONA_DEFAULT_REFRESH_AGE = 43200
+PH_PERSONA_FIELDS = ['username', 'nombres', 'apellido_paterno', 'apellido_materno', 'emails', 'have_sso', 'fetched_at']
+
+
+def persona_from_snapshot(snapshot):
+    """
+    Return the PhPersona stored in the EdxLoginPersona snapshot.
+    """
+    user_data = {
+        'doc_id': snapshot.run,
+        'username': snapshot.username if snapshot.have_sso else None,
+        'nombres': snapshot.nombres,
+        'apellidoPaterno': snapshot.apellido_paterno,
+        'apellidoMaterno': snapshot.apellido_materno,
+        'emails': json.loads(snapshot.emails)
+    }
+    return PhPersona(user_data, snapshot.have_sso)
+
+
+def update_snapshot(snapshot, persona, fetched_at):
+    """
+    Copy the persona to the EdxLoginPersona snapshot, without saving it.
+    """
+    user_data = persona.user_data
+    snapshot.username = user_data['username']
+    snapshot.nombres = user_data['nombres'] or ''
+    snapshot.apellido_paterno = user_data['apellidoPaterno'] or ''
+    snapshot.apellido_materno = user_data['apellidoMaterno'] or ''
+    snapshot.emails = json.dumps(user_data['emails'])
+    snapshot.have_sso = persona.have_sso
+    snapshot.fetched_at = fetched_at
+    return snapshot
+
+
+def fresh_snapshots():
+    """
+    Return the snapshots younger than EDXLOGIN_PH_PERSONA_MAX_AGE seconds.
+    """
+    max_age = getattr(settings, 'EDXLOGIN_PH_PERSONA_MAX_AGE', PH_PERSONA_DEFAULT_MAX_AGE)
+    return EdxLoginPersona.objects.filter(fetched_at__gte=timezone.now() - timedelta(seconds=max_age))
+
+
+def get_local_persona(query_value, query_type):
+    """
+    Get the persona related to query_value, depending on query_type (see ph_query.get_user_data),
+    from its snapshot, if it's younger than EDXLOGIN_PH_PERSONA_MAX_AGE seconds.
+    Returns None if there isn't a fresh snapshot.
+    """
+    snapshots = fresh_snapshots()
+    try:
+        if query_type == 'indiv_id':
+            snapshot = snapshots.filter(run=query_value).first()
+        else:
+            # A username may be left in an old snapshot until it's refreshed, the newest one wins.
+            snapshot = snapshots.filter(username=query_value).order_by('-fetched_at').first()
+    except Exception:
+        logger.exception("Failed to read the persona snapshot of query_value: {}".format(query_value))
+        return None
+    if snapshot is None:
+        return None
+    return persona_from_snapshot(snapshot)
+
+
+def get_local_personas(doc_ids):
+    """
+    Get the personas of doc_ids from their fresh snapshots (see get_local_persona) with one query.
+    Returns a dict with the persona of each doc_id that has a fresh snapshot.
+    """
+    return {snapshot.run: persona_from_snapshot(snapshot) for snapshot in fresh_snapshots().filter(run__in=doc_ids)}
+
+
+def store_personas(personas):
+    """
+    Create or update the snapshots of the personas, with one query to read the existing
+    snapshots and bulk queries to write them.
+    """
+    if not personas:
+        return
+    try:
+        fetched_at = timezone.now()
+        personas = {persona.user_data['doc_id']: persona for persona in personas}
+        snapshots = EdxLoginPersona.objects.in_bulk(list(personas), field_name='run')
+        updated = [update_snapshot(snapshot, personas[run], fetched_at) for run, snapshot in snapshots.items()]
+        created = [
+            update_snapshot(EdxLoginPersona(run=run), persona, fetched_at)
+            for run, persona in personas.items() if run not in snapshots]
+        # In its own savepoint, so a failed write doesn't break the transaction of the caller.
+        with transaction.atomic():
+            if updated:
+                EdxLoginPersona.objects.bulk_update(updated, PH_PERSONA_FIELDS, batch_size=500)
+            if created:
+                EdxLoginPersona.objects.bulk_create(created, batch_size=500, ignore_conflicts=True)
+    except Exception:
+        logger.exception("Failed to store the persona snapshots of doc_ids: {}".format(list(personas)))
+
+
+def remove_personas(doc_ids):
+    """
+    Remove the snapshots of the doc_ids that ph doesn't have anymore.
+    """
+    if not doc_ids:
+        return
+    try:
+        with transaction.atomic():
+            EdxLoginPersona.objects.filter(run__in=doc_ids).delete()
+    except Exception:
+        logger.exception("Failed to remove the persona snapshots of doc_ids: {}".format(doc_ids))
+
+
+def refresh_stale_personas(older_than=None, limit=None, max_workers=None):
+    """
+    Fetch again from ph the snapshots older than `older_than` seconds
+    (EDXLOGIN_PH_PERSONA_REFRESH_AGE by default), the oldest first and at most `limit` of them.
+    The queries are made concurrently, the snapshots are updated with a single bulk query and
+    the ones of personas that ph doesn't have anymore are deleted.
+    Returns a dict with the number of refreshed, removed and failed snapshots.
+    """
+    if older_than is None:
+        older_than = getattr(settings, 'EDXLOGIN_PH_PERSONA_REFRESH_AGE', PH_PERSONA_DEFAULT_REFRESH_AGE)
+    if max_workers is None:
+        max_workers = getattr(settings, 'EDXLOGIN_PH_MAX_WORKERS', PH_DEFAULT_MAX_WORKERS)
+    stale = EdxLoginPersona.objects.filter(
+        fetched_at__lt=timezone.now() - timedelta(seconds=older_than)).order_by('fetched_at')
+    snapshots = list(stale[:limit])
+    if not snapshots:
+        return {'refreshed': 0, 'removed': 0, 'failed': 0}
+
+    def lookup(snapshot):
+        try:
+            return snapshot, query_persona(snapshot.run, 'indiv_id'), None
+        except PhPersonaNotFoundException:
+            return snapshot, None, None
+        except Exception as e:
+            return snapshot, None, e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(snapshots)))) as executor:
+        results = list(executor.map(lookup, snapshots))
+
+    fetched_at = timezone.now()
+    refreshed = []
+    removed = []
+    failed = 0
+    for snapshot, persona, error in results:
+        key = ('indiv_id', snapshot.run)
+        if error is not None:
+            logger.warning("Can't refresh the persona snapshot of doc_id: {}, error: {}".format(snapshot.run, error))
+            failed += 1
+        elif persona is None:
+            removed.append(snapshot.run)
+            ph_cache.set(key, PhCache.NOT_FOUND)
+        else:
+            refreshed.append(update_snapshot(snapshot, persona, fetched_at))
+            ph_cache.set(key, persona)
+    if refreshed:
+        EdxLoginPersona.objects.bulk_update(refreshed, PH_PERSONA_FIELDS, batch_size=500)
+    if removed:
+        EdxLoginPersona.objects.filter(run__in=removed).delete()
+    return {'refreshed': len(refreshed), 'removed': len(removed), 'failed': failed}
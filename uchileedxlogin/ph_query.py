@@ -1,46 +1,66 @@
 # Python Standard Libraries
 import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 # Installed packages (via pip)
 import requests
 from django.conf import settings
 
+# Internal project dependencies
+from .ph_cache import PhCache, ph_cache, ph_single_flight
+from .ph_client import PhCircuitOpenException, ph_client
+
 logger = logging.getLogger(__name__)
 
+PH_DEFAULT_MAX_WORKERS = 8
+
+# Result of a lookup made by get_user_data_many, only one of data/error is set.
+PhResult = namedtuple('PhResult', ['value', 'data', 'error'])
+# Persona returned by the ph api, user_data['username'] is None if the persona doesn't have sso.
+PhPersona = namedtuple('PhPersona', ['user_data', 'have_sso'])
+class PhApiException(Exception):
+    """
+    Raised to indicate that the data related to the value provided to ph failed to get retrieved.
+    """
+
+
+class PhPersonaNotFoundException(Exception):
+    """
+    Raised to indicate that ph doesn't have a persona with a uchile account for the queried value.
+    """
+
+
+# Errors raised when ph can't be reached or answers with an error, they don't say anything about
+# the queried persona.
+PH_UNAVAILABLE_EXCEPTIONS = (PhCircuitOpenException, PhApiException, requests.RequestException)
+
 
 # Functions that make queries to ph.
 def check_doc_id_have_sso(doc_id):
     """
     Check if the doc_id have sso.
+    Raises PH_UNAVAILABLE_EXCEPTIONS while ph can't be reached, so a doc_id with sso isn't taken
+    as one without it.
     """
-    headers = {
-        'AppKey': settings.EDXLOGIN_KEY,
-        'Origin': settings.LMS_ROOT_URL
-    }
-    params = (('indiv_id', doc_id),)
-    base_url = settings.EDXLOGIN_USER_INFO_URL
-    result = requests.get(base_url, headers=headers, params=params)
-    if result.status_code != 200:
-        logger.error(
-            "{} {}".format(
-                result.request,
-                result.request.headers))
-        return False
-    data = result.json()
-    if data["data"]["getRowsPersona"] is None:
-        return False
-    if data['data']['getRowsPersona']['status_code'] != 200:
-        logger.error(
-            "Api Error: {}, body: {}, doc_id: {}".format(
-                data['data']['getRowsPersona']['status_code'],
-                result.text,
-                doc_id))
-        return False
-    if len(data["data"]["getRowsPersona"]["persona"]) == 0:
-        return False
-    if len(data["data"]["getRowsPersona"]["persona"][0]['pasaporte']) == 0:
+    try:
+        persona = get_persona(doc_id, 'indiv_id')
+    except PH_UNAVAILABLE_EXCEPTIONS:
+        raise
+    except Exception as e:
+        persona = e
+    return persona_have_sso(doc_id, persona)
+
+
+def persona_have_sso(doc_id, persona):
+    """
+    Return whether the persona of doc_id have sso, persona is the PhPersona or the exception
+    raised getting it.
+    """
+    if isinstance(persona, Exception):
+        logger.warning("Can't check if doc_id: {} have sso, error: {}".format(doc_id, persona))
         return False
-    return True
+    return persona.have_sso
 
 
 def get_user_data(query_value, query_type):
@@ -51,14 +71,99 @@ def get_user_data(query_value, query_type):
     from the ph api.
     For query_type: 'usuario' and value_type: nombre_apellido, gets the data related to that user
     username from the ph api.
+    Raises PhPersonaNotFoundException if there is no persona or it doesn't have a uchile account.
+    """
+    return persona_user_data(query_value, get_persona(query_value, query_type))
+
+
+def persona_user_data(query_value, persona):
+    """
+    Return the user data of the persona of query_value, raising PhPersonaNotFoundException if it
+    doesn't have a uchile account.
+    """
+    if not persona.have_sso:
+        logger.error("Empty pasaporte field for doc_id {}".format(query_value))
+        raise PhPersonaNotFoundException(
+            "Empty pasaporte field for doc_id {}".format(query_value))
+    return persona.user_data
+
+
+def get_persona(query_value, query_type, fetched=None):
+    """
+    Get the persona related to query_value, depending on query_type (see get_user_data), returning
+    a PhPersona with its user data and whether it has sso.
+    The results are cached in ph_cache, so get_user_data and check_doc_id_have_sso share a single
+    request to the ph api, and concurrent lookups of the same value share the request in progress.
+    "Persona not found" results are cached too, and raise PhPersonaNotFoundException.
+    If EDXLOGIN_PH_LOCAL_FIRST is set, fresh snapshots of the persona mirror are served before
+    going to ph.
+    If fetched is given, the persona mirror isn't used: a persona fetched from ph is put in the
+    fetched dict, by query_value, to be stored later (see get_personas_many).
+    """
+    key = (query_type, query_value)
+    found, persona = ph_cache.get(key)
+    if not found and fetched is None and getattr(settings, 'EDXLOGIN_PH_LOCAL_FIRST', False):
+        # Imported here because ph_mirror depends on the models and this module on the settings only.
+        from .ph_mirror import get_local_persona
+        persona = get_local_persona(query_value, query_type)
+        found = persona is not None
+        if found:
+            ph_cache.set(key, persona)
+    if not found:
+        persona = ph_single_flight.do(
+            key,
+            lambda: fetch_persona(query_value, query_type, fetched),
+            poll=lambda: ph_cache.get(key, count=False))
+    if persona == PhCache.NOT_FOUND:
+        raise PhPersonaNotFoundException(
+            "Persona not found for query_value: {}".format(query_value))
+    return persona
+
+
+def fetch_persona(query_value, query_type, fetched=None):
+    """
+    Get the persona related to query_value from the ph api and cache it, storing it in the
+    persona mirror if it's enabled, or in the fetched dict if it's given (see get_persona).
+    Returns PhCache.NOT_FOUND if ph doesn't have it.
+    """
+    try:
+        persona = query_persona(query_value, query_type)
+    except PhPersonaNotFoundException:
+        persona = PhCache.NOT_FOUND
+    ph_cache.set((query_type, query_value), persona)
+    if fetched is None:
+        mirror_personas({query_value: persona}, query_type)
+    else:
+        fetched[query_value] = persona
+    return persona
+
+
+def persona_mirror_enabled():
+    """
+    Return whether the personas fetched from ph are stored in the persona mirror.
+    """
+    return getattr(settings, 'EDXLOGIN_PH_PERSONA_MIRROR', False) or getattr(settings, 'EDXLOGIN_PH_LOCAL_FIRST', False)
+
+
+def mirror_personas(personas, query_type):
+    """
+    Store the personas fetched from ph, a dict by query value, in the persona mirror if it's
+    enabled, removing the snapshots of the doc_ids that ph doesn't have.
+    """
+    if not persona_mirror_enabled():
+        return
+    from .ph_mirror import remove_personas, store_personas
+    store_personas([persona for persona in personas.values() if persona != PhCache.NOT_FOUND])
+    if query_type == 'indiv_id':
+        remove_personas([value for value, persona in personas.items() if persona == PhCache.NOT_FOUND])
+
+
+def query_persona(query_value, query_type):
+    """
+    Get the persona related to query_value, depending on query_type, directly from the ph api.
     """
-    headers = {
-        'AppKey': settings.EDXLOGIN_KEY,
-        'Origin': settings.LMS_ROOT_URL
-    }
     params = ((query_type, '"{}"'.format(query_value)),)
-    base_url = settings.EDXLOGIN_USER_INFO_URL
-    result = requests.get(base_url, headers=headers, params=params)
+    result = ph_client.get(params)
 
     if result.status_code != 200:
         logger.error(
@@ -66,6 +171,10 @@ def get_user_data(query_value, query_type):
                 result.status_code,
                 result.text,
                 query_value))
+        if result.status_code >= 500:
+            raise PhApiException(
+                "API request failed, HTTP status: {}, query_value: {}".format(
+                    result.status_code, query_value))
         raise Exception(
             "API request failed, HTTP status: {}, query_value: {}".format(
                 result.status_code, query_value))
@@ -77,7 +186,7 @@ def get_user_data(query_value, query_type):
                 result.status_code,
                 result.text,
                 query_value))
-        raise Exception(
+        raise PhApiException(
             "Missing 'getRowsPersona' in API response, status_code: {}, query_value: {}".format(
                 result.status_code, query_value))
     if data['data']['getRowsPersona']['status_code'] != 200:
@@ -86,7 +195,7 @@ def get_user_data(query_value, query_type):
                 data['data']['getRowsPersona']['status_code'],
                 result.text,
                 query_value))
-        raise Exception(
+        raise PhApiException(
             "PH API returned error status {}, expected 200, query_value: {}".format(
                 result.status_code, query_value))
     if len(data["data"]["getRowsPersona"]["persona"]) == 0:
@@ -94,24 +203,97 @@ def get_user_data(query_value, query_type):
             "Empty persona list for query_value: {}, body: {}".format(
                 query_value,
                 result.text))
-        raise Exception(
+        raise PhPersonaNotFoundException(
             "Empty persona list for query_value: {}, body: {}".format(
                 query_value, result.text))
-    if len(data["data"]["getRowsPersona"]["persona"][0]['pasaporte']) == 0:
-        logger.error(
-            "Empty pasaporte field for doc_id {}, body: {}".format(
-                query_value,
-                result.text))
-        raise Exception(
-            "Empty pasaporte field for doc_id {}, body: {}".format(
-                query_value, result.text))
     getRowsPersona = data["data"]["getRowsPersona"]['persona'][0]
+    have_sso = len(getRowsPersona['pasaporte']) > 0
     user_data = {
         'doc_id': getRowsPersona['indiv_id'],
-        'username': getRowsPersona['pasaporte'][0]['usuario'],
+        'username': getRowsPersona['pasaporte'][0]['usuario'] if have_sso else None,
         'nombres': getRowsPersona['nombres'],
         'apellidoPaterno': getRowsPersona['paterno'],
         'apellidoMaterno': getRowsPersona['materno'],
         'emails': [email["email"] for email in getRowsPersona["email"]]
     }
-    return user_data
+    return PhPersona(user_data, have_sso)
+
+
+def run_lookups(values, lookup, max_workers=None):
+    """
+    Call lookup once for every distinct value of values, concurrently on a pool of at most
+    max_workers threads (EDXLOGIN_PH_MAX_WORKERS by default).
+    Returns a dict with the result of each value.
+    """
+    if max_workers is None:
+        max_workers = getattr(settings, 'EDXLOGIN_PH_MAX_WORKERS', PH_DEFAULT_MAX_WORKERS)
+    unique_values = list(dict.fromkeys(values))
+    if max_workers <= 1 or len(unique_values) <= 1:
+        results = [lookup(value) for value in unique_values]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(unique_values))) as executor:
+            results = list(executor.map(lookup, unique_values))
+    return dict(zip(unique_values, results))
+
+
+def get_personas_many(values, query_type, max_workers=None):
+    """
+    Get the persona of every distinct value of values (see get_persona), concurrently (see
+    run_lookups). Returns a dict with the PhPersona of each value or the exception raised
+    getting it, so one failed lookup doesn't stop the others.
+    The persona mirror is used in the calling thread only, so the worker threads don't open
+    database connections or write outside the transaction of the caller: the fresh snapshots are
+    read with one query before the lookups and the personas fetched from ph are stored after them.
+    """
+    unique_values = list(dict.fromkeys(values))
+    if query_type == 'indiv_id' and getattr(settings, 'EDXLOGIN_PH_LOCAL_FIRST', False):
+        from .ph_mirror import get_local_personas
+        missing = [value for value in unique_values if not ph_cache.get((query_type, value), count=False)[0]]
+        for value, persona in get_local_personas(missing).items():
+            ph_cache.set((query_type, value), persona)
+    fetched = {}
+
+    def lookup(value):
+        try:
+            return get_persona(value, query_type, fetched)
+        except Exception as e:
+            return e
+
+    personas = run_lookups(unique_values, lookup, max_workers)
+    mirror_personas(fetched, query_type)
+    return personas
+
+
+def get_user_data_many(values, query_type, max_workers=None):
+    """
+    Get the user data of every value in values, depending on query_type (see get_user_data).
+    The queries are made concurrently (see get_personas_many), and repeated values are queried only once.
+    Returns a list of PhResult in the same order as values, with the user data of the
+    value or the exception raised when getting it, so one failed lookup doesn't stop the others.
+    """
+    results_by_value = {}
+    for value, persona in get_personas_many(values, query_type, max_workers).items():
+        if isinstance(persona, Exception):
+            results_by_value[value] = PhResult(value, None, persona)
+            continue
+        try:
+            results_by_value[value] = PhResult(value, persona_user_data(value, persona), None)
+        except PhPersonaNotFoundException as e:
+            results_by_value[value] = PhResult(value, None, e)
+    return [results_by_value[value] for value in values]
+
+
+def check_doc_ids_have_sso(doc_ids, max_workers=None):
+    """
+    Check concurrently if each doc_id of doc_ids have sso (see check_doc_id_have_sso and
+    get_personas_many), returning a dict by doc_id.
+    The doc_ids that can't be checked because ph is unavailable are None.
+    """
+    have_sso = {}
+    for doc_id, persona in get_personas_many(doc_ids, 'indiv_id', max_workers).items():
+        if isinstance(persona, PH_UNAVAILABLE_EXCEPTIONS):
+            logger.warning("Can't check if doc_id: {} have sso, ph is unavailable: {}".format(doc_id, persona))
+            have_sso[doc_id] = None
+        else:
+            have_sso[doc_id] = persona_have_sso(doc_id, persona)
+    return have_sso
@@ -2,7 +2,7 @@
 import logging
 
 # Internal project dependencies
-from ..ph_query import get_user_data
+from ..ph_query import PhApiException, get_user_data
 from uchileedxlogin.models import EdxLoginUser
 from uchileedxlogin.users import create_edxlogin_user_by_data
 from uchileedxlogin.utils import validate_all_doc_id_types
@@ -10,11 +10,6 @@ from uchileedxlogin.utils import validate_all_doc_id_types
 logger = logging.getLogger(__name__)
 
 # Interface exceptions.
-class PhApiException(Exception):
-    """
-    Raised to indicate that the data related to the value provided to ph failed to get retrieved.
-    """
-
 class EmailException(Exception):
     """
     Raised to indicate that none of the mails associated with the doc_id are valid to create a
@@ -49,23 +44,45 @@ def get_user_by_doc_id(doc_id):
     except EdxLoginUser.DoesNotExist:
         return None
 
-def edxloginuser_factory(value, value_type):
+def get_users_by_doc_ids(doc_ids):
+    """
+    Get the edxloginusers (with their user) of doc_ids in one query, as a dict by doc_id.
+    doc_ids without an edxloginuser are left out.
+    """
+    edxlogin_users = EdxLoginUser.objects.filter(run__in=doc_ids).select_related('user')
+    return {edxlogin_user.run: edxlogin_user for edxlogin_user in edxlogin_users}
+
+def get_user_by_ph_username(ph_username):
+    """
+    Get the user linked to the uchile username ph_username, if it doesn't exists, return None.
+    """
+    try:
+        return EdxLoginUser.objects.select_related('user').get(ph_username=ph_username)
+    except EdxLoginUser.DoesNotExist:
+        return None
+
+def edxloginuser_factory(value, value_type, user_data=None, username_allocator=None, email_user=None):
     """
     Create an edxloginuser using value. Verifies if the value is valid.
     Tries to match the value with an already existing edx user, if it
     can't, creates a new edx user.
     The only value_type supported is doc_id.
+    If the ph data of the value was already retrieved, it can be given in user_data
+    to avoid querying ph again, the username can be taken from a UsernameAllocator and the
+    user of its emails given in email_user (see create_edxlogin_user_by_data).
     """
     if value_type == "doc_id":
         is_doc_id_valid = validate_all_doc_id_types(value)
         if not is_doc_id_valid:
             raise ValueError("doc_id: {value} doesn't match uchileedxlogin format.")
-        try:
-            user_data = get_user_data(value, 'indiv_id')
-        except Exception as e:
-            logger.warning(f"Factory failed for doc_id: {value}, with error: {e}")
-            raise PhApiException()
-        edxlogin_user = create_edxlogin_user_by_data(user_data)
+        if user_data is None:
+            try:
+                user_data = get_user_data(value, 'indiv_id')
+            except Exception as e:
+                logger.warning(f"Factory failed for doc_id: {value}, with error: {e}")
+                raise PhApiException()
+        edxlogin_user = create_edxlogin_user_by_data(
+            user_data, username_allocator=username_allocator, email_user=email_user)
         if not edxlogin_user:
             logger.warning(f"User can't be created because none of the mails are valid.")
             raise EmailException("User can't be created because none of the mails are valid.")
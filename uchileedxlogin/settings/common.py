@@ -5,3 +5,63 @@ def plugin_settings(settings):
     settings.EDXLOGIN_REQUEST_URL = edxlogin_host + ':9513/login'
     settings.EDXLOGIN_KEY = ''
     settings.EDXLOGIN_USER_INFO_URL = ''
+
+    # Connection pool and timeouts (connect, read) used in the requests to the ph api.
+    settings.EDXLOGIN_PH_POOL_SIZE = 10
+    settings.EDXLOGIN_PH_CONNECT_TIMEOUT = 3
+    settings.EDXLOGIN_PH_READ_TIMEOUT = 10
+    # Max number of concurrent requests made by ph_query.get_user_data_many.
+    settings.EDXLOGIN_PH_MAX_WORKERS = 8
+    # Cache of the ph lookups: ttl in seconds of the found and "persona not found" results
+    # (0 disables them), max size of the in-process LRU and optional django cache alias
+    # used as a second tier shared between processes.
+    settings.EDXLOGIN_PH_CACHE_TTL = 300
+    settings.EDXLOGIN_PH_CACHE_NOT_FOUND_TTL = 60
+    settings.EDXLOGIN_PH_CACHE_MAX_SIZE = 10000
+    settings.EDXLOGIN_PH_CACHE_DJANGO_ALIAS = None
+    # Circuit breaker of the ph api: consecutive failures (errors, 5xx or calls slower than
+    # EDXLOGIN_PH_BREAKER_SLOW_CALL_THRESHOLD seconds) to open it, seconds until a trial
+    # request is allowed and number of concurrent trial requests.
+    settings.EDXLOGIN_PH_BREAKER_ENABLED = True
+    settings.EDXLOGIN_PH_BREAKER_FAILURE_THRESHOLD = 5
+    settings.EDXLOGIN_PH_BREAKER_SLOW_CALL_THRESHOLD = 5
+    settings.EDXLOGIN_PH_BREAKER_RESET_TIMEOUT = 30
+    settings.EDXLOGIN_PH_BREAKER_HALF_OPEN_CALLS = 1
+    # Share the ph lookups in progress between processes, using a lock in the django cache
+    # EDXLOGIN_PH_CACHE_DJANGO_ALIAS (max seconds to wait for another process).
+    settings.EDXLOGIN_PH_SINGLE_FLIGHT_DISTRIBUTED = False
+    settings.EDXLOGIN_PH_SINGLE_FLIGHT_TIMEOUT = 15
+    # Local mirror of the ph personas (EdxLoginPersona): store every persona fetched from ph,
+    # serve the snapshots younger than EDXLOGIN_PH_PERSONA_MAX_AGE seconds before going to ph
+    # (local first) and refresh the snapshots older than EDXLOGIN_PH_PERSONA_REFRESH_AGE seconds
+    # with the edxlogin_refresh_personas command.
+    settings.EDXLOGIN_PH_PERSONA_MIRROR = False
+    settings.EDXLOGIN_PH_LOCAL_FIRST = False
+    settings.EDXLOGIN_PH_PERSONA_MAX_AGE = 86400
+    settings.EDXLOGIN_PH_PERSONA_REFRESH_AGE = 43200
+    # Log in returning users with the uchile username saved in EdxLoginUser.ph_username,
+    # without querying ph, queuing a check of the username in the background when it's
+    # older than EDXLOGIN_PH_USERNAME_MAX_AGE seconds.
+    settings.EDXLOGIN_FAST_LOGIN = True
+    settings.EDXLOGIN_PH_USERNAME_MAX_AGE = 86400
+    # Enroll the users in their pending courses with a celery task after the login, instead of
+    # during the login request.
+    settings.EDXLOGIN_ASYNC_PENDING_ENROLLMENTS = False
+    # Metrics of the login stages and the ph requests: backend ('logging', 'statsd', 'memory'
+    # or None to disable them), prefix of the metric names and statsd server. If
+    # EDXLOGIN_SERVER_TIMING is set, the callback returns the stage durations in a
+    # Server-Timing header.
+    settings.EDXLOGIN_METRICS_BACKEND = None
+    settings.EDXLOGIN_METRICS_PREFIX = 'uchileedxlogin'
+    settings.EDXLOGIN_METRICS_STATSD_HOST = '127.0.0.1'
+    settings.EDXLOGIN_METRICS_STATSD_PORT = 8125
+    settings.EDXLOGIN_SERVER_TIMING = False
+    # Staff and external requests with more than EDXLOGIN_JOB_MIN_ROWS rows (None to disable it)
+    # run as a celery job, processed in chunks of EDXLOGIN_JOB_CHUNK_SIZE rows, up to
+    # EDXLOGIN_BULK_MAX_ROWS rows per request.
+    settings.EDXLOGIN_JOB_MIN_ROWS = 50
+    settings.EDXLOGIN_JOB_CHUNK_SIZE = 100
+    settings.EDXLOGIN_BULK_MAX_ROWS = 5000
+    # Jobs still running without progress for EDXLOGIN_JOB_STALE_AFTER seconds are resumed by
+    # the edxlogin_resume_jobs command.
+    settings.EDXLOGIN_JOB_STALE_AFTER = 1800
@@ -31,19 +31,70 @@ function enrollrun(e){
       enroll: auto,
       force: true
   };
+  if (e.dataset.action == "sync") {
+      // A sync unenrolls every rut not in the list, it's simulated and confirmed first.
+      sendData.action = "dry_run_sync";
+      return post_staff(e.dataset.endpoint, sendData, function(data) {
+          display_response(data);
+          if (!("doc_id_sync" in data) || !confirm_sync(data)) {
+              return false;
+          }
+          sendData.action = "sync";
+          sendData.confirm = true;
+          return post_staff(e.dataset.endpoint, sendData, display_response);
+      });
+  }
+  return post_staff(e.dataset.endpoint, sendData, display_response);
+}
+post_staff = function(endpoint, sendData, display) {
   return $.ajax({
       dataType: 'json',
       type: 'POST',
-      url: e.dataset.endpoint,
+      url: endpoint,
       data: sendData,
       success: function(data) {
-          return display_response(data);
+          if ("job_id" in data) {
+              return poll_job(data);
+          }
+          return display(data);
       },
       error: statusAjaxError(function() {
           return fail_with_error("Error inesperado ha ocurrido. Actualice la página e intente nuevamente");
       })
   });        
-}
+};
+confirm_sync = function(data) {
+  var added = 0;
+  var removed = 0;
+  Object.keys(data.doc_id_sync).forEach(course_id => {
+    added = added + data.doc_id_sync[course_id].added.length;
+    removed = removed + data.doc_id_sync[course_id].removed.length;
+  });
+  return window.confirm("Se inscribirán " + added + " ruts y se desinscribirán " + removed + " ruts. ¿Desea continuar?");
+};
+poll_job = function(data) {
+  var task_response = document.getElementById("enroll-run-response");
+
+  if (data.status == "finished") {
+    return display_response(data.result);
+  }
+  if (data.status == "failed") {
+    return fail_with_error("El proceso en segundo plano falló después de procesar " + data.processed + " de " + data.total + " ruts.");
+  }
+  task_response.textContent = "Procesando en segundo plano: " + data.processed + " de " + data.total + " ruts.";
+  setTimeout(function() {
+    $.ajax({
+      dataType: 'json',
+      type: 'GET',
+      url: data.status_url,
+      success: poll_job,
+      error: function() {
+        setTimeout(function() { poll_job(data); }, 5000);
+      }
+    });
+  }, 2000);
+  return true;
+};
 clear_input = function() {
   var doc_ids = document.getElementById("student-run");//value
   var role = document.getElementById("role-run"); //value
@@ -68,6 +119,9 @@ validate_error = function(data) {
   if ("no_doc_id" in data){
     aux_error = aux_error + "Falta agregar rut.</br>";
   }
+  if ("limit_data" in data){
+    aux_error = aux_error + "Se superó el límite de ruts que se pueden inscribir/desinscribir a la vez.</br>";
+  }
   if ("curso2" in data){
     aux_error = aux_error + "No se ha ingresado el id del curso, actualice la página e intentelo nuevamente</br>";
   }
@@ -98,6 +152,9 @@ validate_error = function(data) {
   if ("error_mode" in data){
     aux_error = aux_error + "El rol del usuario esta incorrecto, actualice la página</br>";
   }
+  if ("error_sync_confirm" in data){
+    aux_error = aux_error + "La sincronización debe ser confirmada, actualice la página</br>";
+  }
   if ("error_action" in data){
     aux_error = aux_error + "La acción que quiere realizar es incorrecta, actualice la página</br>";
   }
@@ -110,6 +167,15 @@ validate_error = function(data) {
 validate_success = function(data) {
   var aux_success = "";
   
+  if ("dry_run" in data){
+    aux_success = aux_success + "<b>Simulación, no se ha inscrito/desinscrito ningún rut:</b></br></br>";
+  }
+  if ("doc_id_unknown" in data && data.doc_id_unknown.length > 0){
+    aux_success = aux_success + "No se pudieron obtener los datos de los siguientes ruts, al inscribirlos se buscará su cuenta institucional: " + data.doc_id_unknown.join(" - ") + "</br></br>";
+  }
+  if ("doc_id_enrolled" in data && data.doc_id_enrolled.length > 0){
+    aux_success = aux_success + "Los siguientes ruts ya están inscritos: " + data.doc_id_enrolled.join(" - ") + "</br></br>";
+  }
   if ("saved" in data && data.saved == "saved"){          
     if (data.doc_id_saved['doc_id_saved_pending'] != ""){
       aux_success = aux_success + "No se ha encontrado ninguna cuenta institucional de los siguientes ruts: " + data.doc_id_saved['doc_id_saved_pending'] + "</br>";
@@ -119,7 +185,11 @@ validate_success = function(data) {
       var doc_id_saved_enroll = data.doc_id_saved['doc_id_saved_enroll'].split("/")
       var doc_id_saved_force = data.doc_id_saved['doc_id_saved_force'].split("/")
 
-      aux_success = aux_success + "<b>Usuarios inscritos correctamente: </b></br>";
+      if ("dry_run" in data){
+        aux_success = aux_success + "<b>Usuarios que se inscribirán: </b></br>";
+      } else {
+        aux_success = aux_success + "<b>Usuarios inscritos correctamente: </b></br>";
+      }
       doc_id_saved_enroll.forEach(doc_id => {
         aux_success = aux_success + doc_id + "</br>";
       });
@@ -127,11 +197,34 @@ validate_success = function(data) {
         aux_success = aux_success + doc_id + "</br>";
       });
     }
-    clear_input();
+    if (!("dry_run" in data)){
+      clear_input();
+    }
+  }
+  if ("saved" in data && data.saved == "sync"){
+    var dry_run = "dry_run" in data;
+    aux_success = aux_success + (dry_run ? "<b>Cursos que se sincronizarán:</b></br>" : "<b>Cursos sincronizados:</b></br>");
+    Object.keys(data.doc_id_sync).forEach(course_id => {
+      var sync = data.doc_id_sync[course_id];
+      aux_success = aux_success + course_id + "</br>";
+      aux_success = aux_success + (dry_run ? "Ruts que se agregarán: " : "Ruts agregados: ") + (sync.added.length > 0 ? sync.added.join(" - ") : "ninguno") + "</br>";
+      aux_success = aux_success + (dry_run ? "Ruts que se desinscribirán: " : "Ruts desinscritos: ") + (sync.removed.length > 0 ? sync.removed.join(" - ") : "ninguno") + "</br></br>";
+    });
+    if (data.doc_id_saved['doc_id_saved_pending'] != ""){
+      aux_success = aux_success + "No se ha encontrado ninguna cuenta institucional de los siguientes ruts: " + data.doc_id_saved['doc_id_saved_pending'] + "</br>";
+      aux_success = aux_success + "Al momento de registrarse, automaticamente se inscribirán en el curso.</br>";
+    }
+    if (!dry_run){
+      clear_input();
+    }
   }
   if ("saved" in data && data.saved == "unenroll"){
     if (data.doc_id_unenroll.length > 0 ){
-      aux_success = aux_success + "<b>Ruts desinscrito correctamente: </b></br>";
+      if ("dry_run" in data){
+        aux_success = aux_success + "<b>Ruts que se desinscribirán: </b></br>";
+      } else {
+        aux_success = aux_success + "<b>Ruts desinscrito correctamente: </b></br>";
+      }
       data.doc_id_unenroll.forEach(doc_id => {
           aux_success = aux_success + doc_id + "</br>";
       });
@@ -143,7 +236,9 @@ validate_success = function(data) {
         aux_success = aux_success + doc_id + "</br>";
       });
     }
-    clear_input();
+    if (!("dry_run" in data)){
+      clear_input();
+    }
   }
   return aux_success
 };
@@ -0,0 +1,13 @@
+function pollJob(element) {
+    fetch(element.dataset.statusUrl, {credentials: 'same-origin'})
+        .then(function(response) { return response.json(); })
+        .then(function(data) {
+            if (data.status == 'finished' || data.status == 'failed') {
+                window.location.search = '?job=' + element.dataset.jobId;
+                return;
+            }
+            document.getElementById("job_progress").textContent = data.processed + " de " + data.total;
+            setTimeout(function() { pollJob(element); }, 2000);
+        })
+        .catch(function() { setTimeout(function() { pollJob(element); }, 5000); });
+}
@@ -0,0 +1,80 @@
+# Python Standard Libraries
+import logging
+
+# Installed packages (via pip)
+from celery import task
+
+# Internal project dependencies
+from .jobs import resume_job, run_job
+from .models import EdxLoginUser
+from .ph_mirror import refresh_stale_personas
+from .users import refresh_ph_username
+from .utils import apply_pending_registrations
+
+logger = logging.getLogger(__name__)
+
+PENDING_COURSES_RETRY_DELAY = 30
+PENDING_COURSES_MAX_RETRIES = 5
+
+
+@task(queue='edx.lms.core.low')
+def refresh_personas_task(older_than=None, limit=None):
+    """
+    Refresh the stale snapshots of the persona mirror.
+    """
+    result = refresh_stale_personas(older_than=older_than, limit=limit)
+    logger.info("Persona snapshots refreshed: {}".format(result))
+    return result
+
+
+@task(queue='edx.lms.core.low')
+def refresh_ph_username_task(ph_username):
+    """
+    Check with ph the edxloginuser linked to the uchile username ph_username.
+    """
+    try:
+        refresh_ph_username(ph_username)
+    except Exception:
+        logger.exception("Failed to refresh the ph username: {}".format(ph_username))
+
+
+@task(
+    bind=True,
+    queue='edx.lms.core.low',
+    default_retry_delay=PENDING_COURSES_RETRY_DELAY,
+    max_retries=PENDING_COURSES_MAX_RETRIES)
+def enroll_pending_courses_task(self, run):
+    """
+    Enroll the user of run in its pending courses. Applied registrations are removed, so
+    the task can be retried or queued again for the same run. If the edxloginuser isn't
+    there yet (e.g. its transaction isn't committed) the task is retried.
+    """
+    try:
+        edxlogin_user = EdxLoginUser.objects.select_related('user').get(run=run)
+    except EdxLoginUser.DoesNotExist as e:
+        logger.warning("Can't enroll the pending courses yet, there isn't an edxloginuser with run: {}".format(run))
+        raise self.retry(exc=e)
+    try:
+        applied = apply_pending_registrations(edxlogin_user)
+    except Exception as e:
+        logger.warning("Failed to enroll the pending courses of run: {}, error: {}".format(run, e))
+        raise self.retry(exc=e)
+    if applied is None:
+        # Another call is applying them, check again later for registrations created meanwhile.
+        raise self.retry()
+
+
+@task(queue='edx.lms.core.low')
+def run_job_task(job_id):
+    """
+    Run the background staff or external enrollment job_id.
+    """
+    run_job(job_id)
+
+
+@task(queue='edx.lms.core.low')
+def resume_job_task(job_id):
+    """
+    Resume the failed or interrupted background job job_id from its last committed chunk.
+    """
+    resume_job(job_id)
@@ -3,19 +3,28 @@
 
 # Python Standard Libraries
 import json
+import threading
+import time
 import urllib.parse
 import uuid
 from collections import namedtuple
+from datetime import timedelta
 
 
 # Installed packages (via pip)
+import requests
 from common.djangoapps.student.tests.factories import CourseEnrollmentAllowedFactory, UserFactory, CourseEnrollmentFactory
+from common.djangoapps.student.models import CourseEnrollment, CourseEnrollmentAllowed
 from common.djangoapps.student.roles import CourseInstructorRole, CourseStaffRole
 from django.conf import settings
 from django.contrib.auth.models import Permission, User
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase, Client
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from mock import patch
 
 # Edx dependencies
@@ -24,10 +33,18 @@ from xmodule.modulestore.tests.django_utils import ModuleStoreTestCase
 from xmodule.modulestore.tests.factories import CourseFactory
 
 # Internal project dependencies
-from .users import create_edxloginuser, create_user_by_data
-from .models import EdxLoginUserCourseRegistration, EdxLoginUser
+from .users import create_edxloginuser, create_user_by_data, refresh_ph_username
+from . import metrics
+from .models import EdxLoginJob, EdxLoginPersona, EdxLoginUserCourseRegistration, EdxLoginUser
+from .ph_cache import PhCache, ph_cache, ph_single_flight
+from .ph_client import PhCircuitOpenException, ph_client
+from .ph_mirror import refresh_stale_personas
+from .ph_query import PhPersona, PhPersonaNotFoundException, check_doc_id_have_sso, check_doc_ids_have_sso, get_persona, get_user_data, get_user_data_many
 from .services.utils import get_document_type
-from .utils import generate_username, get_user_from_emails, select_email, validate_all_doc_id_types, validate_rut
+from .doc_ids import format_doc_id, parse_doc_ids
+from .jobs import create_job, get_job_status, get_resumable_job_ids, resume_job, run_job
+from .views import EdxLoginStaff
+from .utils import CoursePermissionResolver, UsernameAllocator, apply_pending_registrations, bulk_register_pending_courses, generate_username, get_user_from_emails, get_users_from_email_lists, select_email, validate_all_doc_id_types, validate_courses, validate_rut
 
 
 class TestRedirectView(TestCase):
@@ -67,6 +84,8 @@ class TestRedirectView(TestCase):
 class TestCallbackView(ModuleStoreTestCase):
     def setUp(self):
         super(TestCallbackView, self).setUp()
+        ph_cache.clear()
+        ph_client.breaker.reset()
         self.client = Client()
         result = self.client.get(reverse('uchileedxlogin-login:login'))
         with patch('common.djangoapps.student.models.cc.User.save'):
@@ -82,8 +101,9 @@ class TestCallbackView(ModuleStoreTestCase):
                 is_staff=True)
         EdxLoginUser.objects.create(user=user, run='009472337K', have_sso=False)
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_login_parameters(self, get):
+    def test_login_parameters(self, get, ph_get):
         """
             Test normal process
         """
@@ -91,8 +111,8 @@ class TestCallbackView(ModuleStoreTestCase):
         get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "content"])(200,
-                                                   ('yes\ntest.name\n').encode('utf-8')),
-                           namedtuple("Request",
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "json"])(200,
                                                 lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[
@@ -108,17 +128,18 @@ class TestCallbackView(ModuleStoreTestCase):
                 'ticket': 'testticket',
                 'next': 'aHR0cHM6Ly9lb2wudWNoaWxlLmNsLw=='})
         self.assertEqual(result.status_code, 302)
-        username = get.call_args_list[1][1]['params'][0]
+        username = ph_get.call_args_list[0][1]['params'][0]
         self.assertEqual(
             get.call_args_list[0][0][0],
             settings.EDXLOGIN_RESULT_VALIDATE)
         self.assertEqual(username[1], '"test.name"')
         self.assertEqual(
-            get.call_args_list[1][0][0],
+            ph_get.call_args_list[0][0][0],
             settings.EDXLOGIN_USER_INFO_URL)
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_login_create_user(self, get):
+    def test_login_create_user(self, get, ph_get):
         """
             Test create user normal process
         """
@@ -126,8 +147,8 @@ class TestCallbackView(ModuleStoreTestCase):
         get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "content"])(200,
-                                                   ('yes\ntest.name\n').encode('utf-8')),
-                           namedtuple("Request",
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "json"])(200,
                                                 lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[
@@ -147,8 +168,9 @@ class TestCallbackView(ModuleStoreTestCase):
         self.assertEqual(edxlogin_user.run, "0112223334")
         self.assertEqual(edxlogin_user.user.email, "test@test.test")
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_login_create_user_email_exists(self, get):
+    def test_login_create_user_email_exists(self, get, ph_get):
         """
             Test create user normal process when email exists but doc_id params dont exists on db
         """
@@ -156,8 +178,8 @@ class TestCallbackView(ModuleStoreTestCase):
         get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "content"])(200,
-                                                   ('yes\ntest.name\n').encode('utf-8')),
-                           namedtuple("Request",
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "json"])(200,
                                                 lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[
@@ -176,16 +198,17 @@ class TestCallbackView(ModuleStoreTestCase):
         self.assertEqual(edxlogin_user.run, "0112223334")
         self.assertEqual(edxlogin_user.user.email, "test22@test.test")
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_login_error_to_get_data(self, get):
+    def test_login_error_to_get_data(self, get, ph_get):
         """
             Test create user when fail to get data from ph api
         """
         get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "content"])(200,
-                                                   ('yes\ntest.name\n').encode('utf-8')),
-                           namedtuple("Request",
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "json"])(200,
                                                 lambda:{'data':{'getRowsPersona':None}})]
@@ -196,16 +219,17 @@ class TestCallbackView(ModuleStoreTestCase):
             data={'ticket': 'testticket'})
         self.assertFalse(EdxLoginUser.objects.filter(run="0112223334").exists())
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_login_error_to_get_data_2(self, get):
+    def test_login_error_to_get_data_2(self, get, ph_get):
         """
             Test create user when fail to get data from ph api
         """
         get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "content"])(200,
-                                                   ('yes\ntest.name\n').encode('utf-8')),
-                           namedtuple("Request",
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "json"])(200,
                                                 lambda:{'data':{'getRowsPersona':{'status_code': 400,'persona':[
@@ -222,16 +246,17 @@ class TestCallbackView(ModuleStoreTestCase):
             data={'ticket': 'testticket'})
         self.assertFalse(EdxLoginUser.objects.filter(run="0112223334").exists())
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_login_error_to_get_data_3(self, get):
+    def test_login_error_to_get_data_3(self, get, ph_get):
         """
             Test create user when fail to get data from ph api
         """
         get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "content"])(200,
-                                                   ('yes\ntest.name\n').encode('utf-8')),
-                           namedtuple("Request",
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "json"])(200,
                                                 lambda:{'data':{'getRowsPersona':{'status_code': 400,'persona':[]}}})]
@@ -242,16 +267,17 @@ class TestCallbackView(ModuleStoreTestCase):
             data={'ticket': 'testticket'})
         self.assertFalse(EdxLoginUser.objects.filter(run="0112223334").exists())
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_login_error_to_get_data_4(self, get):
+    def test_login_error_to_get_data_4(self, get, ph_get):
         """
             Test create user when fail to get data from ph api
         """
         get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "content"])(200,
-                                                   ('yes\ntest.name\n').encode('utf-8')),
-                           namedtuple("Request",
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "json"])(200,
                                                 lambda:{'data':{'getRowsPersona':{'status_code': 400}}})]
@@ -262,8 +288,9 @@ class TestCallbackView(ModuleStoreTestCase):
             data={'ticket': 'testticket'})
         self.assertFalse(EdxLoginUser.objects.filter(run="0112223334").exists())
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_login_update_have_sso_param(self, get):
+    def test_login_update_have_sso_param(self, get, ph_get):
         """
             Test callback update have_sso param
         """
@@ -271,8 +298,8 @@ class TestCallbackView(ModuleStoreTestCase):
         get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "content"])(200,
-                                                   ('yes\ntest.name\n').encode('utf-8')),
-                            namedtuple("Request",
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "json"])(200,
                                                 lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[
@@ -293,8 +320,107 @@ class TestCallbackView(ModuleStoreTestCase):
         self.assertTrue(edxlogin_user.have_sso)
         self.assertEqual(edxlogin_user.user.email, "test555@test.test")
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_login_create_user_wrong_email(self, get):
+    def test_login_returning_user(self, get, ph_get):
+        """
+            Test that the uchile username is linked on login and the next logins don't query ph
+        """
+        get.side_effect = [namedtuple("Request",
+                                      ["status_code",
+                                       "content"])(200,
+                                                   ('yes\ntest.name\n').encode('utf-8'))] * 2
+        ph_get.side_effect = [namedtuple("Request",
+                                      ["status_code",
+                                       "json"])(200,
+                                                lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[
+                                                    {"paterno": "TESTLASTNAME",
+                                                     "materno": "TESTLASTNAME",
+                                                     'pasaporte': [{'usuario':'test.name'}],
+                                                     "nombres": "TEST NAME",
+                                                     'email': [{'email': 'test@test.test'}],
+                                                     "indiv_id": "009472337K"}]}}})]
+        self.client.get(reverse('uchileedxlogin-login:callback'), data={'ticket': 'testticket'})
+        edxlogin_user = EdxLoginUser.objects.get(run="009472337K")
+        self.assertEqual(edxlogin_user.ph_username, 'test.name')
+        self.assertIsNotNone(edxlogin_user.ph_username_checked_at)
+        ph_cache.clear()
+        client = Client()
+        result = client.get(reverse('uchileedxlogin-login:callback'), data={'ticket': 'testticket'})
+        self.assertEqual(result.status_code, 302)
+        self.assertEqual(result.url, '/')
+        self.assertEqual(ph_get.call_count, 1)
+        self.assertEqual(int(client.session['_auth_user_id']), edxlogin_user.user.id)
+
+    @patch('uchileedxlogin.views.refresh_ph_username_task.delay')
+    @patch('requests.Session.get')
+    @patch('requests.get')
+    def test_login_returning_user_stale_link(self, get, ph_get, delay):
+        """
+            Test that an old link logs in the user and is checked with ph in the background
+        """
+        get.side_effect = [namedtuple("Request",
+                                      ["status_code",
+                                       "content"])(200,
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        EdxLoginUser.objects.filter(run="009472337K").update(
+            ph_username='test.name',
+            ph_username_checked_at=timezone.now() - timedelta(days=2))
+        result = self.client.get(reverse('uchileedxlogin-login:callback'), data={'ticket': 'testticket'})
+        self.assertEqual(result.url, '/')
+        self.assertEqual(ph_get.call_count, 0)
+        delay.assert_called_once_with('test.name')
+
+    @patch('requests.Session.get')
+    def test_refresh_ph_username(self, ph_get):
+        """
+            Test that the refresh moves the uchile username to the doc_id returned by ph
+        """
+        ph_get.side_effect = [namedtuple("Request",
+                                      ["status_code",
+                                       "json"])(200,
+                                                lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[
+                                                    {"paterno": "TESTLASTNAME",
+                                                     "materno": "TESTLASTNAME",
+                                                     'pasaporte': [{'usuario':'test.name'}],
+                                                     "nombres": "TEST NAME",
+                                                     'email': [{'email': 'test22@test.test'}],
+                                                     "indiv_id": "0000000108"}]}}})]
+        EdxLoginUser.objects.filter(run="009472337K").update(ph_username='test.name')
+        EdxLoginUser.objects.create(user=User.objects.get(username='testuser22'), run='0000000108')
+        edxlogin_user = refresh_ph_username('test.name')
+        self.assertEqual(edxlogin_user.run, '0000000108')
+        self.assertEqual(EdxLoginUser.objects.get(run='0000000108').ph_username, 'test.name')
+        self.assertIsNone(EdxLoginUser.objects.get(run='009472337K').ph_username)
+
+    @override_settings(EDXLOGIN_METRICS_BACKEND='memory', EDXLOGIN_SERVER_TIMING=True)
+    @patch('requests.Session.get')
+    @patch('requests.get')
+    def test_login_metrics(self, get, ph_get):
+        """
+            Test that the callback measures its stages and counts the logins
+        """
+        metrics.get_backend().reset()
+        get.side_effect = [
+            namedtuple("Request", ["status_code", "content"])(200, ('yes\ntest.name\n').encode('utf-8')),
+            namedtuple("Request", ["status_code", "content"])(200, ('no\n\n').encode('utf-8'))]
+        ph_get.side_effect = [ph_persona_response((('indiv_id', '"009472337K"'),))]
+        result = self.client.get(reverse('uchileedxlogin-login:callback'), data={'ticket': 'testticket'})
+        self.assertEqual(result.url, '/')
+        self.assertEqual(
+            [stage.split(';')[0] for stage in result['Server-Timing'].split(', ')],
+            ['verify_state', 'user_lookup', 'ph_lookup', 'pending_enrollments', 'login', 'total'])
+        result = Client().get(reverse('uchileedxlogin-login:callback'), data={'ticket': 'wrongticket'})
+        backend = metrics.get_backend()
+        self.assertEqual(backend.counters['uchileedxlogin.callback.success'], 1)
+        self.assertEqual(backend.counters['uchileedxlogin.callback.failure.invalid_ticket'], 1)
+        self.assertEqual(len(backend.timings['uchileedxlogin.callback.total']), 2)
+        self.assertEqual(len(backend.timings['uchileedxlogin.callback.ph_lookup']), 1)
+        self.assertEqual(len(backend.timings['uchileedxlogin.ph.request']), 1)
+
+    @patch('requests.Session.get')
+    @patch('requests.get')
+    def test_login_create_user_wrong_email(self, get, ph_get):
         """
             Test create user when email is wrong
         """
@@ -302,8 +428,8 @@ class TestCallbackView(ModuleStoreTestCase):
         get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "content"])(200,
-                                                   ('yes\ntest.name\n').encode('utf-8')),
-                           namedtuple("Request",
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "json"])(200,
                                                 lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[
@@ -323,16 +449,17 @@ class TestCallbackView(ModuleStoreTestCase):
         request = urllib.parse.urlparse(result.url)
         self.assertEqual(request.path, '/uchileedxlogin/login/')
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_login_create_user_email_diff_doc_id(self, get):
+    def test_login_create_user_email_diff_doc_id(self, get, ph_get):
         """
             Test create user when email have different doc_id param
         """
         get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "content"])(200,
-                                                   ('yes\ntest.name\n').encode('utf-8')),
-                           namedtuple("Request",
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "json"])(200,
                                                 lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[
@@ -352,8 +479,9 @@ class TestCallbackView(ModuleStoreTestCase):
         request = urllib.parse.urlparse(result.url)
         self.assertEqual(request.path, '/uchileedxlogin/login/')
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_login_wrong_ticket(self, get):
+    def test_login_wrong_ticket(self, get, ph_get):
         """
             Test callback when ticket is wrong
         """
@@ -361,8 +489,8 @@ class TestCallbackView(ModuleStoreTestCase):
         get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "content"])(200,
-                                                   ('no\n\n').encode('utf-8')),
-                           namedtuple("Request",
+                                                   ('no\n\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "json"])(200,
                                                 lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[
@@ -379,8 +507,9 @@ class TestCallbackView(ModuleStoreTestCase):
         request = urllib.parse.urlparse(result.url)
         self.assertEqual(request.path, '/uchileedxlogin/login/')
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_login_wrong_username(self, get):
+    def test_login_wrong_username(self, get, ph_get):
         """
             Test callback when username is wrong
         """
@@ -389,8 +518,8 @@ class TestCallbackView(ModuleStoreTestCase):
             namedtuple(
                 "Request", [
                     "status_code", "content"])(
-                200, ('yes\nwrongname\n').encode('utf-8')), 
-            namedtuple("Request",
+                200, ('yes\nwrongname\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                 ["status_code",
                 "json"])(200,
                         lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[]}}})]
@@ -511,8 +640,9 @@ class TestCallbackView(ModuleStoreTestCase):
         self.assertEqual(create_user_by_data(
             data, 'test@test.test', False).username, 'a234567890123456789012341')
 
+    @patch('requests.Session.get')
     @patch('requests.get')
-    def test_callback_enroll_pending_courses(self, get):
+    def test_callback_enroll_pending_courses(self, get, ph_get):
         """
             Test callback enroll when user have pending course with auto enroll and not auto enroll
         """
@@ -542,8 +672,8 @@ class TestCallbackView(ModuleStoreTestCase):
         get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "content"])(200,
-                                                   ('yes\ntest.name\n').encode('utf-8')),
-                           namedtuple("Request",
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        ph_get.side_effect = [namedtuple("Request",
                                       ["status_code",
                                        "json"])(200,
                                                 lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[
@@ -561,10 +691,54 @@ class TestCallbackView(ModuleStoreTestCase):
                 'ticket': 'testticket'})
         self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 0)
 
+    @override_settings(EDXLOGIN_ASYNC_PENDING_ENROLLMENTS=True)
+    @patch('uchileedxlogin.views.transaction.on_commit')
+    @patch('uchileedxlogin.views.enroll_pending_courses_task.delay')
+    @patch('requests.Session.get')
+    @patch('requests.get')
+    def test_callback_enroll_pending_courses_async(self, get, ph_get, delay, on_commit):
+        """
+            Test that the pending courses are left to the celery task, queued once the user is committed,
+            and applying them is idempotent
+        """
+        self.course = CourseFactory.create(
+            org='mss',
+            course='999',
+            display_name='2020',
+            emit_signals=True)
+        aux = CourseOverview.get_from_id(self.course.id)
+        EdxLoginUserCourseRegistration.objects.create(
+            run='009472337K',
+            course=self.course.id,
+            mode="honor",
+            auto_enroll=True)
+        get.side_effect = [namedtuple("Request",
+                                      ["status_code",
+                                       "content"])(200,
+                                                   ('yes\ntest.name\n').encode('utf-8'))]
+        ph_get.side_effect = [ph_persona_response((('indiv_id', '"009472337K"'),))]
+        result = self.client.get(
+            reverse('uchileedxlogin-login:callback'),
+            data={
+                'ticket': 'testticket'})
+        self.assertEqual(result.url, '/')
+        delay.assert_not_called()
+        self.assertEqual(on_commit.call_count, 1)
+        on_commit.call_args[0][0]()
+        delay.assert_called_once_with('009472337K')
+        self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 1)
+        edxlogin_user = EdxLoginUser.objects.get(run='009472337K')
+        self.assertEqual(apply_pending_registrations(edxlogin_user), 1)
+        self.assertEqual(apply_pending_registrations(edxlogin_user), 0)
+        self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 0)
+        self.assertTrue(CourseEnrollment.is_enrolled(edxlogin_user.user, self.course.id))
+
 class TestStaffView(ModuleStoreTestCase):
 
     def setUp(self):
         super(TestStaffView, self).setUp()
+        ph_cache.clear()
+        ph_client.breaker.reset()
         self.course = CourseFactory.create(
             org='mss',
             course='999',
@@ -891,6 +1065,19 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(
             EdxLoginUserCourseRegistration.objects.all().count(), 0)
 
+    def test_validate_courses(self):
+        """
+            Test validate_courses checks every course with one query
+        """
+        course_ids = [str(self.course.id), str(self.course2.id), 'course-v1:tet+MSS001+2009_2', 'invalid_course']
+        with self.assertNumQueries(1):
+            valid_courses = validate_courses(course_ids)
+        self.assertEqual(valid_courses, {
+            str(self.course.id): self.course.id,
+            str(self.course2.id): self.course2.id})
+        with self.assertNumQueries(0):
+            self.assertEqual(validate_courses(['invalid_course']), {})
+
     def test_staff_post_sin_doc_id(self):
         """
             Test staff view post when 'doc_ids' is empty
@@ -910,6 +1097,31 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(
             EdxLoginUserCourseRegistration.objects.all().count(), 0)
 
+    @override_settings(EDXLOGIN_BULK_MAX_ROWS=2)
+    def test_staff_post_limit_data_exceeded(self):
+        """
+            Test staff view post when there are more doc_ids than EDXLOGIN_BULK_MAX_ROWS
+        """
+        post_data = {
+            'action': "staff_enroll",
+            'doc_ids': '10-8\n9472337-k\n1-9',
+            'course': self.course.id,
+            'modes': 'audit',
+            'enroll': '1'
+        }
+
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue("id=\"limit_data\"" in response._container[0].decode())
+        self.assertEqual(
+            EdxLoginUserCourseRegistration.objects.all().count(), 0)
+        post_data['action'] = "enroll"
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        self.assertTrue('limit_data' in response.json())
+        self.assertFalse(EdxLoginJob.objects.exists())
+
     def test_staff_post_doc_id_malo(self):
         """
             Test staff view post when 'doc_ids' is wrong
@@ -969,7 +1181,49 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertTrue(
             "id=\"doc_id_saved_enroll_no_auto\"" in response._container[0].decode())
 
-    @patch('requests.get')
+    def test_staff_post_exits_user_no_enroll_twice(self):
+        """
+            Test staff view post without auto enroll twice doesn't duplicate the enrollment allowed
+        """
+        post_data = {
+            'action': "staff_enroll",
+            'doc_ids': '9472337-k',
+            'course': '{}\n{}'.format(str(self.course.id), str(self.course2.id)),
+            'modes': 'audit'
+        }
+        for i in range(2):
+            response = self.client.post(
+                reverse('uchileedxlogin-login:staff'), post_data)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(CourseEnrollmentAllowed.objects.filter(email='student2@edx.org').count(), 2)
+        self.assertTrue(
+            "id=\"doc_id_saved_enroll_no_auto\"" in response._container[0].decode())
+
+    def test_staff_post_pending_twice(self):
+        """
+            Test staff view post of a pending doc_id twice updates its registrations
+        """
+        post_data = {
+            'action': "staff_enroll",
+            'doc_ids': '10-8\n9045578-8',
+            'course': str(self.course.id),
+            'modes': 'audit',
+            'enroll': '1'
+        }
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        self.assertEqual(response.status_code, 200)
+        post_data['modes'] = 'honor'
+        del post_data['enroll']
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 2)
+        aux = EdxLoginUserCourseRegistration.objects.get(run='0000000108')
+        self.assertEqual(aux.mode, 'honor')
+        self.assertEqual(aux.auto_enroll, False)
+
+    @patch('requests.Session.get')
     def test_staff_post_force_enroll(self, get):
         """
             Test staff view post with force enroll normal process
@@ -1009,7 +1263,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(edxlogin_user.run, "0000000108")
         self.assertEqual(edxlogin_user.user.email, "test@test.test")
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_force_enroll_uchile_email(self, get):
         """
             Test staff view post with force enroll normal process
@@ -1049,7 +1303,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(edxlogin_user.run, "0000000108")
         self.assertEqual(edxlogin_user.user.email, "test@uchile.cl")
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_force_enroll_exists_email(self, get):
         """
             Test staff view post with force enroll normal process
@@ -1089,7 +1343,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(edxlogin_user.run, "0000000108")
         self.assertEqual(edxlogin_user.user.email, "student@edx.org")
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_force_enroll_exists_email_2(self, get):
         """
             Test staff view post with force enroll normal process
@@ -1129,7 +1383,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(edxlogin_user.run, "0000000108")
         self.assertEqual(edxlogin_user.user.email, "student@edx.org")
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_force_enroll_exists_email_3(self, get):
         """
             Test staff view post with force enroll normal process
@@ -1169,7 +1423,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(edxlogin_user.run, "0000000108")
         self.assertTrue(edxlogin_user.user.email in ['student22@edx2.org', 'student55@edx.org'])
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_force_enroll_email_diff_doc_id(self, get):
         """
             Test staff view post with force enroll when fail to get data from ph api
@@ -1206,7 +1460,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 1)
         self.assertFalse(EdxLoginUser.objects.filter(run="0000000108").exists())
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_force_enroll_error_to_get_data(self, get):
         """
             Test staff view post with force enroll when fail to get data from ph api
@@ -1243,7 +1497,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 1)
         self.assertFalse(EdxLoginUser.objects.filter(run="0000000108").exists())
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_force_enroll_error_to_get_data_2(self, get):
         """
             Test staff view post with force enroll when fail to get data from ph api
@@ -1275,7 +1529,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 1)
         self.assertFalse(EdxLoginUser.objects.filter(run="0000000108").exists())
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_force_enroll_error_to_get_data_3(self, get):
         """
             Test staff view post with force enroll when fail to get data from ph api
@@ -1307,7 +1561,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 1)
         self.assertFalse(EdxLoginUser.objects.filter(run="0000000108").exists())
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_force_enroll_error_to_get_data_4(self, get):
         """
             Test staff view post with force enroll when fail to get data from ph api
@@ -1339,7 +1593,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 1)
         self.assertFalse(EdxLoginUser.objects.filter(run="0000000108").exists())
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_force_enroll_error_to_get_data_5(self, get):
         """
             Test staff view post with force enroll when fail to get data from ph api
@@ -1371,7 +1625,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 1)
         self.assertFalse(EdxLoginUser.objects.filter(run="0000000108").exists())
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_force_no_enroll(self, get):
         """
             Test staff view post with force enroll without auto enroll
@@ -1410,7 +1664,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(edxlogin_user.run, "0000000108")
         self.assertEqual(edxlogin_user.user.email, "test@test.test")
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_force_no_user(self, get):
         """
             Test staff view post with force enroll when fail get username
@@ -1476,7 +1730,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(r['parameters'], ["action"])
         self.assertEqual(r['info'], {"action": "test"})
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_staff_course(self, get):
         """
             Test staff view post when user is staff course
@@ -1515,7 +1769,7 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(r['doc_id_saved']['doc_id_saved_force'], "TEST_TESTLASTNAME - 0000000108")        
         self.assertEqual(aux.user.email, "test@test.test")
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_instructor_staff(self, get):
         """
             Test staff view post when user have permission
@@ -1547,7 +1801,7 @@ class TestStaffView(ModuleStoreTestCase):
         r = json.loads(response._container[0].decode())
         self.assertTrue(r['error_permission'], [str(self.course.id)])
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_instructor(self, get):
         """
             Test staff view post when user is instructor
@@ -1585,7 +1839,7 @@ class TestStaffView(ModuleStoreTestCase):
         r = json.loads(response._container[0].decode())
         self.assertEqual(r['doc_id_saved']['doc_id_saved_force'], "TEST_TESTLASTNAME - 0000000108")
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_instructor_multiple_course(self, get):
         """
             Test staff view post when user is instructor and multiple course
@@ -1726,6 +1980,229 @@ class TestStaffView(ModuleStoreTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(r['doc_id_unenroll'], ['0000000108'])
 
+    def test_staff_unenroll_query_budget(self):
+        """
+            Test unenroll_user makes the same number of queries for any number of doc_ids and courses
+        """
+        course_ids = [str(self.course.id), str(self.course2.id)]
+        for i in range(3):
+            user = UserFactory(username='unenroll{}'.format(i), email='unenroll{}@edx.org'.format(i))
+            EdxLoginUser.objects.create(user=user, run='00000001{}'.format(i))
+            for course in (self.course, self.course2):
+                CourseEnrollmentFactory(user=user, course_id=course.id)
+                CourseEnrollmentAllowedFactory(email=user.email, course_id=course.id, user=user)
+            EdxLoginUserCourseRegistration.objects.create(run='00000002{}'.format(i), course=self.course.id, mode='audit')
+
+        with CaptureQueriesContext(connection) as single:
+            result = EdxLoginStaff().unenroll_user(course_ids, ['000000010', '000000020'])
+        self.assertEqual(result['doc_id_unenroll'], ['000000010', '000000020'])
+        doc_ids = ['000000011', '000000021', '000000099', '000000012', '000000022']
+        with CaptureQueriesContext(connection) as many:
+            result = EdxLoginStaff().unenroll_user(course_ids, doc_ids)
+        self.assertEqual(len(many.captured_queries), len(single.captured_queries))
+        self.assertEqual(result['doc_id_unenroll'], ['000000011', '000000021', '000000012', '000000022'])
+        self.assertEqual(result['doc_id_unenroll_no_exists'], ['000000099'])
+        self.assertFalse(CourseEnrollment.objects.filter(user__username__startswith='unenroll', is_active=True).exists())
+        self.assertFalse(CourseEnrollmentAllowed.objects.filter(email__startswith='unenroll').exists())
+        self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 0)
+
+    @override_settings(EDXLOGIN_PH_PERSONA_MIRROR=True)
+    @patch('requests.Session.get')
+    def test_staff_post_dry_run_enroll(self, get):
+        """
+            Test staff view post dry_run_enroll returns the plan without querying ph nor saving anything
+        """
+        EdxLoginPersona.objects.create(
+            run='0000000108',
+            username='local.0000000108',
+            nombres='LOCAL NAME',
+            apellido_paterno='LOCALLASTNAME',
+            apellido_materno='LOCALLASTNAME',
+            emails=json.dumps(['0000000108@local.test']),
+            have_sso=True,
+            fetched_at=timezone.now())
+        CourseEnrollmentFactory(user=User.objects.get(username='testuser3'), course_id=self.course.id, mode='audit')
+        post_data = {
+            'action': "dry_run_enroll",
+            'doc_ids': '10-8\n9472337-k\n9045578-8',
+            'course': self.course.id,
+            'modes': 'audit',
+            'enroll': '1',
+            'force': '1'
+        }
+        users = EdxLoginUser.objects.count()
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        self.assertEqual(response.status_code, 200)
+        r = response.json()
+        self.assertTrue(r['dry_run'])
+        self.assertTrue(r['doc_id_saved']['doc_id_saved_force'].endswith(' - 0000000108'))
+        self.assertEqual(r['doc_id_saved']['doc_id_saved_enroll'], 'testuser3 - 009472337K')
+        self.assertEqual(r['doc_id_saved']['doc_id_saved_pending'], '')
+        self.assertEqual(r['doc_id_unknown'], ['0090455788'])
+        self.assertEqual(r['doc_id_enrolled'], ['009472337K'])
+        self.assertEqual(get.call_count, 0)
+        self.assertEqual(EdxLoginUser.objects.count(), users)
+        self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 0)
+
+    @patch('requests.Session.get')
+    def test_staff_post_dry_run_enroll_without_mirror(self, get):
+        """
+            Test staff view post dry_run_enroll doesn't query ph when the persona mirror is disabled
+        """
+        get.side_effect = lambda url, params, **kwargs: ph_persona_response(params)
+        post_data = {
+            'action': "dry_run_enroll",
+            'doc_ids': '10-8\n9045578-8',
+            'course': self.course.id,
+            'modes': 'audit',
+            'enroll': '1',
+            'force': '1'
+        }
+        users = EdxLoginUser.objects.count()
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        self.assertEqual(response.status_code, 200)
+        r = response.json()
+        self.assertTrue(r['dry_run'])
+        self.assertEqual(r['doc_id_unknown'], ['0000000108', '0090455788'])
+        self.assertEqual(get.call_count, 0)
+        self.assertEqual(EdxLoginUser.objects.count(), users)
+        self.assertFalse(EdxLoginPersona.objects.exists())
+
+    def test_staff_post_dry_run_unenroll(self):
+        """
+            Test staff view post dry_run_unenroll returns the plan without unenrolling
+        """
+        post_data = {
+            'action': "dry_run_unenroll",
+            'doc_ids': '10-8\n9045578-8',
+            'course': self.course.id,
+            'modes': 'audit',
+        }
+        EdxLoginUser.objects.create(user=self.student, run='0000000108')
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        self.assertEqual(response.status_code, 200)
+        r = response.json()
+        self.assertTrue(r['dry_run'])
+        self.assertEqual(r['doc_id_unenroll'], ['0000000108'])
+        self.assertEqual(r['doc_id_unenroll_no_exists'], ['0090455788'])
+        self.assertTrue(CourseEnrollment.objects.get(user=self.student, course_id=self.course.id).is_active)
+
+    def test_staff_post_sync(self):
+        """
+            Test staff view post sync adds and removes only the differences with the roster, keeping the course staff
+        """
+        EdxLoginUser.objects.create(user=self.student, run='0000000108')
+        EdxLoginUser.objects.create(user=self.staff_user, run='0090455788')
+        EdxLoginUserCourseRegistration.objects.create(run='0000000019', course=self.course.id, mode='audit')
+        post_data = {
+            'action': "sync",
+            'doc_ids': '9472337-k\n1-9',
+            'course': self.course.id,
+            'modes': 'audit',
+            'enroll': '1',
+            'confirm': '1'
+        }
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        self.assertEqual(response.status_code, 200)
+        r = response.json()
+        self.assertEqual(r['doc_id_sync'], {str(self.course.id): {'added': ['009472337K'], 'removed': ['0000000108']}})
+        self.assertEqual(r['doc_id_saved']['doc_id_saved_enroll'], 'testuser3 - 009472337K')
+        self.assertTrue(CourseEnrollment.is_enrolled(User.objects.get(username='testuser3'), self.course.id))
+        self.assertFalse(CourseEnrollment.is_enrolled(self.student, self.course.id))
+        self.assertTrue(CourseEnrollment.is_enrolled(self.student, self.course2.id))
+        self.assertTrue(CourseEnrollment.is_enrolled(self.staff_user, self.course.id))
+
+        # Syncing the same roster again doesn't change anything
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        r = response.json()
+        self.assertEqual(r['doc_id_sync'], {str(self.course.id): {'added': [], 'removed': []}})
+        self.assertEqual(r['doc_id_saved']['doc_id_saved_enroll'], '')
+        self.assertTrue(EdxLoginUserCourseRegistration.objects.filter(run='0000000019').exists())
+
+    def test_staff_post_sync_without_confirm(self):
+        """
+            Test staff view post sync is rejected without confirm and dry_run_sync returns the plan without saving it
+        """
+        EdxLoginUser.objects.create(user=self.student, run='0000000108')
+        post_data = {
+            'action': "sync",
+            'doc_ids': '9472337-k',
+            'course': self.course.id,
+            'modes': 'audit',
+            'enroll': '1'
+        }
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('error_sync_confirm' in response.json())
+        self.assertTrue(CourseEnrollment.is_enrolled(self.student, self.course.id))
+
+        post_data['action'] = "dry_run_sync"
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        r = response.json()
+        self.assertTrue(r['dry_run'])
+        self.assertEqual(r['doc_id_sync'], {str(self.course.id): {'added': ['009472337K'], 'removed': ['0000000108']}})
+        self.assertTrue(CourseEnrollment.is_enrolled(self.student, self.course.id))
+        self.assertFalse(CourseEnrollment.is_enrolled(User.objects.get(username='testuser3'), self.course.id))
+
+    def test_staff_post_sync_enroll_allowed(self):
+        """
+            Test staff view post sync enrolls the doc_ids only allowed in the course when enroll is set
+        """
+        user = User.objects.get(username='testuser3')
+        CourseEnrollmentAllowedFactory(email=user.email, course_id=self.course.id, user=user)
+        post_data = {
+            'action': "sync",
+            'doc_ids': '9472337-k',
+            'course': self.course.id,
+            'modes': 'audit',
+            'confirm': '1'
+        }
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        self.assertEqual(response.json()['doc_id_sync'][str(self.course.id)]['added'], [])
+        self.assertFalse(CourseEnrollment.is_enrolled(user, self.course.id))
+
+        post_data['enroll'] = '1'
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        self.assertEqual(response.json()['doc_id_sync'][str(self.course.id)]['added'], ['009472337K'])
+        self.assertTrue(CourseEnrollment.is_enrolled(user, self.course.id))
+
+    def test_staff_post_sync_background_job(self):
+        """
+            Test staff view post sync as a background job commits the doc_ids to add chunk by chunk
+        """
+        EdxLoginUser.objects.create(user=self.student, run='0000000108')
+        EdxLoginUser.objects.create(user=self.instructor_staff, run='0000000019')
+        post_data = {
+            'action': "sync",
+            'doc_ids': '9472337-k\n1-9',
+            'course': self.course.id,
+            'modes': 'audit',
+            'enroll': '1',
+            'confirm': '1',
+            'background': '1'
+        }
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        job = EdxLoginJob.objects.get(id=response.json()['job_id'])
+        with override_settings(EDXLOGIN_JOB_CHUNK_SIZE=1):
+            run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed, job.total), ('finished', 2, 2))
+        self.assertEqual(json.loads(job.outcomes), ['enroll', 'enroll'])
+        result = json.loads(job.result)
+        self.assertEqual(result['doc_id_sync'], {str(self.course.id): {'added': ['009472337K', '0000000019'], 'removed': ['0000000108']}})
+        self.assertTrue(CourseEnrollment.is_enrolled(self.instructor_staff, self.course.id))
+        self.assertFalse(CourseEnrollment.is_enrolled(self.student, self.course.id))
+
     def test_staff_post_unenroll_student(self):
         """
             Test staff view post unenroll when user is student 
@@ -1742,7 +2219,72 @@ class TestStaffView(ModuleStoreTestCase):
             reverse('uchileedxlogin-login:staff'), post_data)
         self.assertEqual(response.status_code, 404)
 
-    @patch('requests.get')
+    def test_staff_post_background_job(self):
+        """
+            Test staff view post enroll as a background job and its status endpoint
+        """
+        post_data = {
+            'action': "enroll",
+            'doc_ids': '10-8\n9472337-k\n9045578-8',
+            'course': self.course.id,
+            'modes': 'audit',
+            'enroll': '1',
+            'background': '1'
+        }
+        response = self.client.post(
+            reverse('uchileedxlogin-login:staff'), post_data)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['status'], data['total'], data['processed']), ('pending', 3, 0))
+        self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 0)
+
+        with override_settings(EDXLOGIN_JOB_CHUNK_SIZE=2):
+            run_job(data['job_id'])
+        status = self.client.get(data['status_url']).json()
+        self.assertEqual((status['status'], status['processed']), ('finished', 3))
+        self.assertEqual(status['result']['doc_id_saved']['doc_id_saved_pending'], '0000000108 - 0090455788')
+        self.assertEqual(status['result']['doc_id_saved']['doc_id_saved_enroll'], 'testuser3 - 009472337K')
+        self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 2)
+        response = self.client.get(reverse('uchileedxlogin-login:staff'), {'job': data['job_id']})
+        self.assertTrue('id="doc_id_saved_pending"' in response._container[0].decode())
+        # Other users can't see the job
+        response = self.instructor_staff_client.get(data['status_url'])
+        self.assertEqual(response.status_code, 404)
+
+    def test_staff_background_job_resume(self):
+        """
+            Test a staff job that fails in a chunk keeps the previous chunks and is resumed from there
+        """
+        job = create_job(self.instructor_staff, 'enroll', {
+            'course_ids': [str(self.course.id)],
+            'mode': 'audit',
+            'doc_id_list': ['0000000108', '009472337K', '0090455788'],
+            'force': False,
+            'enroll': True}, 3)
+
+        def register_pending(doc_ids, *args):
+            if doc_ids == ['0090455788']:
+                raise Exception('Connection lost')
+            return bulk_register_pending_courses(doc_ids, *args)
+
+        with override_settings(EDXLOGIN_JOB_CHUNK_SIZE=1):
+            with patch('uchileedxlogin.views.bulk_register_pending_courses', side_effect=register_pending):
+                run_job(job.id)
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.processed), ('failed', 2))
+            self.assertEqual(json.loads(job.outcomes), ['pending', 'enroll'])
+            self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 1)
+            self.assertEqual(get_resumable_job_ids(failed=True), [job.id])
+
+            resume_job(job.id)
+        status = get_job_status(EdxLoginJob.objects.get(id=job.id))
+        self.assertEqual((status['status'], status['processed']), ('finished', 3))
+        self.assertEqual(status['outcomes'], {'pending': 2, 'enroll': 1})
+        self.assertEqual(status['result']['doc_id_saved']['doc_id_saved_pending'], '0000000108 - 0090455788')
+        self.assertEqual(status['result']['doc_id_saved']['doc_id_saved_enroll'], 'testuser3 - 009472337K')
+        self.assertEqual(EdxLoginUserCourseRegistration.objects.count(), 2)
+
+    @patch('requests.Session.get')
     def test_staff_post_enroll_student(self, get):
         """
             Test staff view post enroll when user is student 
@@ -1850,6 +2392,8 @@ class TestStaffView(ModuleStoreTestCase):
 class TestExternalView(ModuleStoreTestCase):
     def setUp(self):
         super(TestExternalView, self).setUp()
+        ph_cache.clear()
+        ph_client.breaker.reset()
         self.course = CourseFactory.create(
             org='mss',
             course='999',
@@ -2048,7 +2592,7 @@ class TestExternalView(ModuleStoreTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTrue('id="lista_saved"' in response._container[0].decode())
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_external_post_with_doc_id(self, get):
         """
             Test external view post with run and (run,email) no exists in db platform
@@ -2079,7 +2623,80 @@ class TestExternalView(ModuleStoreTestCase):
         edxlogin_user = EdxLoginUser.objects.get(run="0000000108")
         self.assertEqual(edxlogin_user.user.email, "aux.student2@edx.org")
 
-    @patch('requests.get')
+    @override_settings(EDXLOGIN_METRICS_BACKEND='memory')
+    @patch('requests.Session.get')
+    def test_external_post_ph_prefetch(self, get):
+        """
+            Test external view post checks the sso of the new doc_ids before the transaction
+        """
+        metrics.get_backend().reset()
+        get.side_effect = [ph_persona_response((('indiv_id', '"0000000108"'),))]
+        EdxLoginUser.objects.create(user=UserFactory(email='aux.student4@edx.org'), run='009472337K', have_sso=True)
+        post_data = {
+            'datos': 'ee ff gg hh, aux.student3@edx.org\naa bb cc dd, aux.student2@edx.org, 10-8\nii jj kk ll, aux.student4@edx.org, 9472337-k',
+            'course': self.course.id,
+            'modes': 'audit',
+            'enroll': '1'
+        }
+        response = self.client.post(
+            reverse('uchileedxlogin-login:external'), post_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('id="lista_saved"' in response._container[0].decode())
+        self.assertEqual(get.call_count, 1)
+        self.assertTrue(EdxLoginUser.objects.get(run="0000000108").have_sso)
+        backend = metrics.get_backend()
+        self.assertEqual(len(backend.timings['uchileedxlogin.external_enroll.ph_prefetch']), 1)
+        self.assertEqual(len(backend.timings['uchileedxlogin.external_enroll.transaction']), 1)
+
+    @override_settings(EDXLOGIN_PH_BREAKER_FAILURE_THRESHOLD=1)
+    @patch('requests.Session.get')
+    def test_external_post_ph_unavailable(self, get):
+        """
+            Test external view post doesn't save a new doc_id as without sso while ph is unavailable
+        """
+        get.side_effect = requests.exceptions.ConnectionError()
+        post_data = {
+            'datos': 'aa bb cc dd, aux.student2@edx.org, 10-8\nee ff gg hh, aux.student3@edx.org',
+            'course': self.course.id,
+            'modes': 'audit',
+            'enroll': '1'
+        }
+        response = self.client.post(
+            reverse('uchileedxlogin-login:external'), post_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('id="lista_not_saved"' in response._container[0].decode())
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(ph_client.breaker.stats()['state'], 'open')
+        self.assertFalse(EdxLoginUser.objects.filter(run="0000000108").exists())
+        self.assertFalse(User.objects.filter(email="aux.student2@edx.org").exists())
+        self.assertTrue(User.objects.filter(email="aux.student3@edx.org").exists())
+
+    @override_settings(EDXLOGIN_PH_BREAKER_FAILURE_THRESHOLD=5)
+    @patch('uchileedxlogin.views.enroll_email')
+    @patch('requests.Session.get')
+    def test_external_post_ph_error_response(self, get, enroll_email):
+        """
+            Test external view post doesn't save a new doc_id as without sso when ph answers with an error
+        """
+        get.side_effect = [namedtuple("Request", ["status_code", "text"])(500, '')]
+        post_data = {
+            'datos': 'aa bb cc dd, aux.student2@edx.org, 10-8',
+            'course': self.course.id,
+            'modes': 'audit',
+            'enroll': '1',
+            'send_email': '1'
+        }
+        response = self.client.post(
+            reverse('uchileedxlogin-login:external'), post_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('id="lista_not_saved"' in response._container[0].decode())
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(ph_client.breaker.stats()['state'], 'closed')
+        self.assertFalse(EdxLoginUser.objects.filter(run="0000000108").exists())
+        self.assertFalse(User.objects.filter(email="aux.student2@edx.org").exists())
+        enroll_email.delay.assert_not_called()
+
+    @patch('requests.Session.get')
     def test_external_post_with_passport(self, get):
         """
             Test external view post with passport and (run,email) no exists in db platform
@@ -2110,7 +2727,7 @@ class TestExternalView(ModuleStoreTestCase):
         edxlogin_user = EdxLoginUser.objects.get(run="P123465789")
         self.assertEqual(edxlogin_user.user.email, "aux.student2@edx.org")
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_external_post_with_passport_lower(self, get):
         """
             Test external view post with passport and (run,email) no exists in db platform
@@ -2141,7 +2758,7 @@ class TestExternalView(ModuleStoreTestCase):
         edxlogin_user = EdxLoginUser.objects.get(run="P123465789")
         self.assertEqual(edxlogin_user.user.email, "aux.student2@edx.org")
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_external_post_with_doc_id_exists_email(self, get):
         """
             Test external view post with run,email exists, run no exists in db platform
@@ -2499,6 +3116,7 @@ class TestExternalView(ModuleStoreTestCase):
         self.assertTrue('id="lista_saved"' in response._container[0].decode())
         self.assertTrue(User.objects.filter(email="aux.student2@edx.org").exists())
 
+    @override_settings(EDXLOGIN_BULK_MAX_ROWS=50)
     def test_external_post_limit_data_exceeded(self):
         """
             Test external view post, limit data exceeded
@@ -2517,6 +3135,64 @@ class TestExternalView(ModuleStoreTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTrue('id="limit_data"' in response._container[0].decode())
 
+    def test_external_post_background_job(self):
+        """
+            Test external view post as a background job, polled until its result is shown
+        """
+        post_data = {
+            'datos': 'aa bb cc dd, aux.student2@edx.org\nee ff gg hh, aux.student3@edx.org',
+            'course': self.course.id,
+            'modes': 'audit',
+            'enroll': '1',
+            'background': '1'
+        }
+        response = self.client.post(
+            reverse('uchileedxlogin-login:external'), post_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('id="job"' in response._container[0].decode())
+        self.assertFalse(User.objects.filter(email="aux.student2@edx.org").exists())
+        job = EdxLoginJob.objects.get(action='external')
+        self.assertEqual((job.status, job.total, job.processed), ('pending', 2, 0))
+
+        with override_settings(EDXLOGIN_JOB_CHUNK_SIZE=1):
+            run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed), ('finished', 2))
+        self.assertTrue(User.objects.filter(email="aux.student2@edx.org").exists())
+        self.assertTrue(User.objects.filter(email="aux.student3@edx.org").exists())
+        status = self.client.get(reverse('uchileedxlogin-login:job', kwargs={'job_id': job.id})).json()
+        self.assertEqual(status['status'], 'finished')
+        self.assertEqual(len(status['result']['lista_saved']), 2)
+        self.assertFalse('password' in status['result']['lista_saved'][0])
+        response = self.client.get(reverse('uchileedxlogin-login:external'), {'job': job.id})
+        self.assertTrue('id="lista_saved"' in response._container[0].decode())
+        self.assertFalse('id="job"' in response._container[0].decode())
+
+    @patch('uchileedxlogin.views.enroll_email')
+    @patch('uchileedxlogin.jobs.transaction.on_commit')
+    def test_external_job_send_email_on_commit(self, on_commit, enroll_email):
+        """
+            Test that the emails of an external job are queued when each chunk is committed
+        """
+        post_data = {
+            'datos': 'aa bb cc dd, aux.student2@edx.org\nee ff gg hh, aux.student3@edx.org',
+            'course': self.course.id,
+            'modes': 'audit',
+            'enroll': '1',
+            'send_email': '1',
+            'background': '1'
+        }
+        self.client.post(reverse('uchileedxlogin-login:external'), post_data)
+        job = EdxLoginJob.objects.get(action='external')
+        with override_settings(EDXLOGIN_JOB_CHUNK_SIZE=1):
+            run_job(job.id)
+        self.assertEqual(on_commit.call_count, 2)
+        enroll_email.delay.assert_not_called()
+        for call in on_commit.call_args_list:
+            call[0][0]()
+        self.assertEqual(enroll_email.delay.call_count, 2)
+        self.assertEqual(enroll_email.delay.call_args_list[0][0][1], 'aux.student2@edx.org')
+
     def test_external_post_send_email(self):
         """
             Test external view post with send email
@@ -2533,7 +3209,7 @@ class TestExternalView(ModuleStoreTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTrue('id="action_send"' in response._container[0].decode())
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_external_post_with_doc_id_email_diff_doc_id(self, get):
         """
             Test external view post with doc_id, when email already have another doc_id params
@@ -2562,7 +3238,7 @@ class TestExternalView(ModuleStoreTestCase):
         self.assertTrue('id="lista_not_saved"' in response._container[0].decode())
         self.assertFalse(EdxLoginUser.objects.filter(run="0000000108").exists())
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_external_post_with_doc_id_fail_get_data(self, get):
         """
             Test external view post with run, when fail to get data from ph api
@@ -2588,13 +3264,11 @@ class TestExternalView(ModuleStoreTestCase):
         response = self.client.post(
             reverse('uchileedxlogin-login:external'), post_data)
         self.assertEqual(response.status_code, 200)
-        self.assertTrue('id="lista_saved"' in response._container[0].decode())
-        self.assertTrue(EdxLoginUser.objects.filter(run="0000000108").exists())
-        edxlogin_user = EdxLoginUser.objects.get(run="0000000108")
-        self.assertFalse(edxlogin_user.have_sso)
-        self.assertEqual(edxlogin_user.user.email, 'test2099@edx.org')
+        self.assertTrue('id="lista_not_saved"' in response._container[0].decode())
+        self.assertFalse(EdxLoginUser.objects.filter(run="0000000108").exists())
+        self.assertFalse(User.objects.filter(email="test2099@edx.org").exists())
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_external_post_with_doc_id_fail_get_data_2(self, get):
         """
             Test external view post with run, when fail to get data from ph api
@@ -2620,7 +3294,7 @@ class TestExternalView(ModuleStoreTestCase):
         self.assertFalse(edxlogin_user.have_sso)
         self.assertEqual(edxlogin_user.user.email, 'test2099@edx.org')
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_external_post_with_doc_id_fail_get_data_3(self, get):
         """
             Test external view post with run, when fail to get data from ph api
@@ -2640,13 +3314,11 @@ class TestExternalView(ModuleStoreTestCase):
         response = self.client.post(
             reverse('uchileedxlogin-login:external'), post_data)
         self.assertEqual(response.status_code, 200)
-        self.assertTrue('id="lista_saved"' in response._container[0].decode())
-        self.assertTrue(EdxLoginUser.objects.filter(run="0000000108").exists())
-        edxlogin_user = EdxLoginUser.objects.get(run="0000000108")
-        self.assertFalse(edxlogin_user.have_sso)
-        self.assertEqual(edxlogin_user.user.email, 'test2099@edx.org')
+        self.assertTrue('id="lista_not_saved"' in response._container[0].decode())
+        self.assertFalse(EdxLoginUser.objects.filter(run="0000000108").exists())
+        self.assertFalse(User.objects.filter(email="test2099@edx.org").exists())
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_external_post_with_doc_id_fail_get_data_4(self, get):
         """
             Test external view post with run, when fail to get data from ph api
@@ -2672,7 +3344,7 @@ class TestExternalView(ModuleStoreTestCase):
         self.assertFalse(edxlogin_user.have_sso)
         self.assertEqual(edxlogin_user.user.email, 'test2099@edx.org')
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_external_post_with_doc_id_fail_get_data_5(self, get):
         """
             Test external view post with run, when fail to get data from ph api
@@ -2765,6 +3437,50 @@ class TestUtils(ModuleStoreTestCase):
                 email='test2@uchile.cl',
                 is_staff=True)
 
+    def test_generate_username_collisions(self):
+        """
+            Test that generate_username resolves heavy collisions with a query per strategy
+        """
+        User.objects.bulk_create(
+            [User(username='juan_gonzalez', email='jg@test.test')] +
+            [User(username='juan_gonzalez{}'.format(i), email='jg{}@test.test'.format(i)) for i in range(1, 700)])
+        data = {'nombres': 'juan', 'apellidoPaterno': 'gonzalez', 'apellidoMaterno': None}
+        with self.assertNumQueries(3):
+            self.assertEqual(generate_username(data), 'juan_gonzalez700')
+
+    def test_username_allocator(self):
+        """
+            Test that UsernameAllocator prefetches the collisions once and allocates unique usernames in order
+        """
+        User.objects.bulk_create([
+            User(username='juan_gonzalez', email='jg@test.test'),
+            User(username='juan_gonzalez1', email='jg1@test.test'),
+            User(username='Maria', email='maria@test.test')])
+        data = {'nombres': 'juan', 'apellidoPaterno': 'gonzalez', 'apellidoMaterno': None}
+        with self.assertNumQueries(1):
+            allocator = UsernameAllocator([data, data, {'nombreCompleto': 'maria'}, {'nombreCompleto': 'maria'}])
+        with self.assertNumQueries(0):
+            self.assertEqual(allocator.allocate(data), 'juan_gonzalez2')
+            self.assertEqual(allocator.allocate(data), 'juan_gonzalez3')
+            self.assertEqual(allocator.allocate({'nombreCompleto': 'maria'}), 'maria1')
+            self.assertEqual(allocator.allocate({'nombreCompleto': 'maria'}), 'maria2')
+        user = create_user_by_data(dict(data), 'juan@test.test', username=allocator.allocate(data))
+        self.assertEqual(user.username, 'juan_gonzalez4')
+
+    def test_username_allocator_ignore_case(self):
+        """
+            Test that UsernameAllocator doesn't give a username that exists with another case
+        """
+        User.objects.bulk_create([
+            User(username='JUAN_GONZALEZ', email='jg@test.test'),
+            User(username='Juan_Gonzalez1', email='jg1@test.test'),
+            User(username='Juan_Gonzalez3', email='jg3@test.test')])
+        data = {'nombres': 'juan', 'apellidoPaterno': 'gonzalez', 'apellidoMaterno': None}
+        with self.assertNumQueries(1):
+            allocator = UsernameAllocator([data, data])
+        self.assertEqual(allocator.allocate(data), 'juan_gonzalez2')
+        self.assertEqual(allocator.allocate(data), 'juan_gonzalez4')
+
     def test_select_email_empty(self):
         """
             Test select_email for an empty email list
@@ -2809,6 +3525,64 @@ class TestUtils(ModuleStoreTestCase):
         create_edxloginuser(self.user2, False, '0094723373')
         self.assertEqual(get_user_from_emails(['test@test.com', 'test2@uchile.cl']), None)
 
+    def test_get_users_from_email_lists(self):
+        """
+            Test get_users_from_email_lists resolves many email lists with one query
+        """
+        UserFactory(username='testuser3', password='12345', email='test3@uchile.cl', is_active=False)
+        create_edxloginuser(self.user, False, '009472337K')
+        user4 = UserFactory(username='testuser4', password='12345', email='test4@test.com')
+        with self.assertNumQueries(1):
+            users = get_users_from_email_lists([
+                ['test@test.com', 'test2@uchile.cl'],
+                ['test@test.com', 'test4@test.com'],
+                ['test3@uchile.cl'],
+                ['unused@test.com'],
+                ['test4@test.com', 'test3@uchile.cl', 'test2@uchile.cl'],
+            ])
+        self.assertEqual(users, [self.user2, user4, None, None, self.user2])
+
+    @patch('uchileedxlogin.utils.has_access')
+    @patch('uchileedxlogin.utils.get_course_with_access')
+    def test_course_permission_resolver(self, get_course_with_access, has_access):
+        """
+            Test CoursePermissionResolver loads each course once and skips it for platform staff
+        """
+        content_type = ContentType.objects.get_for_model(EdxLoginUser)
+        permission = Permission.objects.get(codename='uchile_instructor_staff', content_type=content_type)
+        self.user.user_permissions.add(permission)
+        self.user2.user_permissions.add(permission)
+        has_access.side_effect = lambda user, access, course: access == 'staff'
+        course_id = 'course-v1:eol+test+2020'
+
+        permissions = CoursePermissionResolver(User.objects.get(id=self.user.id))
+        for i in range(3):
+            self.assertTrue(permissions.has_access(course_id))
+        self.assertEqual(get_course_with_access.call_count, 1)
+        self.assertEqual(has_access.call_count, 2)
+
+        permissions = CoursePermissionResolver(User.objects.get(id=self.user2.id))
+        self.assertTrue(permissions.has_access(course_id))
+        self.assertEqual(get_course_with_access.call_count, 1)
+
+        has_access.side_effect = lambda user, access, course: False
+        permissions = CoursePermissionResolver(User.objects.get(id=self.user.id))
+        self.assertFalse(permissions.has_access('course-v1:eol+test+2021'))
+
+    def test_parse_doc_ids(self):
+        """
+            Test parse_doc_ids cleans, pads, validates and flags duplicated doc_ids
+        """
+        doc_ids = parse_doc_ids("9.472.337-k\n\n 009472337K \nP12345\ncg00000123\n10-8\n123-4\n-.-")
+        self.assertEqual([doc_id.value for doc_id in doc_ids], ['009472337K', '009472337K', 'P12345', 'CG00000123', '0000000108', '0000001234'])
+        self.assertEqual([doc_id.type for doc_id in doc_ids], ['rut', 'rut', 'passport', 'cg', 'rut', 'rut'])
+        self.assertEqual([doc_id.valid for doc_id in doc_ids], [True, True, True, True, True, False])
+        self.assertEqual([doc_id.duplicate for doc_id in doc_ids], [False, True, False, False, False, False])
+        self.assertEqual(doc_ids[0].cleaned, '9472337K')
+        self.assertEqual(parse_doc_ids(['10-8', ' ']), parse_doc_ids('10-8'))
+        self.assertEqual(format_doc_id(' 10-8 '), '0000000108')
+        self.assertEqual(format_doc_id(''), '')
+
     def test_validate_all_doc_id_types_valid_passport(self,):
         """
             Test validate_all_id_types for valid passports
@@ -2865,6 +3639,8 @@ class TestUtils(ModuleStoreTestCase):
 
 class TestUserData(TestCase):
     def setUp(self):
+        ph_cache.clear()
+        ph_client.breaker.reset()
         with patch('common.djangoapps.student.models.cc.User.save'):
             # staff user
             self.client = Client()
@@ -2934,7 +3710,7 @@ class TestUserData(TestCase):
         self.assertEqual(request['PATH_INFO'], '/edxuserdata/data/')
 
     @patch('uchileedxlogin.views.check_permission_instructor_staff')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post(self, get, mock_permission_check):
         """
             Test normal process
@@ -2962,7 +3738,7 @@ class TestUserData(TestCase):
             "0000000108;avilio.perez;TESTLASTNAME;TESTLASTNAME;TEST NAME;test@test.test")
 
     @patch('uchileedxlogin.views.check_permission_instructor_staff')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_fail_data(self, get, mock_permission_check):
         """
             Test if get data fail
@@ -2990,8 +3766,9 @@ class TestUserData(TestCase):
             data[1],
             "0000000108;No Encontrado;No Encontrado;No Encontrado;No Encontrado;No Encontrado")
 
+    @override_settings(EDXLOGIN_PH_MAX_WORKERS=1)
     @patch('uchileedxlogin.views.check_permission_instructor_staff')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_multiple_doc_id(self, get, mock_permission_check):
         """
             Test normal process with multiple 'r.u.n'
@@ -3077,7 +3854,7 @@ class TestUserData(TestCase):
         self.assertTrue("id=\"invalid_doc_ids\"" in response._container[0].decode())
 
     @patch('uchileedxlogin.views.check_permission_instructor_staff')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_passport(self, get, mock_permission_check):
         """
             Test normal process with passport
@@ -3105,7 +3882,7 @@ class TestUserData(TestCase):
             "P123456;avilio.perez;TESTLASTNAME;TESTLASTNAME;TEST NAME;test@test.test")
 
     @patch('uchileedxlogin.views.check_permission_instructor_staff')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_staff_post_CG(self, get, mock_permission_check):
         """
             Test normal process with CG
@@ -3131,3 +3908,440 @@ class TestUserData(TestCase):
         self.assertEqual(
             data[1],
             "CG00123456;avilio.perez;TESTLASTNAME;TESTLASTNAME;TEST NAME;test@test.test")
+
+
+class TestPhClient(TestCase):
+    def setUp(self):
+        ph_client.close()
+        ph_client.breaker.reset()
+
+    @patch('requests.Session.get')
+    def test_ph_client_reuse_session(self, get):
+        """
+            Test that consecutive ph requests reuse the same pooled session
+        """
+        session = ph_client.session
+        ph_client.get((('indiv_id', '"0000000108"'),))
+        ph_client.get((('indiv_id', '"009472337K"'),))
+        self.assertIs(ph_client.session, session)
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(get.call_args_list[0][0][0], settings.EDXLOGIN_USER_INFO_URL)
+        self.assertEqual(get.call_args_list[1][1]['params'], (('indiv_id', '"009472337K"'),))
+
+    @patch('requests.Session.get')
+    def test_ph_client_timeout(self, get):
+        """
+            Test that every ph request is made with the configured connect/read timeout
+        """
+        ph_client.get((('indiv_id', '"0000000108"'),))
+        self.assertEqual(
+            get.call_args_list[0][1]['timeout'],
+            (settings.EDXLOGIN_PH_CONNECT_TIMEOUT, settings.EDXLOGIN_PH_READ_TIMEOUT))
+        self.assertEqual(get.call_args_list[0][1]['headers']['AppKey'], settings.EDXLOGIN_KEY)
+
+    def test_ph_client_close(self):
+        """
+            Test that closing the client builds a new session on the next request
+        """
+        session = ph_client.session
+        ph_client.close()
+        self.assertIsNot(ph_client.session, session)
+        self.assertEqual(ph_client.session.headers['Accept-Encoding'], 'gzip, deflate')
+
+
+    @override_settings(EDXLOGIN_PH_BREAKER_FAILURE_THRESHOLD=2)
+    @patch('requests.Session.get')
+    def test_ph_client_circuit_breaker_open(self, get):
+        """
+            Test that the circuit opens after consecutive failures and fails fast while open
+        """
+        get.side_effect = [
+            namedtuple("Request", ["status_code", "text"])(503, ''),
+            ConnectionError()]
+        ph_client.get((('indiv_id', '"0000000108"'),))
+        with self.assertRaises(ConnectionError):
+            ph_client.get((('indiv_id', '"0000000108"'),))
+        self.assertEqual(ph_client.breaker.stats()['state'], 'open')
+        with self.assertRaises(PhCircuitOpenException):
+            ph_client.get((('indiv_id', '"0000000108"'),))
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(ph_client.breaker.stats()['short_circuited'], 1)
+
+    @override_settings(EDXLOGIN_PH_BREAKER_FAILURE_THRESHOLD=1, EDXLOGIN_PH_BREAKER_RESET_TIMEOUT=0)
+    @patch('requests.Session.get')
+    def test_ph_client_circuit_breaker_half_open(self, get):
+        """
+            Test that a successful trial request closes the circuit and a failed one opens it again
+        """
+        get.side_effect = [
+            namedtuple("Request", ["status_code", "text"])(500, ''),
+            namedtuple("Request", ["status_code", "text"])(500, ''),
+            namedtuple("Request", ["status_code", "text"])(200, '')]
+        ph_client.get((('indiv_id', '"0000000108"'),))
+        self.assertEqual(ph_client.breaker.stats()['state'], 'open')
+        ph_client.get((('indiv_id', '"0000000108"'),))
+        self.assertEqual(ph_client.breaker.stats()['state'], 'open')
+        self.assertEqual(ph_client.breaker.stats()['trips'], 2)
+        ph_client.get((('indiv_id', '"0000000108"'),))
+        self.assertEqual(ph_client.breaker.stats()['state'], 'closed')
+
+    @override_settings(EDXLOGIN_PH_BREAKER_FAILURE_THRESHOLD=1, EDXLOGIN_PH_BREAKER_SLOW_CALL_THRESHOLD=-1)
+    @patch('requests.Session.get')
+    def test_ph_client_circuit_breaker_slow_calls(self, get):
+        """
+            Test that slow requests count as failures
+        """
+        get.side_effect = [namedtuple("Request", ["status_code", "text"])(200, '')]
+        ph_client.get((('indiv_id', '"0000000108"'),))
+        self.assertEqual(ph_client.breaker.stats()['state'], 'open')
+
+    @override_settings(EDXLOGIN_METRICS_BACKEND='memory', EDXLOGIN_PH_BREAKER_FAILURE_THRESHOLD=1)
+    @patch('requests.Session.get')
+    def test_circuit_breaker_metrics(self, get):
+        """
+            Test that the breaker state changes are emitted as a gauge
+        """
+        metrics.get_backend().reset()
+        ph_cache.clear()
+        get.side_effect = [namedtuple("Request", ["status_code", "text"])(500, '')]
+        with self.assertRaises(Exception):
+            get_user_data('0000000108', 'indiv_id')
+        backend = metrics.get_backend()
+        self.assertEqual(backend.gauges['uchileedxlogin.ph.breaker.state'], 2)
+        self.assertEqual(backend.counters['uchileedxlogin.ph.breaker.trips'], 1)
+        self.assertEqual(backend.counters['uchileedxlogin.ph.request.error'], 1)
+
+def ph_persona_response(params, **kwargs):
+    """
+    Build a ph api response for the doc_id queried in params.
+    """
+    doc_id = params[0][1].strip('"')
+    return namedtuple("Request",
+                      ["status_code",
+                       "json"])(200,
+                                lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[
+                                    {"paterno": "TESTLASTNAME",
+                                     "materno": "TESTLASTNAME",
+                                     'pasaporte': [{'usuario':'user.' + doc_id}],
+                                     "nombres": "TEST NAME",
+                                     'email': [{'email': doc_id + '@test.test'}],
+                                     "indiv_id": doc_id}]}}})
+
+
+class TestPhQuery(TestCase):
+    def setUp(self):
+        ph_cache.clear()
+        ph_client.breaker.reset()
+
+    @patch('requests.Session.get')
+    def test_get_user_data_many(self, get):
+        """
+            Test that get_user_data_many keeps the order of the values and queries repeated values once
+        """
+        get.side_effect = lambda url, params, **kwargs: ph_persona_response(params)
+        results = get_user_data_many(['0000000108', '009472337K', '0000000108'], 'indiv_id')
+        self.assertEqual([result.value for result in results], ['0000000108', '009472337K', '0000000108'])
+        self.assertEqual([result.data['username'] for result in results], ['user.0000000108', 'user.009472337K', 'user.0000000108'])
+        self.assertEqual(get.call_count, 2)
+
+    @patch('requests.Session.get')
+    def test_get_user_data_many_errors(self, get):
+        """
+            Test that a failed lookup is returned as an error without stopping the others
+        """
+        def side_effect(url, params, **kwargs):
+            if params[0][1] == '"0000000108"':
+                return namedtuple("Request", ["status_code", "text"])(500, '')
+            return ph_persona_response(params)
+        get.side_effect = side_effect
+        results = get_user_data_many(['0000000108', '009472337K'], 'indiv_id', max_workers=2)
+        self.assertIsNone(results[0].data)
+        self.assertIsInstance(results[0].error, Exception)
+        self.assertIsNone(results[1].error)
+        self.assertEqual(results[1].data['doc_id'], '009472337K')
+
+    @patch('requests.Session.get')
+    def test_get_user_data_cache(self, get):
+        """
+            Test that repeated lookups are served from the cache until invalidated
+        """
+        get.side_effect = lambda url, params, **kwargs: ph_persona_response(params)
+        user_data = get_user_data('0000000108', 'indiv_id')
+        user_data['nombreCompleto'] = 'changed by the caller'
+        self.assertEqual(get_user_data('0000000108', 'indiv_id'), {
+            'doc_id': '0000000108',
+            'username': 'user.0000000108',
+            'nombres': 'TEST NAME',
+            'apellidoPaterno': 'TESTLASTNAME',
+            'apellidoMaterno': 'TESTLASTNAME',
+            'emails': ['0000000108@test.test']})
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(ph_cache.stats()['hits'], 1)
+        ph_cache.invalidate(('indiv_id', '0000000108'))
+        get_user_data('0000000108', 'indiv_id')
+        self.assertEqual(get.call_count, 2)
+
+    @patch('requests.Session.get')
+    def test_get_user_data_cache_not_found(self, get):
+        """
+            Test that "persona not found" results are cached and errors are not
+        """
+        get.side_effect = [
+            namedtuple("Request", ["status_code", "text"])(500, ''),
+            namedtuple("Request",
+                       ["status_code",
+                        "json",
+                        "text"])(200,
+                                 lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[]}}},
+                                 '')]
+        with self.assertRaises(Exception):
+            get_user_data('0000000108', 'indiv_id')
+        with self.assertRaises(PhPersonaNotFoundException):
+            get_user_data('0000000108', 'indiv_id')
+        with self.assertRaises(PhPersonaNotFoundException):
+            get_user_data('0000000108', 'indiv_id')
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(ph_cache.stats()['not_found_hits'], 1)
+
+    @override_settings(EDXLOGIN_PH_CACHE_MAX_SIZE=2)
+    @patch('requests.Session.get')
+    def test_get_user_data_cache_eviction(self, get):
+        """
+            Test that the least recently used entry is evicted when the cache is full
+        """
+        get.side_effect = lambda url, params, **kwargs: ph_persona_response(params)
+        get_user_data('0000000108', 'indiv_id')
+        get_user_data('009472337K', 'indiv_id')
+        get_user_data('0000000108', 'indiv_id')
+        get_user_data('0090455788', 'indiv_id')
+        self.assertEqual(ph_cache.stats()['evictions'], 1)
+        get_user_data('0000000108', 'indiv_id')
+        self.assertEqual(get.call_count, 3)
+        get_user_data('009472337K', 'indiv_id')
+        self.assertEqual(get.call_count, 4)
+
+    @override_settings(EDXLOGIN_PH_CACHE_DJANGO_ALIAS='default')
+    @patch('uchileedxlogin.ph_cache.caches')
+    def test_ph_cache_django_backend_errors(self, caches):
+        """
+            Test that the ph cache keeps working with its in-process tier when the django cache fails
+        """
+        django_cache = caches.__getitem__.return_value
+        django_cache.get.side_effect = Exception()
+        django_cache.set.side_effect = Exception()
+        django_cache.delete.side_effect = Exception()
+        cache = PhCache()
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), (True, 'value'))
+        cache.invalidate('key')
+        self.assertEqual(cache.get('key'), (False, None))
+        self.assertEqual(django_cache.delete.call_count, 1)
+
+    @patch('requests.Session.get')
+    def test_get_persona_single_request(self, get):
+        """
+            Test that the sso check and the user data of a doc_id cost a single ph request
+        """
+        get.side_effect = lambda url, params, **kwargs: ph_persona_response(params)
+        self.assertTrue(check_doc_id_have_sso('0000000108'))
+        self.assertEqual(get_user_data('0000000108', 'indiv_id')['username'], 'user.0000000108')
+        self.assertEqual(get.call_count, 1)
+
+    @override_settings(EDXLOGIN_PH_BREAKER_FAILURE_THRESHOLD=1)
+    @patch('requests.Session.get')
+    def test_check_doc_id_have_sso_ph_unavailable(self, get):
+        """
+            Test that the sso check raises while ph is unavailable instead of returning False
+        """
+        get.side_effect = requests.exceptions.ConnectionError()
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            check_doc_id_have_sso('0000000108')
+        with self.assertRaises(PhCircuitOpenException):
+            check_doc_id_have_sso('0000000108')
+        self.assertEqual(check_doc_ids_have_sso(['0000000108', '009472337K']), {'0000000108': None, '009472337K': None})
+        self.assertEqual(get.call_count, 1)
+
+    @patch('requests.Session.get')
+    def test_get_persona_without_sso(self, get):
+        """
+            Test a persona without uchile account
+        """
+        get.side_effect = [namedtuple("Request",
+                                      ["status_code",
+                                       "json"])(200,
+                                                lambda:{'data':{'getRowsPersona':{'status_code':200,'persona':[
+                                                    {"paterno": "TESTLASTNAME",
+                                                     "materno": "TESTLASTNAME",
+                                                     'pasaporte': [],
+                                                     "nombres": "TEST NAME",
+                                                     'email': [{'email': 'test@test.test'}],
+                                                     "indiv_id": "0000000108"}]}}})]
+        persona = get_persona('0000000108', 'indiv_id')
+        self.assertFalse(persona.have_sso)
+        self.assertIsNone(persona.user_data['username'])
+        self.assertEqual(persona.user_data['emails'], ['test@test.test'])
+        self.assertFalse(check_doc_id_have_sso('0000000108'))
+        with self.assertRaises(PhPersonaNotFoundException):
+            get_user_data('0000000108', 'indiv_id')
+        self.assertEqual(get.call_count, 1)
+
+    @patch('requests.Session.get')
+    def test_get_user_data_single_flight(self, get):
+        """
+            Test that concurrent lookups of the same value share a single ph request
+        """
+        release = threading.Event()
+        def side_effect(url, params, **kwargs):
+            release.wait(5)
+            return ph_persona_response(params)
+        get.side_effect = side_effect
+        coalesced = ph_single_flight.coalesced
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(get_user_data('0000000108', 'indiv_id')))
+            for i in range(3)]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while ph_single_flight.coalesced < coalesced + 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual([user_data['username'] for user_data in results], ['user.0000000108'] * 3)
+
+    @override_settings(EDXLOGIN_PH_CACHE_DJANGO_ALIAS='default', EDXLOGIN_PH_SINGLE_FLIGHT_DISTRIBUTED=True)
+    @patch('requests.Session.get')
+    def test_get_user_data_single_flight_distributed(self, get):
+        """
+            Test that a lookup in progress in another process is awaited instead of repeated
+        """
+        key = ('indiv_id', '0000000108')
+        lock_key = '{}.lock'.format(PhCache.django_key(key))
+        caches['default'].delete(PhCache.django_key(key))
+        caches['default'].add(lock_key, 1, 10)
+        persona = PhPersona({
+            'doc_id': '0000000108',
+            'username': 'other.process',
+            'nombres': 'TEST NAME',
+            'apellidoPaterno': 'TESTLASTNAME',
+            'apellidoMaterno': 'TESTLASTNAME',
+            'emails': ['test@test.test']}, True)
+        publisher = threading.Timer(0.1, lambda: ph_cache.set(key, persona))
+        publisher.start()
+        try:
+            self.assertEqual(get_user_data('0000000108', 'indiv_id')['username'], 'other.process')
+        finally:
+            publisher.join()
+            caches['default'].delete(lock_key)
+            ph_cache.invalidate(key)
+        self.assertEqual(get.call_count, 0)
+
+
+class TestPhMirror(TestCase):
+    def setUp(self):
+        ph_cache.clear()
+        ph_client.breaker.reset()
+
+    def create_snapshot(self, doc_id, age=0, **kwargs):
+        return EdxLoginPersona.objects.create(
+            run=doc_id,
+            username=kwargs.get('username', 'local.' + doc_id),
+            nombres='LOCAL NAME',
+            apellido_paterno='LOCALLASTNAME',
+            apellido_materno='LOCALLASTNAME',
+            emails=json.dumps([doc_id + '@local.test']),
+            have_sso=kwargs.get('have_sso', True),
+            fetched_at=timezone.now() - timedelta(seconds=age))
+
+    @override_settings(EDXLOGIN_PH_PERSONA_MIRROR=True)
+    @patch('requests.Session.get')
+    def test_mirror_store_persona(self, get):
+        """
+            Test that the personas fetched from ph are stored and the ones not found are removed
+        """
+        self.create_snapshot('009472337K', age=100000)
+        get.side_effect = [
+            ph_persona_response((('indiv_id', '"0000000108"'),)),
+            namedtuple("Request", ["status_code", "json", "text"])(
+                200, lambda: {'data': {'getRowsPersona': {'status_code': 200, 'persona': []}}}, '')]
+        get_user_data('0000000108', 'indiv_id')
+        with self.assertRaises(PhPersonaNotFoundException):
+            get_user_data('009472337K', 'indiv_id')
+        snapshot = EdxLoginPersona.objects.get(run='0000000108')
+        self.assertEqual(snapshot.username, 'user.0000000108')
+        self.assertEqual(json.loads(snapshot.emails), ['0000000108@test.test'])
+        self.assertTrue(snapshot.have_sso)
+        self.assertFalse(EdxLoginPersona.objects.filter(run='009472337K').exists())
+
+    @override_settings(EDXLOGIN_PH_LOCAL_FIRST=True, EDXLOGIN_PH_PERSONA_MAX_AGE=3600)
+    @patch('requests.Session.get')
+    def test_local_first(self, get):
+        """
+            Test that fresh snapshots are served without ph requests and stale ones are fetched again
+        """
+        get.side_effect = lambda url, params, **kwargs: ph_persona_response(params)
+        self.create_snapshot('0000000108')
+        self.create_snapshot('009472337K', age=7200)
+        self.assertEqual(get_user_data('0000000108', 'indiv_id')['username'], 'local.0000000108')
+        self.assertEqual(get_user_data('local.0000000108', 'usuario')['doc_id'], '0000000108')
+        self.assertEqual(get.call_count, 0)
+        self.assertEqual(get_user_data('009472337K', 'indiv_id')['username'], 'user.009472337K')
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(EdxLoginPersona.objects.get(run='009472337K').username, 'user.009472337K')
+
+    @override_settings(EDXLOGIN_PH_LOCAL_FIRST=True, EDXLOGIN_PH_PERSONA_MAX_AGE=3600)
+    @patch('requests.Session.get')
+    def test_local_first_many(self, get):
+        """
+            Test that the concurrent lookups read and store the snapshots in the calling thread
+        """
+        get.side_effect = lambda url, params, **kwargs: ph_persona_response(params)
+        self.create_snapshot('0000000108')
+        self.create_snapshot('009472337K', age=7200)
+        with self.assertNumQueries(4):
+            results = get_user_data_many(['0000000108', '009472337K', '0090455788'], 'indiv_id', max_workers=3)
+        self.assertEqual([result.data['username'] for result in results],
+                         ['local.0000000108', 'user.009472337K', 'user.0090455788'])
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(EdxLoginPersona.objects.get(run='009472337K').username, 'user.009472337K')
+        self.assertEqual(EdxLoginPersona.objects.get(run='0090455788').username, 'user.0090455788')
+
+    @override_settings(EDXLOGIN_PH_LOCAL_FIRST=True)
+    @patch('requests.Session.get')
+    def test_local_first_without_sso(self, get):
+        """
+            Test that a snapshot without sso keeps raising in get_user_data
+        """
+        self.create_snapshot('0000000108', have_sso=False, username=None)
+        with self.assertRaises(PhPersonaNotFoundException):
+            get_user_data('0000000108', 'indiv_id')
+        self.assertFalse(check_doc_id_have_sso('0000000108'))
+        self.assertEqual(get.call_count, 0)
+
+    @patch('requests.Session.get')
+    def test_refresh_stale_personas(self, get):
+        """
+            Test that stale snapshots are refreshed or removed and fresh ones are not queried
+        """
+        def side_effect(url, params, **kwargs):
+            if params[0][1] == '"009472337K"':
+                return namedtuple("Request", ["status_code", "json", "text"])(
+                    200, lambda: {'data': {'getRowsPersona': {'status_code': 200, 'persona': []}}}, '')
+            if params[0][1] == '"0000000205"':
+                return namedtuple("Request", ["status_code", "text"])(500, '')
+            return ph_persona_response(params)
+        get.side_effect = side_effect
+        self.create_snapshot('0000000108', age=100000)
+        self.create_snapshot('009472337K', age=100000)
+        self.create_snapshot('0000000205', age=100000)
+        self.create_snapshot('0000000302')
+        result = refresh_stale_personas(older_than=3600, max_workers=1)
+        self.assertEqual(result, {'refreshed': 1, 'removed': 1, 'failed': 1})
+        self.assertEqual(get.call_count, 3)
+        snapshot = EdxLoginPersona.objects.get(run='0000000108')
+        self.assertEqual(snapshot.username, 'user.0000000108')
+        self.assertGreater(snapshot.fetched_at, timezone.now() - timedelta(seconds=60))
+        self.assertFalse(EdxLoginPersona.objects.filter(run='009472337K').exists())
+        self.assertEqual(EdxLoginPersona.objects.get(run='0000000205').username, 'local.0000000205')
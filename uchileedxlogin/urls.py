@@ -8,4 +8,5 @@ urlpatterns = [
     url('uchileedxlogin/staff/$', EdxLoginStaff.as_view(), name='staff'),
     url('uchileedxlogin/external/$', EdxLoginExternal.as_view(), name='external'),
     url('edxuserdata/data/', EdxLoginUserData.as_view(), name='data'),
+    url(r'uchileedxlogin/job/(?P<job_id>[0-9]+)/$', EdxLoginJobStatus.as_view(), name='job'),
 ]
@@ -4,19 +4,25 @@ import logging
 # Edx dependencies
 from common.djangoapps.student.helpers import do_create_account
 from django.contrib.auth.base_user import BaseUserManager
+from django.db import transaction
+from django.utils import timezone
 from openedx.core.djangoapps.user_authn.views.registration_form import AccountCreationForm
 
 # Internal project dependencies
 from uchileedxlogin.models import EdxLoginUser
+from uchileedxlogin.ph_cache import PhCache
+from uchileedxlogin.ph_query import fetch_persona
 from uchileedxlogin.utils import get_user_from_emails, generate_username, select_email
 
 logger = logging.getLogger(__name__)
 
-def create_user_by_data(user_data, email, password=None):
+def create_user_by_data(user_data, email, password=None, username=None):
     """
     Create an eol user using user_data, email and an optional password.
+    The username is generated from user_data if it's not given (e.g. by a UsernameAllocator).
     """
-    username = generate_username(user_data)
+    if username is None:
+        username = generate_username(user_data)
     if 'nombreCompleto' not in user_data:
         user_data['nombreCompleto'] = '{} {} {}'.format(user_data['nombres'], user_data['apellidoPaterno'], user_data['apellidoMaterno'])
     if not password:
@@ -37,17 +43,21 @@ def create_user_by_data(user_data, email, password=None):
     return user
 
 
-def create_edxlogin_user_by_data(user_data):
+def create_edxlogin_user_by_data(user_data, username_allocator=None, email_user=None):
     """
     Create an edxloginuser using user_data. 
     Returns None if a user can't be created due to not finding neither a suitable user nor email.
+    When many users are created together, the usernames can be taken from a UsernameAllocator,
+    and the user of the emails can be looked up beforehand (get_users_from_email_lists) and given
+    in email_user, False if there wasn't one.
     """
-    user = get_user_from_emails(user_data['emails'])
+    user = get_user_from_emails(user_data['emails']) if email_user is None else email_user
     if not user:
         email = select_email(user_data['emails'])
         if not email:
             return None
-        user = create_user_by_data(user_data, email, None)
+        username = username_allocator.allocate(user_data) if username_allocator else None
+        user = create_user_by_data(user_data, email, None, username=username)
     edxlogin_user = create_edxloginuser(user, True, user_data["doc_id"])
     return edxlogin_user
 
@@ -69,6 +79,43 @@ def create_edxloginuser(user, have_sso, doc_id):
         raise Exception(f"Failed to create EdxLoginUser object for user: {user}, have_sso: {have_sso} and doc_id: {doc_id}")
 
 
+def link_ph_username(edxlogin_user, ph_username):
+    """
+    Save ph_username as the uchile username of edxlogin_user, removing it from any other
+    edxloginuser that still has it.
+    Returns False if the link couldn't be saved.
+    """
+    try:
+        with transaction.atomic():
+            EdxLoginUser.objects.filter(ph_username=ph_username).exclude(pk=edxlogin_user.pk).update(
+                ph_username=None, ph_username_checked_at=None)
+            edxlogin_user.ph_username = ph_username
+            edxlogin_user.ph_username_checked_at = timezone.now()
+            edxlogin_user.save(update_fields=['ph_username', 'ph_username_checked_at'])
+        return True
+    except Exception as e:
+        logger.warning(f"Failed to link ph username: {ph_username} to doc_id: {edxlogin_user.run}, with error: {e}")
+        return False
+
+
+def refresh_ph_username(ph_username):
+    """
+    Check with ph which doc_id owns ph_username and move the link to the edxloginuser of that doc_id,
+    or remove it if ph doesn't have the username anymore or there isn't an edxloginuser with the doc_id
+    (the next login goes through ph then).
+    Returns the edxloginuser linked to ph_username, or None.
+    """
+    persona = fetch_persona(ph_username, 'usuario')
+    edxlogin_user = None
+    if persona != PhCache.NOT_FOUND and persona.have_sso:
+        edxlogin_user = EdxLoginUser.objects.filter(run=persona.user_data['doc_id']).first()
+    if edxlogin_user is None:
+        EdxLoginUser.objects.filter(ph_username=ph_username).update(ph_username=None, ph_username_checked_at=None)
+        return None
+    link_ph_username(edxlogin_user, ph_username)
+    return edxlogin_user
+
+
 # Model permissions
 def check_permission_instructor_staff(user):
     """
@@ -1,11 +1,12 @@
 # Python Standard Libraries
 import logging
 import re
-from itertools import cycle
 
 # Installed packages (via pip)
 import unidecode
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Q
 
 # Edx dependencies
 from common.djangoapps.student.models import CourseEnrollment, CourseEnrollmentAllowed
@@ -16,10 +17,15 @@ from lms.djangoapps.courseware.access import has_access
 from lms.djangoapps.courseware.courses import get_course_with_access
 
 # Internal project dependencies
-from uchileedxlogin.models import EdxLoginUser
+from uchileedxlogin.doc_ids import clean_doc_id, is_valid_doc_id
+from uchileedxlogin.models import EdxLoginUserCourseRegistration
+from uchileedxlogin.services.utils import get_document_type
 
 logger = logging.getLogger(__name__)
 
+PENDING_COURSES_LOCK_TIMEOUT = 300
+EMAIL_QUERY_BATCH_SIZE = 500
+
 def select_email(email_list):
     """
     Select an unused email from email_list following some criteria.
@@ -45,95 +51,231 @@ def select_email(email_list):
         return ''
 
 
+def get_used_emails(emails):
+    """
+    Return the emails of emails that some user already has (see select_email), with one query
+    per EMAIL_QUERY_BATCH_SIZE emails.
+    """
+    emails = list(set(emails))
+    used_emails = set()
+    for start in range(0, len(emails), EMAIL_QUERY_BATCH_SIZE):
+        used_emails.update(User.objects.filter(
+            email__in=emails[start:start + EMAIL_QUERY_BATCH_SIZE]).values_list('email', flat=True))
+    return used_emails
+
+
 def get_user_from_emails(email_list):
     """
     Check if there are any users associated with the given list of email addresses. 
     If multiple users are found, prioritize the @uchile.cl one, otherwise select whichever.
     """
-    exists_user = User.objects.filter(email__in=email_list)
-    if exists_user:
-        users_without_link = []
-        for user in exists_user:
-            if not EdxLoginUser.objects.filter(user=user).exists() and user.is_active:
-                if '@uchile.cl' in user.email:
-                    return user
-                else:
-                    users_without_link.append(user)
-        if users_without_link:
-            return users_without_link[0]
-    return None
+    return get_users_from_email_lists([email_list])[0]
+
+
+def get_users_from_email_lists(email_lists):
+    """
+    Bulk version of get_user_from_emails: return, for each email list of email_lists, the active
+    user without an edxloginuser that has one of the emails (the @uchile.cl one first), or None.
+    The users are fetched with one query per EMAIL_QUERY_BATCH_SIZE emails.
+    """
+    emails = list({email for email_list in email_lists for email in email_list})
+    users_by_email = {}
+    for start in range(0, len(emails), EMAIL_QUERY_BATCH_SIZE):
+        users = User.objects.filter(
+            email__in=emails[start:start + EMAIL_QUERY_BATCH_SIZE],
+            is_active=True,
+            edxloginuser__isnull=True).order_by('id')
+        for user in users:
+            # Emails are compared ignoring case, as the database does.
+            users_by_email.setdefault(user.email.lower(), []).append(user)
+    result = []
+    for email_list in email_lists:
+        users = []
+        for email in dict.fromkeys(email.lower() for email in email_list):
+            users.extend(users_by_email.get(email, []))
+        users.sort(key=lambda user: user.id)
+        result.append(next((user for user in users if '@uchile.cl' in user.email), users[0] if users else None))
+    return result
 
         
-def enroll_in_course(user, course, enroll, mode):
+def enroll_in_course(user, course_key, enroll, mode):
     """
-    Enroll a user in course with mode "mode", if enroll is true, directly creates an enrollment,
-    otherwise creates an enrollment allowed.
+    Enroll a user in the course course_key (a CourseKey) with mode "mode", if enroll is true,
+    directly creates an enrollment, otherwise creates an enrollment allowed.
     """
     if enroll:
         CourseEnrollment.enroll(
             user,
-            CourseKey.from_string(course),
+            course_key,
             mode=mode)
     else:
         CourseEnrollmentAllowed.objects.create(
-            course_id=CourseKey.from_string(course),
+            course_id=course_key,
             email=user.email,
             user=user)
 
 
+def get_enrolled_key(user, enroll):
+    """
+    Key of user in the pairs of get_enrolled_pairs.
+    """
+    return user.id if enroll else user.email
+
+
+def get_enrolled_pairs(users, course_keys, enroll, mode):
+    """
+    Return the set of pairs (get_enrolled_key(user), course_key) of the users of users already
+    enrolled with mode in the courses of course_keys if enroll is true, otherwise of the users
+    with an enrollment allowed in them.
+    """
+    if not users or not course_keys:
+        return set()
+    if enroll:
+        return set(CourseEnrollment.objects.filter(
+            user__in=users,
+            course_id__in=course_keys,
+            is_active=True,
+            mode=mode).values_list('user_id', 'course_id'))
+    return set(CourseEnrollmentAllowed.objects.filter(
+        course_id__in=course_keys,
+        email__in=[user.email for user in users]).values_list('email', 'course_id'))
+
+
+def bulk_enroll_in_courses(users, course_keys, enroll, mode):
+    """
+    Bulk version of enroll_in_course, for every user of users in every course of course_keys.
+    Enrollments still go through CourseEnrollment.enroll (for its signals), but only for the users
+    not already enrolled with mode. The enrollment allowed rows that don't exist yet are created
+    with one bulk_create.
+    """
+    if not users or not course_keys:
+        return
+    enrolled = get_enrolled_pairs(users, course_keys, enroll, mode)
+    if enroll:
+        for user in users:
+            for course_key in course_keys:
+                if (user.id, course_key) not in enrolled:
+                    CourseEnrollment.enroll(user, course_key, mode=mode)
+    else:
+        CourseEnrollmentAllowed.objects.bulk_create([
+            CourseEnrollmentAllowed(course_id=course_key, email=user.email, user=user)
+            for user in users for course_key in course_keys
+            if (user.email, course_key) not in enrolled])
+
+
+def bulk_register_pending_courses(doc_ids, course_keys, enroll, mode):
+    """
+    Save the pending registrations (EdxLoginUserCourseRegistration) of every doc_id of doc_ids in
+    every course of course_keys, applied when the user logs in for the first time.
+    Existing registrations for the same doc_id and course are updated instead of duplicated.
+    """
+    existing = {
+        (registration.run, registration.course): registration
+        for registration in EdxLoginUserCourseRegistration.objects.filter(run__in=doc_ids, course__in=course_keys)}
+    new_registrations = []
+    updated_registrations = []
+    for doc_id in doc_ids:
+        for course_key in course_keys:
+            registration = existing.get((doc_id, course_key))
+            if registration is None:
+                new_registrations.append(EdxLoginUserCourseRegistration(
+                    run=doc_id, course=course_key, mode=mode, auto_enroll=enroll))
+            elif registration.mode != mode or registration.auto_enroll != enroll:
+                registration.mode = mode
+                registration.auto_enroll = enroll
+                updated_registrations.append(registration)
+    EdxLoginUserCourseRegistration.objects.bulk_create(new_registrations)
+    EdxLoginUserCourseRegistration.objects.bulk_update(updated_registrations, ['mode', 'auto_enroll'])
+
+
+def apply_pending_registrations(edxlogin_user):
+    """
+    Enroll the user in its pending courses (EdxLoginUserCourseRegistration), removing each
+    registration once it's applied, so it's safe to run again after a failure.
+    Only one call per run is made at a time, returns None if another one is in progress
+    or the number of applied registrations.
+    """
+    lock_key = 'uchileedxlogin.pending_registrations.{}'.format(edxlogin_user.run)
+    if not cache.add(lock_key, 1, PENDING_COURSES_LOCK_TIMEOUT):
+        logger.info("The pending courses of run: {} are already being applied.".format(edxlogin_user.run))
+        return None
+    try:
+        registrations = EdxLoginUserCourseRegistration.objects.filter(run=edxlogin_user.run)
+        applied = 0
+        for item in registrations:
+            if item.auto_enroll:
+                CourseEnrollment.enroll(
+                    edxlogin_user.user, item.course, mode=item.mode)
+            else:
+                CourseEnrollmentAllowed.objects.get_or_create(
+                    course_id=item.course,
+                    email=edxlogin_user.user.email,
+                    defaults={'user': edxlogin_user.user})
+            item.delete()
+            applied += 1
+        return applied
+    finally:
+        cache.delete(lock_key)
+
+
 def validate_rut(rut):
     """
     Verify if the rut is valid.
     """
-    rut = rut.upper()
-    rut = rut.replace("-", "")
-    rut = rut.replace(".", "")
-    rut = rut.strip()
-    aux = rut[:-1]
-    dv = rut[-1:]
-    revertido = list(map(int, reversed(str(aux))))
-    factors = cycle(list(range(2, 8)))
-    s = sum(d * f for d, f in zip(revertido, factors))
-    res = (-s) % 11
-    if str(res) == dv:
-        return True
-    elif dv == "K" and res == 10:
-        return True
-    else:
-        return False
+    return is_valid_doc_id(clean_doc_id(rut), 'rut')
 
 
 def validate_all_doc_id_types(doc_id):
     """
-    Validate all document id types.
+    Validate all document id types, see doc_ids.is_valid_doc_id.
     """
     try:
-        if doc_id[0] == 'P':
-            if 5 > len(doc_id[1:]) or len(doc_id[1:]) > 20:
-                logger.error("Invalid Passport: {}".format(doc_id))
-                return False
-        elif doc_id[0:2] == 'CG':
-            if len(doc_id) != 10:
-                logger.error("Invalid CG: {}".format(doc_id))
-                return False
-        else:
-            if not validate_rut(doc_id):
-                logger.error("Invalid document_id: {}".format(doc_id))
-                return False
+        doc_id_type = get_document_type(doc_id)
     except Exception:
         logger.error("Invalid: {}".format(doc_id))
         return False
-    return True
+    if doc_id_type == 'rut':
+        valid = validate_rut(doc_id)
+    else:
+        valid = is_valid_doc_id(doc_id, doc_id_type)
+    if not valid:
+        logger.error("Invalid {}: {}".format(doc_id_type, doc_id))
+    return valid
+
 
 def validate_course(course_id):
     """
     Verify if a course associated with course_id exists.
     """
-    try:
-        course_key = CourseKey.from_string(course_id)
-        return CourseOverview.objects.filter(id=course_key).exists()
-    except InvalidKeyError:
-        return False
+    return course_id in validate_courses([course_id])
+
+
+def validate_courses(course_ids):
+    """
+    Verify which courses of course_ids exist, parsing each course_id once and checking them all
+    with a single query. Returns a dict with the CourseKey of each course_id that exists.
+    """
+    course_keys = {}
+    for course_id in course_ids:
+        try:
+            course_keys[course_id] = CourseKey.from_string(course_id)
+        except InvalidKeyError:
+            pass
+    if not course_keys:
+        return {}
+    existing = set(CourseOverview.objects.filter(
+        id__in=list(course_keys.values())).values_list('id', flat=True))
+    return {
+        course_id: course_key for course_id, course_key in course_keys.items()
+        if course_key in existing}
+
+
+USERNAME_MAX_LENGTH = 30
+USERNAME_MAX_SUFFIX = 10000
+# Max number of usernames checked in a single query.
+USERNAME_QUERY_BATCH_SIZE = 500
+# Max number of records prefetched by UsernameAllocator in a single query.
+USERNAME_ALLOCATOR_BATCH_SIZE = 100
 
 
 def generate_username(user_data):
@@ -147,9 +289,24 @@ def generate_username(user_data):
     3. return first_name[0] + "_" first_name[1..N][0..N] + "_" + last_name[0]
     4. return first_name[0] + "_" first_name[1..N][0..N] + "_" + last_name[0] + last_name[1..N][0..N]
     5. return first_name[0] + "_" + last_name[0] + N
+    The candidates of every case are generated first and checked against the existing usernames
+    with a few queries (see get_first_free_username).
     If a username can't be generated, raises an Exception.
     """
-    USERNAME_MAX_LENGTH = 30
+    candidates, numbered_prefix = get_username_candidates(user_data)
+    username = get_first_free_username(candidates) or get_first_free_numbered_username(numbered_prefix)
+    if username is None:
+        # Username cant be generated
+        raise Exception("Error generating username for user: {}".format(user_data))
+    return username
+
+
+def get_username_candidates(user_data):
+    """
+    Return a tuple (candidates, numbered_prefix) with the usernames of the cases 0 to 4 of
+    generate_username for user_data, in order of preference, and the prefix of the numbered
+    usernames tried after them.
+    """
     if 'nombreCompleto' in user_data:
         aux_username = unidecode.unidecode(user_data['nombreCompleto'].lower())
         aux_username = re.sub(r'[^a-zA-Z0-9\_]', ' ', aux_username)
@@ -161,13 +318,7 @@ def generate_username(user_data):
         # 0. Tries to create an username only using the first name and a number, in cases where
         # that name is the only name information in user_data.
         else:
-            if User.objects.filter(username=aux_username[0]).exists():
-                for i in range(1, 10000):
-                    name_tmp = aux_username[0] + str(i)
-                    if not User.objects.filter(username=name_tmp).exists():
-                        return name_tmp
-            else:
-                return aux_username[0]
+            return [aux_username[0]], aux_username[0]
     else:
         aux_last_name = ((user_data['apellidoPaterno'] or '') +
                         " " + (user_data['apellidoMaterno'] or '')).strip()
@@ -181,11 +332,23 @@ def generate_username(user_data):
     first_name = [x for x in aux_first_name if x != ''] or ['']
     last_name = [x for x in aux_last_name if x != ''] or ['']
 
+    # 5. Usernames using the first and last name and adding a number to the end.
+    first_and_last_name = first_name[0] + "_" + last_name[0]
+    # Truncate the name to assure that there is enough space to add numbers to the username.
+    trunctated_first_and_last_name = first_and_last_name[0:(USERNAME_MAX_LENGTH - 5)]
+    if trunctated_first_and_last_name[-1] == '_':
+        trunctated_first_and_last_name = trunctated_first_and_last_name[:-1]
+    return list(generate_username_candidates(first_name, last_name)), trunctated_first_and_last_name
+
+
+def generate_username_candidates(first_name, last_name):
+    """
+    Yield, in order of preference, the usernames of the cases 1 to 4 of generate_username.
+    """
     # 1. Tries to create an username using the first and last name.
     first_and_last_name = first_name[0] + "_" + last_name[0]
-    if len(first_and_last_name) <= USERNAME_MAX_LENGTH and not User.objects.filter(
-            username=first_and_last_name).exists():
-        return first_and_last_name
+    if len(first_and_last_name) <= USERNAME_MAX_LENGTH:
+        yield first_and_last_name
 
     # 2. Tries to create an username concatenating letters from the others last names to firstName_lastName.
     fist_and_last_names = first_and_last_name
@@ -195,8 +358,7 @@ def generate_username(user_data):
             fist_and_last_names = fist_and_last_names + last_name[i + 1][j]
             if len(fist_and_last_names) > USERNAME_MAX_LENGTH:
                 break
-            if not User.objects.filter(username=fist_and_last_names).exists():
-                return fist_and_last_names
+            yield fist_and_last_names
 
     # 3. Tries to create an username concatenating the first name, with letter of other names and 
     # the first last name.
@@ -208,8 +370,7 @@ def generate_username(user_data):
             first_names_and_last_name = first_names + "_" + last_name[0]
             if len(first_names_and_last_name) > USERNAME_MAX_LENGTH:
                 break
-            if not User.objects.filter(username=first_names_and_last_name).exists():
-                return first_names_and_last_name
+            yield first_names_and_last_name
 
     # 4. Tries to create an username by concatenating the first and last name, with the other first
     # and last names.
@@ -230,22 +391,86 @@ def generate_username(user_data):
                         last_name[second_index + 1][second_second_index]
                     if len(possible_name) > USERNAME_MAX_LENGTH:
                         break
-                    if not User.objects.filter(
-                            username=possible_name).exists():
-                        return possible_name
+                    yield possible_name
+
+
+def get_first_free_username(candidates):
+    """
+    Return the first of the candidates that isn't used by an existing user, or None.
+    The candidates are checked with one query per USERNAME_QUERY_BATCH_SIZE of them. The usernames
+    returned are matched ignoring case, because the query compares them with the collation of the
+    database (case insensitive in mysql), so a returned row is always one of the candidates up to case.
+    """
+    candidates = list(dict.fromkeys(candidates))
+    for start in range(0, len(candidates), USERNAME_QUERY_BATCH_SIZE):
+        batch = candidates[start:start + USERNAME_QUERY_BATCH_SIZE]
+        used = User.objects.filter(username__in=batch).values_list('username', flat=True)
+        used = {username.lower() for username in used}
+        for candidate in batch:
+            if candidate.lower() not in used:
+                return candidate
+    return None
+
+
+def get_first_free_numbered_username(prefix):
+    """
+    Return the first free username prefix + N, with N from 1 to USERNAME_MAX_SUFFIX - 1, or None.
+    """
+    return get_first_free_username(prefix + str(i) for i in range(1, USERNAME_MAX_SUFFIX))
+
+class UsernameAllocator(object):
+    """
+    Allocate the usernames of a batch of accounts created together, e.g.:
+
+        allocator = UsernameAllocator(user_data_list)
+        for user_data in user_data_list:
+            create_user_by_data(user_data, email, username=allocator.allocate(user_data))
+
+    The existing usernames that may collide with any record of the batch (its candidates and
+    numbered usernames, see generate_username) are fetched when it's created, with one query per
+    USERNAME_ALLOCATOR_BATCH_SIZE records. allocate then picks the usernames in memory, in the
+    same order of preference as generate_username, remembering the ones already handed out so
+    the accounts of the batch don't collide between them.
+    Usernames are compared ignoring case, so a username is never given if it matches an
+    existing one in any case.
+    """
+    def __init__(self, user_data_list):
+        self.used = set()
+        plans = [get_username_candidates(user_data) for user_data in user_data_list]
+        for start in range(0, len(plans), USERNAME_ALLOCATOR_BATCH_SIZE):
+            self.prefetch(plans[start:start + USERNAME_ALLOCATOR_BATCH_SIZE])
+
+    def prefetch(self, plans):
+        query = Q()
+        candidates = set()
+        for plan_candidates, numbered_prefix in plans:
+            candidates.update(candidate.lower() for candidate in plan_candidates)
+            if numbered_prefix:
+                query |= Q(username__istartswith=numbered_prefix)
+        for candidate in candidates:
+            query |= Q(username__iexact=candidate)
+        usernames = User.objects.filter(query).values_list('username', flat=True)
+        self.used.update(username.lower() for username in usernames)
+
+    def allocate(self, user_data):
+        """
+        Return a free username for user_data and reserve it.
+        If a username can't be generated, raises an Exception.
+        """
+        candidates, numbered_prefix = get_username_candidates(user_data)
+        if not numbered_prefix:
+            # Not prefetched, a username__startswith='' query would fetch every user.
+            candidates = candidates + [generate_username(user_data)]
+        username = next((candidate for candidate in candidates if candidate.lower() not in self.used), None)
+        if username is None:
+            username = next((
+                numbered_prefix + str(i) for i in range(1, USERNAME_MAX_SUFFIX)
+                if (numbered_prefix + str(i)).lower() not in self.used), None)
+        if username is None:
+            raise Exception("Error generating username for user: {}".format(user_data))
+        self.used.add(username.lower())
+        return username
 
-    # 5. Tries to create an username using the first and last name and adding a number to the end.
-    first_and_last_name = first_name[0] + "_" + last_name[0]
-    # Truncate the name to assure that there is enough space to add numbers to the username.
-    trunctated_first_and_last_name = first_and_last_name[0:(USERNAME_MAX_LENGTH - 5)]
-    if trunctated_first_and_last_name[-1] == '_':
-        trunctated_first_and_last_name = trunctated_first_and_last_name[:-1]
-    for i in range(1, 10000):
-        possible_name = trunctated_first_and_last_name + str(i)
-        if not User.objects.filter(username=possible_name).exists():
-            return possible_name
-    # Username cant be generated
-    raise Exception("Error generating username for user: {}".format(user_data))
 
 def is_course_staff(user, course_id):
     """
@@ -273,13 +498,39 @@ def validate_user(user, course_id):
     """
     Verify if the user have permission.
     """
-    access = False
-    if not user.is_anonymous:
-        if user.has_perm('uchileedxlogin.uchile_instructor_staff'):
-            if user.is_staff:
-                access = True
-            if is_instructor(user, course_id):
-                access = True
-            if is_course_staff(user, course_id):
-                access = True
-    return access
+    return CoursePermissionResolver(user).has_access(course_id)
+
+
+class CoursePermissionResolver(object):
+    """
+    Check if user can enroll/unenroll users in courses: it needs the uchile_instructor_staff
+    permission and be platform staff, or instructor or staff of the course.
+    Each course is loaded once and its result kept, so a resolver is meant to be used for a
+    single request. Platform staff don't need the course to be loaded.
+    """
+    def __init__(self, user):
+        self.user = user
+        self.results = {}
+
+    def has_access(self, course_id):
+        if course_id not in self.results:
+            self.results[course_id] = self.check_access(course_id)
+        return self.results[course_id]
+
+    def check_access(self, course_id):
+        user = self.user
+        if user.is_anonymous or not user.has_perm('uchileedxlogin.uchile_instructor_staff'):
+            return False
+        if user.is_staff:
+            return True
+        try:
+            course = get_course_with_access(user, "load", CourseKey.from_string(course_id))
+        except Exception:
+            return False
+        for access in ('instructor', 'staff'):
+            try:
+                if has_access(user, access, course):
+                    return True
+            except Exception:
+                pass
+        return False
@@ -5,13 +5,15 @@
 import base64
 import logging
 import re
+from collections import defaultdict
+from datetime import timedelta
 from urllib.parse import urlencode
 
 # Installed packages (via pip)
 import requests
 import unidecode
 import unicodecsv as csv
-from common.djangoapps.student.models import CourseEnrollment, CourseEnrollmentAllowed
+from common.djangoapps.student.models import CourseAccessRole, CourseEnrollment, CourseEnrollmentAllowed
 from common.djangoapps.util.json_request import JsonResponse
 from django.conf import settings
 from django.contrib.auth import login, logout
@@ -21,6 +23,8 @@ from django.db import transaction
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.shortcuts import render
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.decorators import method_decorator
 from django.views.generic.base import View
 
 # Edx dependencies
@@ -29,18 +33,36 @@ from opaque_keys.edx.keys import CourseKey
 from openedx.core.djangoapps.user_authn.utils import is_safe_login_or_logout_redirect
 
 # Internal project dependencies
+from . import metrics
+from .doc_ids import clean_doc_id, format_doc_id, is_valid_doc_id, parse_doc_ids
 from .email_tasks import enroll_email
-from .ph_query import check_doc_id_have_sso, get_user_data
-from .models import EdxLoginUserCourseRegistration
-from .services.interface import edxloginuser_factory, get_doc_id_by_user_id, get_user_by_doc_id
-from .users import check_permission_instructor_staff, create_edxloginuser, create_edxlogin_user_by_data, create_user_by_data
-from .utils import enroll_in_course, validate_all_doc_id_types, validate_course, validate_rut, validate_user
+from .ph_mirror import get_local_personas
+from .ph_query import check_doc_id_have_sso, check_doc_ids_have_sso, get_user_data, get_user_data_many, persona_mirror_enabled
+from .jobs import create_job, get_bulk_max_rows, get_job_status, merge_doc_id_saved, use_background_job
+from .models import EdxLoginJob, EdxLoginUser, EdxLoginUserCourseRegistration
+from .services.interface import edxloginuser_factory, get_doc_id_by_user_id, get_user_by_doc_id, get_user_by_ph_username, get_users_by_doc_ids
+from .services.utils import get_document_type
+from .tasks import enroll_pending_courses_task, refresh_ph_username_task, run_job_task
+from .users import check_permission_instructor_staff, create_edxloginuser, create_edxlogin_user_by_data, create_user_by_data, link_ph_username
+from .utils import CoursePermissionResolver, UsernameAllocator, apply_pending_registrations, bulk_enroll_in_courses, bulk_register_pending_courses, enroll_in_course, get_enrolled_key, get_enrolled_pairs, get_used_emails, get_users_from_email_lists, validate_courses
 
 logger = logging.getLogger(__name__)
 regex = r'^(([^ñáéíóú<>()\[\]\.,;:\s@\"]+(\.[^ñáéíóú<>()\[\]\.,;:\s@\"]+)*)|(\".+\"))@(([^ñáéíóú<>()[\]\.,;:\s@\"]+\.)+[^ñáéíóú<>()[\]\.,;:\s@\"]{2,})$'
 regex_names = r'^[A-Za-z\s\_]+$'
 
 
+# Actions of EdxLoginStaff.post, the dry runs return the plan of the action without saving it.
+STAFF_ACTIONS = ["enroll", "unenroll", "staff_enroll", "dry_run_enroll", "dry_run_unenroll", "dry_run_sync", "sync"]
+# Actions of the instructor dashboard, answered with json.
+STAFF_JSON_ACTIONS = ["enroll", "unenroll", "dry_run_enroll", "dry_run_unenroll", "dry_run_sync", "sync"]
+# Actions run as a background job when the request is large (see jobs.use_background_job).
+STAFF_JOB_ACTIONS = ["enroll", "staff_enroll", "sync"]
+# Course roles whose users are never removed by a sync.
+SYNC_KEPT_ROLES = ["staff", "instructor"]
+# have_sso of a doc_id not checked before the transaction of enroll_create_user.
+NOT_PREFETCHED = object()
+
+
 def require_post_action():
     """
     Checks for required parameters or renders a 400 error.
@@ -59,7 +81,7 @@ def require_post_action():
                 'parameters': ["action"],
                 'info': {"action": action},
             }
-            if action in ["enroll", "unenroll", "staff_enroll"]:
+            if action in STAFF_ACTIONS:
                 return func(*args, **kwargs)
             else:
                 return JsonResponse(error_response_data, status=400)
@@ -67,6 +89,55 @@ def require_post_action():
         return wrapped
     return decorator
 
+
+def get_user_job(user, job_id):
+    """
+    Get the job job_id of user, or raise Http404.
+    """
+    try:
+        return EdxLoginJob.objects.get(id=job_id, user=user)
+    except (EdxLoginJob.DoesNotExist, ValueError):
+        raise Http404()
+
+
+def get_job_status_context(job):
+    context = get_job_status(job)
+    context['status_url'] = reverse('uchileedxlogin-login:job', kwargs={'job_id': job.id})
+    return context
+
+
+def get_job_context(request, job_id, context):
+    """
+    Context of the staff/external page for the job job_id: its result once it's finished,
+    otherwise its progress (and partial result), polled by the page until it finishes.
+    """
+    job = get_user_job(request.user, job_id)
+    status = get_job_status_context(job)
+    if status['result']:
+        context = status['result']
+    if job.status != 'finished':
+        context['job'] = status
+    return context
+
+
+def queue_job(job):
+    """
+    Queue the task of job once it's committed.
+    """
+    transaction.on_commit(lambda: run_job_task.delay(job.id))
+
+
+class EdxLoginJobStatus(View):
+    """
+    Progress and (partial) result of a background staff or external job.
+    """
+    def get(self, request, job_id):
+        if check_permission_instructor_staff(request.user):
+            return JsonResponse(get_job_status_context(get_user_job(request.user, job_id)))
+        else:
+            raise Http404()
+
+
 class EdxLoginLoginRedirect(View):
     def get(self, request):
         redirect_url = request.GET.get('next', "/")
@@ -103,6 +174,22 @@ class EdxLoginLoginRedirect(View):
 
 class EdxLoginCallback(View):
     def get(self, request):
+        """
+        Log in the user of the cas ticket, measuring each stage of the login (see metrics.StageTimer).
+        """
+        self.timer = metrics.StageTimer('callback')
+        self.failure = None
+        with self.timer.stage('total'):
+            response = self.login_callback(request)
+        if self.failure is None:
+            metrics.increment('callback.success')
+        else:
+            metrics.increment('callback.failure.{}'.format(self.failure))
+        if getattr(settings, 'EDXLOGIN_SERVER_TIMING', False):
+            response['Server-Timing'] = self.timer.server_timing()
+        return response
+
+    def login_callback(self, request):
         ticket = request.GET.get('ticket')
         redirect_url = base64.b64decode(
             request.GET.get(
@@ -113,22 +200,27 @@ class EdxLoginCallback(View):
 
         if ticket is None:
             logger.exception("Error ticket")
+            self.failure = 'no_ticket'
             return HttpResponseRedirect(
                 '{}?next={}'.format(
                     error_url, redirect_url))
 
-        username = self.verify_state(request, ticket)
+        with self.timer.stage('verify_state'):
+            username = self.verify_state(request, ticket)
         if username is None:
             logger.exception("Error username ")
+            self.failure = 'invalid_ticket'
             return HttpResponseRedirect(
                 '{}?next={}'.format(
                     error_url, redirect_url))
         try:
             is_logged = self.login_user(request, username)
             if not is_logged:
+                self.failure = 'create_user'
                 return HttpResponseRedirect('{}?next={}'.format(error_url, redirect_url))
         except Exception:
             logger.exception("Error logging {}, with ticket: {}".format(username, ticket))
+            self.failure = 'error'
             return HttpResponseRedirect(
                 '{}?next={}'.format(
                     error_url, redirect_url))
@@ -164,57 +256,97 @@ class EdxLoginCallback(View):
         Log in the uchile user with the account linked to it, creating a eol account if there
         wasn't any associated to the user.
         """
-        user_data = get_user_data(username, 'usuario')
-        doc_id = user_data['doc_id']
-        edxlogin_user = get_user_by_doc_id(doc_id)
-        if not edxlogin_user:
-            try:
-               edxlogin_user = create_edxlogin_user_by_data(user_data)
-               if not edxlogin_user:
-                   logger.error(f"User can't be created because none of the mails are valid.")
-                   return False
-            except Exception as e:
-                logger.error(f'Error when trying to create edxloginuser with doc_id: {doc_id} and error: {e}')
-                return False
+        with self.timer.stage('user_lookup'):
+            edxlogin_user = self.get_returning_user(username)
+        if edxlogin_user is None:
+            with self.timer.stage('ph_lookup'):
+                user_data = get_user_data(username, 'usuario')
+            doc_id = user_data['doc_id']
+            edxlogin_user = get_user_by_doc_id(doc_id)
+            if not edxlogin_user:
+                try:
+                   with self.timer.stage('create_user'):
+                       edxlogin_user = create_edxlogin_user_by_data(user_data)
+                   if not edxlogin_user:
+                       logger.error(f"User can't be created because none of the mails are valid.")
+                       return False
+                except Exception as e:
+                    logger.error(f'Error when trying to create edxloginuser with doc_id: {doc_id} and error: {e}')
+                    return False
+            if getattr(settings, 'EDXLOGIN_FAST_LOGIN', True):
+                link_ph_username(edxlogin_user, username)
         if not edxlogin_user.have_sso:
             edxlogin_user.have_sso = True
             edxlogin_user.save()
-        self.enroll_pending_courses(edxlogin_user)
+        with self.timer.stage('pending_enrollments'):
+            self.enroll_pending_courses(edxlogin_user)
         if request.user.is_anonymous or request.user.id != edxlogin_user.user.id:
-            logout(request)
-            login(
-                request,
-                edxlogin_user.user,
-                backend="django.contrib.auth.backends.AllowAllUsersModelBackend",
-            )
+            with self.timer.stage('login'):
+                logout(request)
+                login(
+                    request,
+                    edxlogin_user.user,
+                    backend="django.contrib.auth.backends.AllowAllUsersModelBackend",
+                )
         return True
 
+    def get_returning_user(self, username):
+        """
+        Get the edxloginuser linked to the uchile username in a previous login, without querying ph.
+        If the link is older than EDXLOGIN_PH_USERNAME_MAX_AGE seconds, it's checked with ph in
+        the background. Returns None if the user must be looked up in ph.
+        """
+        if not getattr(settings, 'EDXLOGIN_FAST_LOGIN', True):
+            return None
+        edxlogin_user = get_user_by_ph_username(username)
+        if edxlogin_user is None:
+            return None
+        max_age = getattr(settings, 'EDXLOGIN_PH_USERNAME_MAX_AGE', 86400)
+        checked_at = edxlogin_user.ph_username_checked_at
+        if checked_at is None or timezone.now() - checked_at > timedelta(seconds=max_age):
+            try:
+                refresh_ph_username_task.delay(username)
+            except Exception:
+                logger.exception("Failed to queue the refresh of the ph username: {}".format(username))
+        return edxlogin_user
+
     def enroll_pending_courses(self, edxlogin_user):
         """
         Enroll the user in the pending courses, removing the enrollments when
         they are applied.
+        If EDXLOGIN_ASYNC_PENDING_ENROLLMENTS is set, they are applied by a celery task, queued
+        once the edxloginuser is committed so the worker can read it.
         """
-        registrations = EdxLoginUserCourseRegistration.objects.filter(
-            run=edxlogin_user.run)
-        for item in registrations:
-            if item.auto_enroll:
-                CourseEnrollment.enroll(
-                    edxlogin_user.user, item.course, mode=item.mode)
-            else:
-                CourseEnrollmentAllowed.objects.create(
-                    course_id=item.course,
-                    email=edxlogin_user.user.email,
-                    user=edxlogin_user.user)
-        registrations.delete()
+        if not EdxLoginUserCourseRegistration.objects.filter(run=edxlogin_user.run).exists():
+            return
+        if getattr(settings, 'EDXLOGIN_ASYNC_PENDING_ENROLLMENTS', False):
+            transaction.on_commit(lambda: self.queue_pending_courses(edxlogin_user))
+            return
+        apply_pending_registrations(edxlogin_user)
+
+    def queue_pending_courses(self, edxlogin_user):
+        """
+        Queue the celery task of the pending courses, if it fails they are applied here.
+        """
+        try:
+            enroll_pending_courses_task.delay(edxlogin_user.run)
+        except Exception:
+            logger.exception("Failed to queue the pending courses of run: {}".format(edxlogin_user.run))
+            apply_pending_registrations(edxlogin_user)
 
 
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
 class EdxLoginStaff(View):
     """
     Enroll/force enroll/unenroll user.
+    The requests aren't atomic, so the ph queries are made outside of any transaction and only
+    the writes are done in one (see enroll_or_create_users).
     """
     def get(self, request):
         if check_permission_instructor_staff(request.user):
             context = {'doc_ids': '', 'auto_enroll': True, 'modo': 'audit', 'curso':''}
+            if request.GET.get('job'):
+                context = get_job_context(request, request.GET['job'], context)
             return render(request, 'edxlogin/staff.html', context)
         else:
             raise Http404()
@@ -223,13 +355,8 @@ class EdxLoginStaff(View):
     def post(self, request):
         if check_permission_instructor_staff(request.user):
             action = request.POST.get("action", "")
-            doc_id_list = request.POST.get("doc_ids", "").split('\n')
-            # Document id formatting
-            doc_id_list = [doc_id.upper() for doc_id in doc_id_list]
-            doc_id_list = [doc_id.replace("-", "") for doc_id in doc_id_list]
-            doc_id_list = [doc_id.replace(".", "") for doc_id in doc_id_list]
-            doc_id_list = [doc_id.strip() for doc_id in doc_id_list]
-            doc_id_list = [doc_id for doc_id in doc_id_list if doc_id]
+            doc_ids = parse_doc_ids(request.POST.get("doc_ids", ""))
+            doc_id_list = [doc_id.value for doc_id in doc_ids]
 
             #  Verifies if auto-enroll is checked
             enroll = False
@@ -251,16 +378,31 @@ class EdxLoginStaff(View):
                 'modo': request.POST.get(
                     "modes",
                     None)}
-            context = self.validate_data(request.user, doc_id_list, context)
+            context = self.validate_data(request.user, doc_ids, context)
+            # A sync unenrolls everyone not in the form, so it must be confirmed (after its dry run).
+            if action == "sync" and not request.POST.getlist("confirm"):
+                context['error_sync_confirm'] = ''
             # Returns is there is at least one error
-            if len(context) > 5 and action not in ["enroll", "unenroll"]:
+            if len(context) > 5 and action not in STAFF_JSON_ACTIONS:
                 return render(request, 'edxlogin/staff.html', context)
-            if len(context) > 5 and action in ["enroll", "unenroll"]:
+            if len(context) > 5 and action in STAFF_JSON_ACTIONS:
                 return JsonResponse(context)
 
             list_course = context['curso'].split('\n')
             list_course = [course_id.strip() for course_id in list_course]
             list_course = [course_id for course_id in list_course if course_id]
+            if action in STAFF_JOB_ACTIONS and use_background_job(request, len(doc_id_list)):
+                job = create_job(request.user, action, {
+                    'course_ids': list_course,
+                    'mode': context['modo'],
+                    'doc_id_list': doc_id_list,
+                    'force': force,
+                    'enroll': enroll}, len(doc_id_list))
+                queue_job(job)
+                if action in STAFF_JSON_ACTIONS:
+                    return JsonResponse(get_job_status_context(job))
+                context = {'doc_ids': '', 'auto_enroll': enroll, 'modo': context['modo'], 'curso': '', 'job': get_job_status_context(job)}
+                return render(request, 'edxlogin/staff.html', context)
             if action in ["enroll", "staff_enroll"]:
                 context = self.enroll_or_create_users(
                     list_course, context['modo'], doc_id_list, force, enroll)
@@ -271,6 +413,18 @@ class EdxLoginStaff(View):
             elif action == "unenroll":
                 context = self.unenroll_user(list_course, doc_id_list)
                 return JsonResponse(context)
+            elif action == "dry_run_enroll":
+                context = self.plan_enroll(list_course, context['modo'], doc_id_list, force, enroll)
+                return JsonResponse(context)
+            elif action == "dry_run_unenroll":
+                context = self.plan_unenroll(list_course, doc_id_list)
+                return JsonResponse(context)
+            elif action == "dry_run_sync":
+                context = self.dry_run_sync(list_course, doc_id_list, enroll)
+                return JsonResponse(context)
+            elif action == "sync":
+                context = self.sync_roster(list_course, context['modo'], doc_id_list, force, enroll)
+                return JsonResponse(context)
             else:
                 #Cambiar este log, deberia ser algo como invalid action y nose si se deberia raisear un 404
                 logger.error("User doesn't have permission or is not staff, user: {}".format(request.user))
@@ -278,35 +432,15 @@ class EdxLoginStaff(View):
         else:
             raise Http404()
         
-    def validate_data(self, user, doc_id_list, context):
+    def validate_data(self, user, doc_ids, context):
         """
         Verify if the data if valid.
         """
-        invalid_doc_ids = ""
-        original_doc_ids = []
-        duplicate_doc_ids = []
         original_courses = []
         duplicate_courses = []
         # doc_id validation
-        for doc_id in doc_id_list:
-            try:
-                if doc_id[0] == 'P':
-                    if 5 > len(doc_id[1:]) or len(doc_id[1:]) > 20:
-                        invalid_doc_ids += doc_id + " - "
-                elif doc_id[0:2] == 'CG':
-                    if len(doc_id) != 10:
-                        invalid_doc_ids += doc_id + " - "
-                else:
-                    if not validate_rut(doc_id):
-                        invalid_doc_ids += doc_id + " - "
-                if doc_id in original_doc_ids:
-                    duplicate_doc_ids.append(doc_id)
-                else:
-                    original_doc_ids.append(doc_id)
-            except Exception:
-                invalid_doc_ids += doc_id + " - "
-
-        invalid_doc_ids = invalid_doc_ids[:-3]
+        invalid_doc_ids = " - ".join(doc_id.cleaned for doc_id in doc_ids if not doc_id.valid)
+        duplicate_doc_ids = [doc_id.cleaned for doc_id in doc_ids if doc_id.duplicate]
 
         # Other fields validation
         # If there is a wrong doc_id
@@ -322,20 +456,22 @@ class EdxLoginStaff(View):
             list_course = context['curso'].split('\n')
             list_course = [course_id.strip() for course_id in list_course]
             list_course = [course_id for course_id in list_course if course_id]
+            valid_courses = validate_courses(list_course)
             for course_id in list_course:
                 if course_id in original_courses:
                     duplicate_courses.append(course_id)
                 else:
                     original_courses.append(course_id)
-                if not validate_course(course_id):
+                if course_id not in valid_courses:
                     if 'error_curso' not in context:
                         context['error_curso'] = [course_id]
                     else:
                         context['error_curso'].append(course_id)
                     logger.error("EdxLoginStaff - Course doesn't exists, user: {}, course_id: {}".format(user.id, course_id))
             if 'error_curso' not in context:
+                permissions = CoursePermissionResolver(user)
                 for course_id in list_course:
-                    if not validate_user(user, course_id):
+                    if not permissions.has_access(course_id):
                         if 'error_permission' not in context:
                             context['error_permission'] = [course_id]
                         else:
@@ -344,65 +480,106 @@ class EdxLoginStaff(View):
         if len(duplicate_courses) > 0:
             context['duplicate_courses'] = duplicate_courses
         # If there was no doc_id
-        if not doc_id_list:
+        if not doc_ids:
             context['no_doc_id'] = ''
+        # If there are more doc_ids than the limit of a request
+        if len(doc_ids) > get_bulk_max_rows():
+            logger.error("EdxLoginStaff - data limit is {}, length data: {} user: {}".format(get_bulk_max_rows(), len(doc_ids), user.id))
+            context['limit_data'] = ''
         # If the mode is incorrect
         if not context['modo'] in [
                 x[0] for x in EdxLoginUserCourseRegistration.MODE_CHOICES]:
             context['error_mode'] = ''
         # If action is incorrect
-        if not context['action'] in [
-                "enroll",
-                "unenroll",
-                "staff_enroll"]:
+        if not context['action'] in STAFF_ACTIONS:
             context['error_action'] = ''
         return context
         
 
-    def enroll_or_create_users(self, course_ids, mode, doc_id_list, force, enroll):
+    def enroll_or_create_users(self, course_ids, mode, doc_id_list, force, enroll, checkpoint=None):
+        """
+        Enroll/force enroll users, doc_id_list has canonical doc_ids (see doc_ids.parse_doc_ids).
+        Everything that is read from ph and the database is fetched first, then the users are
+        created and enrolled in a short transaction, measuring both stages (see metrics.StageTimer).
+        Each user is created in its own savepoint, if it fails the doc_id is left pending.
+        checkpoint(context, outcomes) is called at the end of the transaction, with the outcome
+        ('enroll', 'force' or 'pending') of each doc_id, to save the progress of a job with the rows.
+        """
+        timer = metrics.StageTimer('staff_enroll')
+        course_keys = [CourseKey.from_string(course_id) for course_id in course_ids]
+        edxlogin_users = get_users_by_doc_ids(doc_id_list)
+        # Get the ph data of the doc_ids without an edxloginuser concurrently, before
+        # creating them one by one.
+        ph_data = {}
+        with timer.stage('ph_prefetch'):
+            if force:
+                missing_doc_ids = [doc_id for doc_id in doc_id_list if doc_id not in edxlogin_users]
+                for result in get_user_data_many(missing_doc_ids, 'indiv_id'):
+                    if result.error is None:
+                        ph_data[result.value] = result.data
+                    else:
+                        logger.warning("Failed to get ph data for doc_id: {}, with error: {}".format(result.value, result.error))
+        username_allocator = UsernameAllocator(list(ph_data.values()))
+        email_users = dict(zip(ph_data, get_users_from_email_lists(
+            [user_data['emails'] for user_data in ph_data.values()])))
+        linked_user_ids = set()
+        created_doc_ids = set()
+        # guarda el form
+        with timer.stage('transaction'), transaction.atomic():
+            for doc_id in doc_id_list:
+                if doc_id in edxlogin_users or doc_id not in ph_data:
+                    continue
+                email_user = email_users[doc_id] or False
+                if email_user and email_user.id in linked_user_ids:
+                    # Already linked to another doc_id of the list, look it up again.
+                    email_user = None
+                try:
+                    with transaction.atomic():
+                        edxlogin_user = edxloginuser_factory(
+                            doc_id, 'doc_id', user_data=ph_data[doc_id],
+                            username_allocator=username_allocator, email_user=email_user)
+                except Exception as e:
+                    logger.warning("Failed to create the user of doc_id: {}, with error: {}".format(doc_id, e))
+                    continue
+                edxlogin_users[doc_id] = edxlogin_user
+                linked_user_ids.add(edxlogin_user.user_id)
+                created_doc_ids.add(doc_id)
+            bulk_enroll_in_courses(
+                [edxlogin_user.user for edxlogin_user in edxlogin_users.values()], course_keys, enroll, mode)
+            pending_doc_ids = [doc_id for doc_id in doc_id_list if doc_id not in edxlogin_users]
+            bulk_register_pending_courses(pending_doc_ids, course_keys, enroll, mode)
+            context, outcomes = self.saved_report(doc_id_list, edxlogin_users, created_doc_ids, enroll)
+            if checkpoint is not None:
+                checkpoint(context, outcomes)
+        return context
+
+    def saved_report(self, doc_id_list, edxlogin_users, created_doc_ids, enroll):
         """
-        Enroll/force enroll users.
+        Context of the staff view once the doc_ids are enrolled, and the outcome of each doc_id.
         """
         doc_id_saved_force = ""
         doc_id_saved_force_no_auto = ""
         doc_id_saved_pending = ""
         doc_id_saved_enroll = ""
         doc_id_saved_enroll_no_auto = ""
-        # guarda el form
-        with transaction.atomic():
-            for doc_id in doc_id_list:
-                while len(doc_id) < 10 and 'P' != doc_id[0] and 'CG' != doc_id[0:2]:
-                    doc_id = "0" + doc_id
-                edxlogin_user = get_user_by_doc_id(doc_id)
-                if edxlogin_user:
-                    for course_id in course_ids:
-                        enroll_in_course(edxlogin_user.user, course_id, enroll, mode)
-                    if enroll:
-                        doc_id_saved_enroll += edxlogin_user.user.username + " - " + doc_id + " / "
-                    else:
-                        doc_id_saved_enroll_no_auto += edxlogin_user.user.username + " - " + doc_id + " / "
+        outcomes = []
+        for doc_id in doc_id_list:
+            edxlogin_user = edxlogin_users.get(doc_id)
+            if edxlogin_user is None:
+                doc_id_saved_pending += doc_id + " - "
+                outcomes.append('pending')
+            elif doc_id in created_doc_ids:
+                if enroll:
+                    doc_id_saved_force += edxlogin_user.user.username + " - " + doc_id + " / "
                 else:
-                    if force:
-                        try:
-                            edxlogin_user = edxloginuser_factory(doc_id, 'doc_id')
-                        except:
-                            pass
-                    if edxlogin_user:
-                        for course_id in course_ids:
-                            enroll_in_course(edxlogin_user.user, course_id, enroll, mode)
-                        if enroll:
-                            doc_id_saved_force += edxlogin_user.user.username + " - " + doc_id + " / "
-                        else:
-                            doc_id_saved_force_no_auto += edxlogin_user.user.username + " - " + doc_id + " / "
-                    else:
-                        for course_id in course_ids:
-                            registro = EdxLoginUserCourseRegistration()
-                            registro.run = doc_id
-                            registro.course = course_id
-                            registro.mode = mode
-                            registro.auto_enroll = enroll
-                            registro.save()
-                        doc_id_saved_pending += doc_id + " - "
+                    doc_id_saved_force_no_auto += edxlogin_user.user.username + " - " + doc_id + " / "
+                outcomes.append('force')
+            else:
+                if enroll:
+                    doc_id_saved_enroll += edxlogin_user.user.username + " - " + doc_id + " / "
+                else:
+                    doc_id_saved_enroll_no_auto += edxlogin_user.user.username + " - " + doc_id + " / "
+                outcomes.append('enroll')
         doc_id_saved = {
             'doc_id_saved_force': doc_id_saved_force[:-3],
             'doc_id_saved_pending': doc_id_saved_pending[:-3],
@@ -410,54 +587,229 @@ class EdxLoginStaff(View):
             'doc_id_saved_enroll_no_auto': doc_id_saved_enroll_no_auto[:-3],
             'doc_id_saved_force_no_auto': doc_id_saved_force_no_auto[:-3]
         }
-        return {
+        context = {
             'doc_ids': '',
             'curso': '',
             'auto_enroll': True,
             'modo': 'audit',
             'saved': 'saved',
             'doc_id_saved': doc_id_saved}
+        return context, outcomes
 
-    def unenroll_user(self, course_ids, doc_id_list):
+    def plan_enroll(self, course_ids, mode, doc_id_list, force, enroll):
         """
-        Unenroll user.
+        Dry run of enroll_or_create_users, returns the same context it would return without saving
+        anything. ph isn't queried: the users to create are planned from the persona mirror (see
+        ph_mirror.get_local_personas) if it's enabled, and the doc_ids to create without a fresh
+        snapshot there (every one of them without the mirror) are returned in doc_id_unknown.
+        doc_id_enrolled has the doc_ids already enrolled (or allowed) in every course with mode.
         """
         course_keys = [CourseKey.from_string(course_id) for course_id in course_ids]
-        doc_id_list_format = []
-        doc_id_unenroll_pending = []
-        doc_id_unenroll_allowed = []
-        doc_id_unenroll_enroll = []
+        edxlogin_users = get_users_by_doc_ids(doc_id_list)
+        personas = {}
+        unknown = set()
+        if force:
+            new_doc_ids = [doc_id for doc_id in doc_id_list if doc_id not in edxlogin_users]
+            if persona_mirror_enabled():
+                personas = get_local_personas(new_doc_ids)
+            unknown = set(new_doc_ids) - set(personas)
+        doc_id_unknown = [doc_id for doc_id in doc_id_list if doc_id in unknown]
+        ph_data = {doc_id: persona.user_data for doc_id, persona in personas.items() if persona.have_sso}
+        username_allocator = UsernameAllocator(list(ph_data.values()))
+        email_users = dict(zip(ph_data, get_users_from_email_lists(
+            [user_data['emails'] for user_data in ph_data.values()])))
+        used_emails = get_used_emails([email for user_data in ph_data.values() for email in user_data['emails']])
+        planned_users = dict(edxlogin_users)
+        linked_user_ids = set(edxlogin_user.user_id for edxlogin_user in edxlogin_users.values())
         for doc_id in doc_id_list:
-            while len(doc_id) < 10 and 'P' != doc_id[0] and 'CG' != doc_id[0:2]:
-                doc_id = "0" + doc_id
-            doc_id_list_format.append(doc_id)
+            if doc_id not in ph_data:
+                continue
+            user = email_users[doc_id]
+            if user is None or user.id in linked_user_ids:
+                # Like select_email, the user is created only if one of its emails is unused.
+                if not set(ph_data[doc_id]['emails']) - used_emails:
+                    continue
+                user = User(username=username_allocator.allocate(ph_data[doc_id]))
+            else:
+                linked_user_ids.add(user.id)
+            planned_users[doc_id] = EdxLoginUser(user=user, run=doc_id)
+        enrolled = get_enrolled_pairs(
+            [edxlogin_user.user for edxlogin_user in edxlogin_users.values()], course_keys, enroll, mode)
+        context, _ = self.saved_report(
+            [doc_id for doc_id in doc_id_list if doc_id not in doc_id_unknown],
+            planned_users, set(planned_users) - set(edxlogin_users), enroll)
+        context['dry_run'] = True
+        context['doc_id_unknown'] = doc_id_unknown
+        context['doc_id_enrolled'] = [
+            doc_id for doc_id in doc_id_list
+            if doc_id in edxlogin_users and all(
+                (get_enrolled_key(edxlogin_users[doc_id].user, enroll), course_key) in enrolled
+                for course_key in course_keys)]
+        return context
+
+    def sync_roster(self, course_ids, mode, doc_id_list, force, enroll):
+        """
+        Make the roster of each course of course_ids (the doc_ids enrolled, allowed or pending in
+        it) match doc_id_list: the doc_ids missing in a course are enrolled like in
+        enroll_or_create_users and the doc_ids not in doc_id_list are unenrolled like in
+        unenroll_user, except the staff and instructors of the course (see plan_sync). Doc_ids
+        already in the roster are left as they are (e.g. with another mode), so syncing the same
+        roster again only makes the reads of get_course_rosters.
+        Courses with the same doc_ids to add or remove are synced together.
+        """
+        doc_id_sync = self.plan_sync(course_ids, doc_id_list, enroll)
+        doc_id_saved = {}
+        for added, add_course_ids in self.group_sync_courses(doc_id_sync, 'added').items():
+            context = self.enroll_or_create_users(add_course_ids, mode, list(added), force, enroll)
+            merge_doc_id_saved(doc_id_saved, context['doc_id_saved'])
+        for removed, remove_course_ids in self.group_sync_courses(doc_id_sync, 'removed').items():
+            self.unenroll_user(remove_course_ids, list(removed))
+        return self.sync_report(doc_id_sync, doc_id_saved)
+
+    def dry_run_sync(self, course_ids, doc_id_list, enroll):
+        """
+        Dry run of sync_roster, returns the doc_ids it would add and remove in each course
+        without saving anything.
+        """
+        context = self.sync_report(self.plan_sync(course_ids, doc_id_list, enroll), {})
+        context['dry_run'] = True
+        return context
+
+    def plan_sync(self, course_ids, doc_id_list, enroll):
+        """
+        Return the doc_ids to add to and remove from each course of course_ids so its roster
+        matches doc_id_list, as a dict by course_id with the 'added' and 'removed' lists.
+        If enroll is set, the doc_ids only allowed in a course are added (enrolled) too.
+        """
+        course_keys = [CourseKey.from_string(course_id) for course_id in course_ids]
+        rosters, enrolled, kept = self.get_course_rosters(course_keys, enroll)
+        target = set(doc_id_list)
+        doc_id_sync = {}
+        for course_id, course_key in zip(course_ids, course_keys):
+            doc_id_sync[course_id] = {
+                'added': [doc_id for doc_id in doc_id_list if doc_id not in enrolled[course_key]],
+                'removed': sorted(rosters[course_key] - target - kept[course_key])}
+        return doc_id_sync
+
+    def group_sync_courses(self, doc_id_sync, key):
+        """
+        Group the courses of doc_id_sync by their doc_ids to add or remove (key), returning a
+        dict with the course_ids of each tuple of doc_ids.
+        """
+        courses = defaultdict(list)
+        for course_id, sync in doc_id_sync.items():
+            if sync[key]:
+                courses[tuple(sync[key])].append(course_id)
+        return courses
+
+    def sync_report(self, doc_id_sync, doc_id_saved):
+        """
+        Context of the staff view once the rosters are synced.
+        """
+        return {
+            'doc_ids': '',
+            'curso': '',
+            'auto_enroll': True,
+            'modo': 'audit',
+            'saved': 'sync',
+            'doc_id_saved': merge_doc_id_saved({
+                'doc_id_saved_force': '',
+                'doc_id_saved_pending': '',
+                'doc_id_saved_enroll': '',
+                'doc_id_saved_enroll_no_auto': '',
+                'doc_id_saved_force_no_auto': ''}, doc_id_saved),
+            'doc_id_sync': doc_id_sync}
+
+    def get_course_rosters(self, course_keys, enroll):
+        """
+        Return the doc_ids enrolled (active enrollments), allowed or pending in each course of
+        course_keys, the ones of them that don't need to be enrolled again (the allowed ones do
+        if enroll is set), and the doc_ids of its staff and instructors, as dicts of sets by
+        course key.
+        It makes the same four queries for any number of courses and doc_ids.
+        """
+        rosters = {course_key: set() for course_key in course_keys}
+        enrolled = {course_key: set() for course_key in course_keys}
+        kept = {course_key: set() for course_key in course_keys}
+        active = CourseEnrollment.objects.filter(
+            course_id__in=course_keys, is_active=True, user__edxloginuser__isnull=False).values_list(
+            'course_id', 'user__edxloginuser__run')
+        allowed = CourseEnrollmentAllowed.objects.filter(
+            course_id__in=course_keys, user__edxloginuser__isnull=False).values_list(
+            'course_id', 'user__edxloginuser__run')
+        pending = EdxLoginUserCourseRegistration.objects.filter(
+            course__in=course_keys).values_list('course', 'run')
+        for rows, is_enrolled in ((active, True), (allowed, not enroll), (pending, True)):
+            for course_key, doc_id in rows:
+                rosters[course_key].add(doc_id)
+                if is_enrolled:
+                    enrolled[course_key].add(doc_id)
+        staff = CourseAccessRole.objects.filter(
+            course_id__in=course_keys, role__in=SYNC_KEPT_ROLES, user__edxloginuser__isnull=False).values_list(
+            'course_id', 'user__edxloginuser__run')
+        for course_key, doc_id in staff:
+            kept[course_key].add(doc_id)
+        return rosters, enrolled, kept
+
+    def unenroll_user(self, course_ids, doc_id_list):
+        """
+        Unenroll user, doc_id_list has canonical doc_ids (see doc_ids.parse_doc_ids).
+        The doc_ids of each kind of enrollment are fetched with a join, so the number of queries
+        doesn't depend on the number of doc_ids and courses.
+        """
+        course_keys = [CourseKey.from_string(course_id) for course_id in course_ids]
 
         with transaction.atomic():
+            querysets = self.unenroll_querysets(course_keys, doc_id_list)
+            registrations, enrollment_allowed, enrollments = querysets
+            doc_id_unenroll_pending, doc_id_unenroll_allowed, doc_id_unenroll_enroll = self.unenroll_doc_ids(querysets)
             #unenroll EdxLoginUserCourseRegistration
-            registrations = EdxLoginUserCourseRegistration.objects.filter(
-                run__in=doc_id_list_format, course__in=course_keys)
-            if registrations:
-                doc_id_unenroll_pending = [x.run for x in registrations]
+            if doc_id_unenroll_pending:
                 registrations.delete()
             #unenroll CourseEnrollmentAllowed
-            enrollmentAllowed = CourseEnrollmentAllowed.objects.filter(
-                course_id__in=course_keys, user__edxloginuser__run__in=doc_id_list_format)
-            if enrollmentAllowed:
-                doc_id_unenroll_allowed = [x.user.edxloginuser.run for x in enrollmentAllowed]
-                enrollmentAllowed.delete()
+            if doc_id_unenroll_allowed:
+                enrollment_allowed.delete()
             #unenroll CourseEnrollment
-            enrollment = CourseEnrollment.objects.filter(user__edxloginuser__run__in=doc_id_list_format, course_id__in=course_keys)
-            if enrollment:
-                doc_id_unenroll_enroll = [x.user.edxloginuser.run for x in enrollment]
-                enrollment.update(is_active=0)
-        aux_doc_id_unenroll = doc_id_unenroll_pending
-        aux_doc_id_unenroll.extend(doc_id_unenroll_allowed)
-        aux_doc_id_unenroll.extend(doc_id_unenroll_enroll)
-        doc_id_unenroll = []
-        for i in aux_doc_id_unenroll:
-            if i not in doc_id_unenroll:
-                doc_id_unenroll.append(i)
-        doc_id_unenroll_no_exists = [x for x in doc_id_list_format if x not in doc_id_unenroll]
+            if doc_id_unenroll_enroll:
+                enrollments.update(is_active=0)
+        return self.unenroll_report(
+            doc_id_list, doc_id_unenroll_pending | doc_id_unenroll_allowed | doc_id_unenroll_enroll)
+
+    def plan_unenroll(self, course_ids, doc_id_list):
+        """
+        Dry run of unenroll_user, returns the same context it would return without saving anything.
+        """
+        course_keys = [CourseKey.from_string(course_id) for course_id in course_ids]
+        unenrolled = set().union(*self.unenroll_doc_ids(self.unenroll_querysets(course_keys, doc_id_list)))
+        context = self.unenroll_report(doc_id_list, unenrolled)
+        context['dry_run'] = True
+        return context
+
+    def unenroll_querysets(self, course_keys, doc_id_list):
+        """
+        Return the pending registrations, enrollments allowed and enrollments of doc_id_list in course_keys.
+        """
+        return (
+            EdxLoginUserCourseRegistration.objects.filter(run__in=doc_id_list, course__in=course_keys),
+            CourseEnrollmentAllowed.objects.filter(course_id__in=course_keys, user__edxloginuser__run__in=doc_id_list),
+            CourseEnrollment.objects.filter(user__edxloginuser__run__in=doc_id_list, course_id__in=course_keys))
+
+    def unenroll_doc_ids(self, querysets):
+        """
+        Return the sets of doc_ids of the querysets of unenroll_querysets.
+        """
+        registrations, enrollment_allowed, enrollments = querysets
+        return (
+            set(registrations.values_list('run', flat=True)),
+            set(enrollment_allowed.values_list('user__edxloginuser__run', flat=True)),
+            set(enrollments.values_list('user__edxloginuser__run', flat=True)))
+
+    def unenroll_report(self, doc_id_list, unenrolled):
+        """
+        Context of the staff view once the doc_ids of unenrolled are unenrolled.
+        """
+        doc_id_unenroll = [doc_id for doc_id in doc_id_list if doc_id in unenrolled]
+        doc_id_unenroll_no_exists = [doc_id for doc_id in doc_id_list if doc_id not in unenrolled]
         return {
             'doc_ids': '',
             'auto_enroll': True,
@@ -467,13 +819,17 @@ class EdxLoginStaff(View):
             'doc_id_unenroll': doc_id_unenroll}
 
 
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
 class EdxLoginExternal(View):
     """
         Enroll external user
+        The requests aren't atomic, the ph queries are made before the transaction of enroll_create_user.
     """
     def get(self, request):
         if check_permission_instructor_staff(request.user):
             context = {'datos': '', 'auto_enroll': True, 'modo': 'honor', 'send_email': True, 'curso': ''}
+            if request.GET.get('job'):
+                context = get_job_context(request, request.GET['job'], context)
             return render(request, 'edxlogin/external.html', context)
         else:
             raise Http404()
@@ -508,58 +864,91 @@ class EdxLoginExternal(View):
             list_course = [course_id.strip() for course_id in list_course]
             list_course = [course_id for course_id in list_course if course_id]
 
-            lista_saved, lista_not_saved = self.enroll_create_user(
-                list_course, context['modo'], lista_data, enroll)
-
             login_url = request.build_absolute_uri('/login')
             helpdesk_url = request.build_absolute_uri('/contact_form')
-            email_saved = []
-            courses = [get_course_by_id(CourseKey.from_string(course_id)) for course_id in list_course]
-            courses_name = ''
-            for course in courses:
-                courses_name = courses_name + course.display_name_with_default + ', '
-            courses_name = courses_name[:-2]
-            for email in lista_saved:
-                if send_email:
-                    if 'email2' in email:
-                        enroll_email.delay(email['password'], email['email'], courses_name, email['sso'], email['exists'], login_url, email['nombreCompleto'], helpdesk_url, email['email2'])
-                    else:
-                        enroll_email.delay(email['password'], email['email'], courses_name, email['sso'], email['exists'], login_url, email['nombreCompleto'], helpdesk_url, '')
-                aux = email
-                aux.pop('password', None)
-                email_saved.append(aux)
+            if use_background_job(request, len(lista_data)):
+                job = create_job(request.user, 'external', {
+                    'course_ids': list_course,
+                    'mode': context['modo'],
+                    'lista_data': lista_data,
+                    'enroll': enroll,
+                    'send_email': send_email,
+                    'login_url': login_url,
+                    'helpdesk_url': helpdesk_url}, len(lista_data))
+                queue_job(job)
+                context = {
+                    'datos': '',
+                    'auto_enroll': enroll,
+                    'send_email': send_email,
+                    'curso': '',
+                    'modo': context['modo'],
+                    'job': get_job_status_context(job)
+                }
+                return render(request, 'edxlogin/external.html', context)
 
-            context = {
-                'datos': '',
-                'auto_enroll': True,
-                'send_email': True,
-                'curso': '',
-                'modo': 'honor',
-                'action_send': send_email
-            }
-            if len(email_saved) > 0:
-                context['lista_saved'] = email_saved
-            if len(lista_not_saved) > 0:
-                context['lista_not_saved'] = lista_not_saved
+            lista_saved, lista_not_saved = self.enroll_create_user(
+                list_course, context['modo'], lista_data, enroll)
+            email_saved = self.send_enroll_emails(list_course, lista_saved, send_email, login_url, helpdesk_url)
+            context = self.saved_context(email_saved, lista_not_saved, send_email)
             return render(request, 'edxlogin/external.html', context)
         else:
             raise Http404()
 
+    def send_enroll_emails(self, course_ids, lista_saved, send_email, login_url, helpdesk_url):
+        """
+        Send the enroll email to the saved users if send_email is set.
+        Returns the saved users without their password.
+        """
+        email_saved = []
+        courses = [get_course_by_id(CourseKey.from_string(course_id)) for course_id in course_ids]
+        courses_name = ''
+        for course in courses:
+            courses_name = courses_name + course.display_name_with_default + ', '
+        courses_name = courses_name[:-2]
+        for email in lista_saved:
+            if send_email:
+                if 'email2' in email:
+                    enroll_email.delay(email['password'], email['email'], courses_name, email['sso'], email['exists'], login_url, email['nombreCompleto'], helpdesk_url, email['email2'])
+                else:
+                    enroll_email.delay(email['password'], email['email'], courses_name, email['sso'], email['exists'], login_url, email['nombreCompleto'], helpdesk_url, '')
+            aux = email
+            aux.pop('password', None)
+            email_saved.append(aux)
+        return email_saved
+
+    def saved_context(self, email_saved, lista_not_saved, send_email):
+        """
+        Context of the external page once the users are saved.
+        """
+        context = {
+            'datos': '',
+            'auto_enroll': True,
+            'send_email': True,
+            'curso': '',
+            'modo': 'honor',
+            'action_send': send_email
+        }
+        if len(email_saved) > 0:
+            context['lista_saved'] = email_saved
+        if len(lista_not_saved) > 0:
+            context['lista_not_saved'] = lista_not_saved
+        return context
+
     def validate_data_external(self, user, lista_data, context):
         """
             Validate Data
         """
         wrong_data = []
         duplicate_data = [[],[]]
-        original_data = [[],[]]
+        original_data = [set(), set()]
         duplicate_courses = []
         original_courses = []
         # si no se ingreso datos
         if not lista_data:
             logger.error("EdxLoginExternal - Empty Data, user: {}".format(user.id))
             context['no_data'] = ''
-        if len(lista_data) > 50:
-            logger.error("EdxLoginExternal - data limit is 50, length data: {} user: {}".format(len(lista_data),user.id))
+        if len(lista_data) > get_bulk_max_rows():
+            logger.error("EdxLoginExternal - data limit is {}, length data: {} user: {}".format(get_bulk_max_rows(), len(lista_data), user.id))
             context['limit_data'] = ''
         else:
             for data in lista_data:
@@ -573,7 +962,8 @@ class EdxLoginExternal(View):
                     if len(data) == 2:
                         data.append("")
                     else:
-                        data[2] = data[2].upper()
+                        data[2] = clean_doc_id(data[2])
+                    doc_id = format_doc_id(data[2])
                     if data[0] != "" and data[1] != "":
                         aux_name = unidecode.unidecode(data[0])
                         aux_name = re.sub(r'[^a-zA-Z0-9\_]', ' ', aux_name)
@@ -583,18 +973,18 @@ class EdxLoginExternal(View):
                         elif not re.match(regex, data[1]):
                             logger.error("EdxLoginExternal - Invalid Email {}, user: {}, invalid_data: {}".format(data[1], user.id, wrong_data))
                             wrong_data.append(data)
-                        elif data[2] != "" and not validate_all_doc_id_types(data[2]):
+                        elif doc_id != "" and not is_valid_doc_id(data[2], get_document_type(data[2])):
                             logger.error("EdxLoginExternal - Invalid doc_id {}, user: {}, invalid_data: {}".format(data[2], user.id, wrong_data))
                             wrong_data.append(data)
-                        elif data[1] in original_data[0] or (data[2] != '' and data[2] in original_data[1]):
+                        elif data[1] in original_data[0] or (doc_id != '' and doc_id in original_data[1]):
                             if data[1] in original_data[0]:
                                 duplicate_data[0].append(data[1])
-                            if data[2] != '' and data[2] in original_data[1]:
+                            if doc_id != '' and doc_id in original_data[1]:
                                 duplicate_data[1].append(data[2])
                         else:
-                            original_data[0].append(data[1])
-                            if data[2] != '':
-                                original_data[1].append(data[2])
+                            original_data[0].add(data[1])
+                            if doc_id != '':
+                                original_data[1].add(doc_id)
                     else:
                         wrong_data.append(data)
         if len(wrong_data) > 0:
@@ -616,20 +1006,22 @@ class EdxLoginExternal(View):
             list_course = context['curso'].split('\n')
             list_course = [course_id.strip() for course_id in list_course]
             list_course = [course_id for course_id in list_course if course_id]
+            valid_courses = validate_courses(list_course)
             for course_id in list_course:
                 if course_id in original_courses:
                     duplicate_courses.append(course_id)
                 else:
                     original_courses.append(course_id)
-                if not validate_course(course_id):
+                if course_id not in valid_courses:
                     if 'error_curso' not in context:
                         context['error_curso'] = [course_id]
                     else:
                         context['error_curso'].append(course_id)
                     logger.error("EdxLoginExternal - Course dont exists, user: {}, course_id: {}".format(user.id, course_id))
             if 'error_curso' not in context:
+                permissions = CoursePermissionResolver(user)
                 for course_id in list_course:
-                    if not validate_user(user, course_id):
+                    if not permissions.has_access(course_id):
                         if 'error_permission' not in context:
                             context['error_permission'] = [course_id]
                         else:
@@ -644,90 +1036,132 @@ class EdxLoginExternal(View):
             logger.error("EdxLoginExternal - Wrong Mode, user: {}, mode: {}".format(user.id, context['modo']))
         return context
 
-    def enroll_create_user(self, course_ids, mode, lista_data, enroll):
+    def enroll_create_user(self, course_ids, mode, lista_data, enroll, checkpoint=None):
         """
         Create and enroll the user with/without UChile account
         if email or doc_id exists not saved them
+        Each row is saved in its own savepoint, if it fails it's not saved and the others are.
+        checkpoint(lista_saved, lista_not_saved, outcomes) is called at the end of the transaction,
+        with the outcome ('created', 'enrolled', 'not_saved' or 'failed') of each row, to save the
+        progress of a job with the rows.
         """
+        timer = metrics.StageTimer('external_enroll')
         lista_saved = []
         lista_not_saved = []
+        outcomes = []
+        course_keys = [CourseKey.from_string(course_id) for course_id in course_ids]
+        username_allocator = UsernameAllocator([{'nombreCompleto': dato[0].strip()} for dato in lista_data])
+        datos = []
+        for dato in lista_data:
+            dato = [d.strip() for d in dato]
+            if len(dato) == 2:
+                dato.append("")
+            dato[2] = format_doc_id(dato[2])
+            datos.append(dato)
+        # Check if the new doc_ids have sso concurrently, before the transaction.
+        doc_ids = [dato[2] for dato in datos if dato[2] != ""]
+        edxlogin_users = get_users_by_doc_ids(doc_ids)
+        with timer.stage('ph_prefetch'):
+            doc_ids_have_sso = check_doc_ids_have_sso([doc_id for doc_id in doc_ids if doc_id not in edxlogin_users])
         # guarda el form
-        with transaction.atomic():
-            for dato in lista_data:
-                dato = [d.strip() for d in dato]
-                if len(dato) == 3:
-                    dato[2] = dato[2].upper()
-                    dato[2] = dato[2].replace("-", "")
-                    dato[2] = dato[2].replace(".", "")
-                    dato[2] = dato[2].strip()
-                if len(dato) == 2:
-                    dato.append("")
-                while len(dato[2]) > 0 and len(dato[2]) < 10 and 'P' != dato[2][0] and 'CG' != dato[2][0:2]:
-                    dato[2] = "0" + dato[2]
-                aux_pass = BaseUserManager().make_random_password(12)
-                aux_pass = aux_pass.lower()
-                user_exists = False
-                if dato[2] != "":
-                    aux_email = ''
-                    edxlogin_user = get_user_by_doc_id(dato[2])
-                    if edxlogin_user is not None:
-                        if not edxlogin_user.have_sso:
-                            if edxlogin_user.user.email != dato[1]:
-                                aux_email = edxlogin_user.user.email
-                    else:
-                        edxlogin_user, created = self.get_or_create_user_with_doc_id(dato, aux_pass)
-                        if not created and edxlogin_user is not None:
-                            user_exists = True
-                    if edxlogin_user is None:
-                        lista_not_saved.append([dato[1], dato[2]])
-                    else:
-                        for course_id in course_ids:
-                            enroll_in_course(edxlogin_user.user, course_id, enroll, mode)
-                        aux_append = {
-                            'email': dato[1],
-                            'nombreCompleto': edxlogin_user.user.profile.name.strip(),
-                            'doc_id': dato[2],
-                            'password': aux_pass,
-                            'sso': edxlogin_user.have_sso,
-                            'exists': user_exists
-                        }
-                        if aux_email != '':
-                            aux_append['email2'] = aux_email
-                        lista_saved.append(aux_append)
+        with timer.stage('transaction'), transaction.atomic():
+            for dato in datos:
+                try:
+                    with transaction.atomic():
+                        saved, outcome = self.enroll_create_row(
+                            dato, course_keys, mode, enroll, edxlogin_users.get(dato[2]),
+                            doc_ids_have_sso.get(dato[2], NOT_PREFETCHED), username_allocator)
+                except Exception:
+                    logger.exception("EdxLoginExternal - Failed to save the row: {}".format(dato))
+                    saved, outcome = None, 'failed'
+                if saved is None:
+                    lista_not_saved.append([dato[1], dato[2]])
                 else:
-                    doc_id = ''
-                    have_sso = False
-                    try:
-                        user = User.objects.get(email=dato[1])
-                        user_exists = True
-                        doc_id = get_doc_id_by_user_id(user.id)
-                        if doc_id is not None:
-                            edxlogin_user = get_user_by_doc_id(doc_id)
-                            have_sso = edxlogin_user.have_sso
-                            doc_id = edxlogin_user.run
-                    except User.DoesNotExist:
-                        user_data = {
-                            'email':dato[1],
-                            'nombreCompleto':dato[0],
-                            'pass': aux_pass
-                        }
-                        user = create_user_by_data(user_data, dato[1], True)
-                    for course_id in course_ids:
-                        enroll_in_course(user, course_id, enroll, mode)
-                    lista_saved.append({
-                        'email': dato[1],
-                        'nombreCompleto': user.profile.name.strip(),
-                        'doc_id': doc_id,
-                        'password': aux_pass,
-                        'sso': have_sso,
-                        'exists': user_exists
-                    })
+                    lista_saved.append(saved)
+                outcomes.append(outcome)
+            if checkpoint is not None:
+                checkpoint(lista_saved, lista_not_saved, outcomes)
         return lista_saved, lista_not_saved
 
-    def get_or_create_user_with_doc_id(self, dato, aux_pass):
+    def enroll_create_row(self, dato, course_keys, mode, enroll, edxlogin_user, have_sso, username_allocator):
+        """
+        Create and enroll the user of a row of enroll_create_user, edxlogin_user is the
+        edxloginuser of its doc_id if it already exists and have_sso whether its doc_id have sso
+        (None if ph was unavailable, NOT_PREFETCHED if it wasn't checked).
+        Returns the saved user (None if it's not saved) and the outcome of the row.
+        """
+        aux_pass = BaseUserManager().make_random_password(12)
+        aux_pass = aux_pass.lower()
+        user_exists = False
+        if dato[2] != "":
+            aux_email = ''
+            created = False
+            if edxlogin_user is not None:
+                if not edxlogin_user.have_sso:
+                    if edxlogin_user.user.email != dato[1]:
+                        aux_email = edxlogin_user.user.email
+            elif have_sso is None:
+                # ph was unavailable when it was checked, it isn't saved without knowing if it have sso.
+                logger.warning("EdxLoginExternal - Can't check if doc_id: {} have sso, ph is unavailable".format(dato[2]))
+                return None, 'failed'
+            else:
+                edxlogin_user, created = self.get_or_create_user_with_doc_id(
+                    dato, aux_pass, username_allocator, have_sso)
+                if not created and edxlogin_user is not None:
+                    user_exists = True
+            if edxlogin_user is None:
+                return None, 'not_saved'
+            for course_key in course_keys:
+                enroll_in_course(edxlogin_user.user, course_key, enroll, mode)
+            aux_append = {
+                'email': dato[1],
+                'nombreCompleto': edxlogin_user.user.profile.name.strip(),
+                'doc_id': dato[2],
+                'password': aux_pass,
+                'sso': edxlogin_user.have_sso,
+                'exists': user_exists
+            }
+            if aux_email != '':
+                aux_append['email2'] = aux_email
+            return aux_append, 'created' if created else 'enrolled'
+        doc_id = ''
+        have_sso = False
+        try:
+            user = User.objects.get(email=dato[1])
+            user_exists = True
+            doc_id = get_doc_id_by_user_id(user.id)
+            if doc_id is not None:
+                edxlogin_user = get_user_by_doc_id(doc_id)
+                have_sso = edxlogin_user.have_sso
+                doc_id = edxlogin_user.run
+        except User.DoesNotExist:
+            user_data = {
+                'email':dato[1],
+                'nombreCompleto':dato[0],
+                'pass': aux_pass
+            }
+            user = create_user_by_data(user_data, dato[1], True, username=username_allocator.allocate(user_data))
+        for course_key in course_keys:
+            enroll_in_course(user, course_key, enroll, mode)
+        saved = {
+            'email': dato[1],
+            'nombreCompleto': user.profile.name.strip(),
+            'doc_id': doc_id,
+            'password': aux_pass,
+            'sso': have_sso,
+            'exists': user_exists
+        }
+        return saved, 'enrolled' if user_exists else 'created'
+
+    def get_or_create_user_with_doc_id(self, dato, aux_pass, username_allocator=None, have_sso=NOT_PREFETCHED):
         """
         Get user data and create the user.
+        If it was already checked, whether the doc_id have sso can be given in have_sso to
+        avoid querying ph. Otherwise it's checked here, raising if ph is unavailable so the row
+        isn't saved without knowing it.
         """
+        if have_sso is NOT_PREFETCHED:
+            have_sso = check_doc_id_have_sso(dato[2])
         created = False
         if User.objects.filter(email=dato[1]).exists():
             user = User.objects.get(email=dato[1])
@@ -735,26 +1169,22 @@ class EdxLoginExternal(View):
             if doc_id is not None:
                 return None, created
             else:
-                check_sso = check_doc_id_have_sso(dato[2])
                 try:
-                    edxlogin_user = create_edxloginuser(user, check_sso, dato[2])
+                    edxlogin_user = create_edxloginuser(user, have_sso, dato[2])
                 except:
                     logger.error(f"Can't create edxlogin_user for user: {user}.")
                     return None, False
         else:
-            try:
-                check_sso = check_doc_id_have_sso(dato[2])
-            except Exception:
-                check_sso = False
             with transaction.atomic():
                 user_data = {
                     'email': dato[1],
                     'nombreCompleto': dato[0],
                     'pass': aux_pass
                 }
-                user = create_user_by_data(user_data, dato[1], True)
+                username = username_allocator.allocate(user_data) if username_allocator else None
+                user = create_user_by_data(user_data, dato[1], True, username=username)
                 try:
-                    edxlogin_user = create_edxloginuser(user, check_sso, dato[2])
+                    edxlogin_user = create_edxloginuser(user, have_sso, dato[2])
                 except:
                     logger.error(f"Can't create edxlogin_user for user: {user}.")
                     return None, False
@@ -778,28 +1208,19 @@ class EdxLoginUserData(View):
         Returns a CSV with the data for the requested users.
         """
         if check_permission_instructor_staff(request.user):
-            doc_id_list = request.POST.get("doc_ids", "").split('\n')
-            # doc_id clean up.
-            doc_id_list = [doc_id.upper() for doc_id in doc_id_list]
-            doc_id_list = [doc_id.replace("-", "") for doc_id in doc_id_list]
-            doc_id_list = [doc_id.replace(".", "") for doc_id in doc_id_list]
-            doc_id_list = [doc_id.strip() for doc_id in doc_id_list]
-            doc_id_list = [doc_id for doc_id in doc_id_list if doc_id]
+            doc_ids = parse_doc_ids(request.POST.get("doc_ids", ""))
 
             context = {
                 'doc_ids': request.POST.get('doc_ids')
             }
             # Data validation.
-            invalid_doc_id_list = []
-            for doc_id in doc_id_list:
-                if not validate_all_doc_id_types(doc_id):
-                    invalid_doc_id_list.append(doc_id)
+            invalid_doc_id_list = [doc_id.cleaned for doc_id in doc_ids if not doc_id.valid]
             if invalid_doc_id_list:
                 context["invalid_doc_ids"] = " - ".join(invalid_doc_id_list)
             # Returns if there is no input or if there is an invalid doc_id.
-            if invalid_doc_id_list or not doc_id_list:
+            if invalid_doc_id_list or not doc_ids:
                 return render(request, 'edxlogin/userdata.html', context)
-            return self.export_data(doc_id_list)
+            return self.export_data([doc_id.value for doc_id in doc_ids])
         else:
             raise Http404()
 
@@ -817,21 +1238,19 @@ class EdxLoginUserData(View):
             encoding='utf-8')
         headers = ['Documento_id', 'Username', 'Apellido Paterno', 'Apellido Materno', 'Nombre', 'Email']
         writer.writerow(headers)
-        for doc_id in doc_id_list:
-            while len(doc_id) < 10 and 'P' != doc_id[0] and 'CG' != doc_id[0:2]:
-                doc_id = "0" + doc_id
-            try:
-                user_data = get_user_data(doc_id, 'indiv_id')
-            except Exception:
+        # All the doc_ids are queried concurrently, keeping the order of the list.
+        for result in get_user_data_many(doc_id_list, 'indiv_id'):
+            user_data = result.data
+            if result.error is not None:
                 user_data = {
-                'doc_id': doc_id,
-                'username': 'No Encontrado',
-                'nombres': 'No Encontrado',
-                'apellidoPaterno': 'No Encontrado',
-                'apellidoMaterno': 'No Encontrado',
-                'emails': ['No Encontrado']
-            }
-            data = [doc_id,
+                    'doc_id': result.value,
+                    'username': 'No Encontrado',
+                    'nombres': 'No Encontrado',
+                    'apellidoPaterno': 'No Encontrado',
+                    'apellidoMaterno': 'No Encontrado',
+                    'emails': ['No Encontrado']
+                }
+            data = [result.value,
                     user_data['username'],
                     user_data['apellidoPaterno'],
                     user_data['apellidoMaterno'],